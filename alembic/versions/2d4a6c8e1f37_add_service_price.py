@@ -0,0 +1,26 @@
+"""add service price
+
+Revision ID: 2d4a6c8e1f37
+Revises: 9e2f7c41a8d5
+Create Date: 2026-10-18 12:41:19.630254
+
+"""
+from typing import Sequence
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '2d4a6c8e1f37'
+down_revision: str | None = '9e2f7c41a8d5'
+branch_labels: str | Sequence[str] | None = None
+depends_on: str | Sequence[str] | None = None
+
+
+def upgrade() -> None:
+    op.add_column('services', sa.Column('price', sa.Numeric(precision=10, scale=2), nullable=False, server_default='0'))
+
+
+def downgrade() -> None:
+    op.drop_column('services', 'price')
@@ -0,0 +1,151 @@
+"""index lookup fields and type date, time and money columns
+
+Revision ID: 3c9e51d7a2f4
+Revises: 87f4012b68be
+Create Date: 2026-10-18 10:02:17.503861
+
+"""
+from typing import Sequence
+
+from alembic import op
+import sqlalchemy as sa
+import sqlmodel
+
+
+# revision identifiers, used by Alembic.
+revision: str = '3c9e51d7a2f4'
+down_revision: str | None = '87f4012b68be'
+branch_labels: str | Sequence[str] | None = None
+depends_on: str | Sequence[str] | None = None
+
+
+INDEXES = [
+    ('job', 'customerId'),
+    ('job', 'employeeId'),
+    ('job', 'invoiceId'),
+    ('job', 'clockIn'),
+    ('expense', 'purchasedBy'),
+    ('expense', 'linkedJob'),
+    ('expense', 'expenseDate'),
+    ('user', 'email'),
+    ('customer', 'frequencyId'),
+    ('invoice', 'invoiceDate'),
+    ('invoice', 'dueDate'),
+]
+
+
+# Dates were typed in as either 2025-05-10 or 5/10/2025. Anything else (blank, free text or a day that
+# doesn't exist like 2/30/2025) becomes NULL, so these columns are nullable. A cast error inside
+# ALTER COLUMN ... USING would abort the migration, so the parsing happens in plpgsql functions that
+# catch it. They only exist for the length of the upgrade.
+SAFE_DATE = r"""
+CREATE FUNCTION safe_date(value text) RETURNS date AS $$
+DECLARE
+    parts text[];
+BEGIN
+    parts := regexp_match(value, '^(\d{1,2})/(\d{1,2})/(\d{4})$');
+    IF parts IS NOT NULL THEN
+        RETURN make_date(parts[3]::int, parts[1]::int, parts[2]::int);
+    END IF;
+    parts := regexp_match(value, '^(\d{4})-(\d{1,2})-(\d{1,2})$');
+    IF parts IS NOT NULL THEN
+        RETURN make_date(parts[1]::int, parts[2]::int, parts[3]::int);
+    END IF;
+    RETURN NULL;
+EXCEPTION WHEN others THEN
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql IMMUTABLE
+"""
+
+# Clock times saved without a date (e.g. 08:15) can't be placed on a day, so they become NULL,
+# as do impossible ones like 2025-02-30 08:00
+SAFE_TIMESTAMP = r"""
+CREATE FUNCTION safe_timestamp(value text) RETURNS timestamp AS $$
+BEGIN
+    IF value ~ '^\d{4}-\d{2}-\d{2}' THEN
+        RETURN value::timestamp;
+    END IF;
+    RETURN NULL;
+EXCEPTION WHEN others THEN
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql IMMUTABLE
+"""
+
+
+def as_date(column: str) -> str:
+    return f'safe_date("{column}")'
+
+
+def as_timestamp(column: str) -> str:
+    return f'safe_timestamp("{column}")'
+
+
+# Strips currency symbols and thousands separators, blank amounts become 0
+def as_money(column: str) -> str:
+    return f"COALESCE(NULLIF(regexp_replace(\"{column}\", '[^0-9.-]', '', 'g'), '')::numeric(10, 2), 0)"
+
+
+# Columns the conversion can leave NULL. Alembic changes the type before dropping NOT NULL,
+# so the constraint goes first in its own statement.
+NULLABLE = [
+    ('invoice', 'invoiceDate'),
+    ('invoice', 'dueDate'),
+    ('expense', 'expenseDate'),
+    ('job', 'clockIn'),
+    ('job', 'clockOut'),
+]
+
+
+def upgrade() -> None:
+    for table, column in NULLABLE:
+        op.alter_column(table, column, existing_type=sqlmodel.sql.sqltypes.AutoString(), nullable=True)
+    op.execute(SAFE_DATE)
+    op.execute(SAFE_TIMESTAMP)
+    op.alter_column('invoice', 'invoiceDate', existing_type=sqlmodel.sql.sqltypes.AutoString(),
+                    type_=sa.Date(), postgresql_using=as_date('invoiceDate'))
+    op.alter_column('invoice', 'dueDate', existing_type=sqlmodel.sql.sqltypes.AutoString(),
+                    type_=sa.Date(), postgresql_using=as_date('dueDate'))
+    op.alter_column('expense', 'expenseDate', existing_type=sqlmodel.sql.sqltypes.AutoString(),
+                    type_=sa.Date(), postgresql_using=as_date('expenseDate'))
+    op.alter_column('expense', 'totalAmount', existing_type=sqlmodel.sql.sqltypes.AutoString(),
+                    type_=sa.Numeric(precision=10, scale=2), postgresql_using=as_money('totalAmount'))
+    op.alter_column('invoice', 'taxAmount', existing_type=sa.Float(),
+                    type_=sa.Numeric(precision=10, scale=2), postgresql_using='"taxAmount"::numeric(10, 2)')
+    op.alter_column('invoice', 'totalEstimate', existing_type=sa.Float(),
+                    type_=sa.Numeric(precision=10, scale=2), postgresql_using='"totalEstimate"::numeric(10, 2)')
+    op.alter_column('job', 'clockIn', existing_type=sqlmodel.sql.sqltypes.AutoString(),
+                    type_=sa.DateTime(), postgresql_using=as_timestamp('clockIn'))
+    op.alter_column('job', 'clockOut', existing_type=sqlmodel.sql.sqltypes.AutoString(),
+                    type_=sa.DateTime(), postgresql_using=as_timestamp('clockOut'))
+    op.execute('DROP FUNCTION safe_timestamp(text)')
+    op.execute('DROP FUNCTION safe_date(text)')
+
+    for table, column in INDEXES:
+        op.create_index(op.f(f'ix_{table}_{column}'), table, [column], unique=False)
+
+
+def downgrade() -> None:
+    for table, column in reversed(INDEXES):
+        op.drop_index(op.f(f'ix_{table}_{column}'), table_name=table)
+
+    op.alter_column('job', 'clockOut', existing_type=sa.DateTime(), type_=sqlmodel.sql.sqltypes.AutoString(),
+                    nullable=False, postgresql_using='COALESCE("clockOut"::text, \'\')')
+    op.alter_column('job', 'clockIn', existing_type=sa.DateTime(), type_=sqlmodel.sql.sqltypes.AutoString(),
+                    nullable=False, postgresql_using='COALESCE("clockIn"::text, \'\')')
+    op.alter_column('invoice', 'totalEstimate', existing_type=sa.Numeric(precision=10, scale=2),
+                    type_=sa.Float(), postgresql_using='"totalEstimate"::float')
+    op.alter_column('invoice', 'taxAmount', existing_type=sa.Numeric(precision=10, scale=2),
+                    type_=sa.Float(), postgresql_using='"taxAmount"::float')
+    op.alter_column('expense', 'totalAmount', existing_type=sa.Numeric(precision=10, scale=2),
+                    type_=sqlmodel.sql.sqltypes.AutoString(), postgresql_using='"totalAmount"::text')
+    op.alter_column('expense', 'expenseDate', existing_type=sa.Date(),
+                    type_=sqlmodel.sql.sqltypes.AutoString(), nullable=False,
+                    postgresql_using='COALESCE("expenseDate"::text, \'\')')
+    op.alter_column('invoice', 'dueDate', existing_type=sa.Date(),
+                    type_=sqlmodel.sql.sqltypes.AutoString(), nullable=False,
+                    postgresql_using='COALESCE("dueDate"::text, \'\')')
+    op.alter_column('invoice', 'invoiceDate', existing_type=sa.Date(),
+                    type_=sqlmodel.sql.sqltypes.AutoString(), nullable=False,
+                    postgresql_using='COALESCE("invoiceDate"::text, \'\')')
@@ -0,0 +1,37 @@
+"""add job service date and geocode cache
+
+Revision ID: 5b8d1e6f0c93
+Revises: 3c9e51d7a2f4
+Create Date: 2026-10-18 11:24:06.771532
+
+"""
+from typing import Sequence
+
+from alembic import op
+import sqlalchemy as sa
+import sqlmodel
+
+
+# revision identifiers, used by Alembic.
+revision: str = '5b8d1e6f0c93'
+down_revision: str | None = '3c9e51d7a2f4'
+branch_labels: str | Sequence[str] | None = None
+depends_on: str | Sequence[str] | None = None
+
+
+def upgrade() -> None:
+    op.add_column('job', sa.Column('serviceDate', sa.Date(), nullable=True))
+    op.create_index(op.f('ix_job_serviceDate'), 'job', ['serviceDate'], unique=False)
+    op.create_table('geocodecache',
+    sa.Column('address', sqlmodel.sql.sqltypes.AutoString(), nullable=False),
+    sa.Column('lat', sa.Float(), nullable=True),
+    sa.Column('lng', sa.Float(), nullable=True),
+    sa.Column('geocodedAt', sa.DateTime(timezone=True), nullable=False),
+    sa.PrimaryKeyConstraint('address')
+    )
+
+
+def downgrade() -> None:
+    op.drop_table('geocodecache')
+    op.drop_index(op.f('ix_job_serviceDate'), table_name='job')
+    op.drop_column('job', 'serviceDate')
@@ -0,0 +1,63 @@
+"""add report summaries
+
+Revision ID: 7f3b9d2c5e60
+Revises: 2d4a6c8e1f37
+Create Date: 2026-10-18 13:17:42.915306
+
+"""
+from typing import Sequence
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '7f3b9d2c5e60'
+down_revision: str | None = '2d4a6c8e1f37'
+branch_labels: str | Sequence[str] | None = None
+depends_on: str | Sequence[str] | None = None
+
+
+def upgrade() -> None:
+    op.create_table('revenuesummary',
+    sa.Column('month', sa.Date(), nullable=False),
+    sa.Column('invoiced', sa.Numeric(precision=12, scale=2), nullable=False),
+    sa.Column('collected', sa.Numeric(precision=12, scale=2), nullable=False),
+    sa.Column('invoices', sa.Integer(), nullable=False),
+    sa.Column('refreshedAt', sa.DateTime(timezone=True), nullable=False),
+    sa.PrimaryKeyConstraint('month')
+    )
+    op.create_table('expensesummary',
+    sa.Column('month', sa.Date(), nullable=False),
+    sa.Column('employeeId', sa.Integer(), nullable=False),
+    sa.Column('amount', sa.Numeric(precision=12, scale=2), nullable=False),
+    sa.Column('expenses', sa.Integer(), nullable=False),
+    sa.Column('refreshedAt', sa.DateTime(timezone=True), nullable=False),
+    sa.PrimaryKeyConstraint('month', 'employeeId')
+    )
+    op.create_table('laborsummary',
+    sa.Column('month', sa.Date(), nullable=False),
+    sa.Column('employeeId', sa.Integer(), nullable=False),
+    sa.Column('hours', sa.Float(), nullable=False),
+    sa.Column('cost', sa.Numeric(precision=12, scale=2), nullable=False),
+    sa.Column('jobs', sa.Integer(), nullable=False),
+    sa.Column('refreshedAt', sa.DateTime(timezone=True), nullable=False),
+    sa.PrimaryKeyConstraint('month', 'employeeId')
+    )
+    op.create_table('receivablessummary',
+    sa.Column('dueMonth', sa.Date(), nullable=False),
+    sa.Column('outstanding', sa.Numeric(precision=12, scale=2), nullable=False),
+    sa.Column('invoices', sa.Integer(), nullable=False),
+    sa.Column('refreshedAt', sa.DateTime(timezone=True), nullable=False),
+    sa.PrimaryKeyConstraint('dueMonth')
+    )
+    op.create_index('ix_invoice_unpaid_dueDate', 'invoice', ['dueDate'], unique=False,
+                    postgresql_where=sa.text('NOT paid'))
+
+
+def downgrade() -> None:
+    op.drop_index('ix_invoice_unpaid_dueDate', table_name='invoice', postgresql_where=sa.text('NOT paid'))
+    op.drop_table('receivablessummary')
+    op.drop_table('laborsummary')
+    op.drop_table('expensesummary')
+    op.drop_table('revenuesummary')
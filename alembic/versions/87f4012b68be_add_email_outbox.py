@@ -0,0 +1,42 @@
+"""add email outbox
+
+Revision ID: 87f4012b68be
+Revises: 760729ef071f
+Create Date: 2026-10-18 09:12:40.118204
+
+"""
+from typing import Sequence
+
+from alembic import op
+import sqlalchemy as sa
+import sqlmodel
+
+
+# revision identifiers, used by Alembic.
+revision: str = '87f4012b68be'
+down_revision: str | None = '760729ef071f'
+branch_labels: str | Sequence[str] | None = None
+depends_on: str | Sequence[str] | None = None
+
+
+def upgrade() -> None:
+    op.create_table('emailoutbox',
+    sa.Column('emailId', sa.Integer(), nullable=False),
+    sa.Column('toEmail', sqlmodel.sql.sqltypes.AutoString(), nullable=False),
+    sa.Column('subject', sqlmodel.sql.sqltypes.AutoString(), nullable=False),
+    sa.Column('body', sqlmodel.sql.sqltypes.AutoString(), nullable=False),
+    sa.Column('invoiceId', sa.Integer(), nullable=True),
+    sa.Column('status', sqlmodel.sql.sqltypes.AutoString(), nullable=False),
+    sa.Column('attempts', sa.Integer(), nullable=False),
+    sa.Column('nextAttemptAt', sa.DateTime(timezone=True), nullable=False),
+    sa.Column('lastError', sqlmodel.sql.sqltypes.AutoString(), nullable=True),
+    sa.Column('sentAt', sa.DateTime(timezone=True), nullable=True),
+    sa.ForeignKeyConstraint(['invoiceId'], ['invoice.invoiceId'], ),
+    sa.PrimaryKeyConstraint('emailId')
+    )
+    op.create_index(op.f('ix_emailoutbox_status'), 'emailoutbox', ['status'], unique=False)
+
+
+def downgrade() -> None:
+    op.drop_index(op.f('ix_emailoutbox_status'), table_name='emailoutbox')
+    op.drop_table('emailoutbox')
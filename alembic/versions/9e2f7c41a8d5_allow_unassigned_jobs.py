@@ -0,0 +1,26 @@
+"""allow unassigned jobs
+
+Revision ID: 9e2f7c41a8d5
+Revises: 5b8d1e6f0c93
+Create Date: 2026-10-18 12:03:51.208337
+
+"""
+from typing import Sequence
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '9e2f7c41a8d5'
+down_revision: str | None = '5b8d1e6f0c93'
+branch_labels: str | Sequence[str] | None = None
+depends_on: str | Sequence[str] | None = None
+
+
+def upgrade() -> None:
+    op.alter_column('job', 'employeeId', existing_type=sa.Integer(), nullable=True)
+
+
+def downgrade() -> None:
+    op.alter_column('job', 'employeeId', existing_type=sa.Integer(), nullable=False)
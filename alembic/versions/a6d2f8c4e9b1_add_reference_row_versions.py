@@ -0,0 +1,31 @@
+"""add reference row versions
+
+Revision ID: a6d2f8c4e9b1
+Revises: e1c7a9d3f5b8
+Create Date: 2026-10-18 18:04:51.263917
+
+"""
+from typing import Sequence
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'a6d2f8c4e9b1'
+down_revision: str | None = 'e1c7a9d3f5b8'
+branch_labels: str | Sequence[str] | None = None
+depends_on: str | Sequence[str] | None = None
+
+
+TABLES = ['services', 'frequency', 'servicearea', 'user']
+
+
+def upgrade() -> None:
+    for table in TABLES:
+        op.add_column(table, sa.Column('version', sa.Integer(), nullable=False, server_default='1'))
+
+
+def downgrade() -> None:
+    for table in reversed(TABLES):
+        op.drop_column(table, 'version')
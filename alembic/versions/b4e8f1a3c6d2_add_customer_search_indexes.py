@@ -0,0 +1,33 @@
+"""add customer search indexes
+
+Revision ID: b4e8f1a3c6d2
+Revises: 7f3b9d2c5e60
+Create Date: 2026-10-18 15:04:51.226730
+
+"""
+from typing import Sequence
+
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'b4e8f1a3c6d2'
+down_revision: str | None = '7f3b9d2c5e60'
+branch_labels: str | Sequence[str] | None = None
+depends_on: str | Sequence[str] | None = None
+
+
+# Must match search.search_document() for /customer/search to use these indexes
+DOCUMENT = ('lower("fName" || \' \' || "lName" || \' \' || email || \' \' || "phoneNumber" '
+            '|| \' \' || "physicalAddress")')
+
+
+def upgrade() -> None:
+    op.execute('CREATE EXTENSION IF NOT EXISTS pg_trgm')
+    op.execute(f'CREATE INDEX ix_customer_search_trgm ON customer USING gin (({DOCUMENT}) gin_trgm_ops)')
+    op.execute(f'CREATE INDEX ix_customer_search_tsv ON customer USING gin (to_tsvector(\'simple\'::regconfig, {DOCUMENT}))')
+
+
+def downgrade() -> None:
+    op.execute('DROP INDEX ix_customer_search_tsv')
+    op.execute('DROP INDEX ix_customer_search_trgm')
@@ -0,0 +1,30 @@
+"""add geocode retry columns
+
+Revision ID: d3a7c5e9f1b4
+Revises: a6d2f8c4e9b1
+Create Date: 2026-10-18 20:12:37.418206
+
+"""
+from typing import Sequence
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'd3a7c5e9f1b4'
+down_revision: str | None = 'a6d2f8c4e9b1'
+branch_labels: str | Sequence[str] | None = None
+depends_on: str | Sequence[str] | None = None
+
+
+def upgrade() -> None:
+    op.add_column('geocodecache', sa.Column('attempts', sa.Integer(), nullable=False, server_default='0'))
+    op.add_column('geocodecache', sa.Column('retryAt', sa.DateTime(timezone=True), nullable=True))
+    op.create_index(op.f('ix_geocodecache_retryAt'), 'geocodecache', ['retryAt'], unique=False)
+
+
+def downgrade() -> None:
+    op.drop_index(op.f('ix_geocodecache_retryAt'), table_name='geocodecache')
+    op.drop_column('geocodecache', 'retryAt')
+    op.drop_column('geocodecache', 'attempts')
@@ -0,0 +1,31 @@
+"""add row versions
+
+Revision ID: e1c7a9d3f5b8
+Revises: b4e8f1a3c6d2
+Create Date: 2026-10-18 16:22:08.417395
+
+"""
+from typing import Sequence
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'e1c7a9d3f5b8'
+down_revision: str | None = 'b4e8f1a3c6d2'
+branch_labels: str | Sequence[str] | None = None
+depends_on: str | Sequence[str] | None = None
+
+
+TABLES = ['customer', 'employee', 'invoice', 'expense', 'job']
+
+
+def upgrade() -> None:
+    for table in TABLES:
+        op.add_column(table, sa.Column('version', sa.Integer(), nullable=False, server_default='1'))
+
+
+def downgrade() -> None:
+    for table in reversed(TABLES):
+        op.drop_column(table, 'version')
@@ -0,0 +1,58 @@
+# Times plan_dispatch on a synthetic day and compares nearest neighbour alone with nearest neighbour + 2-opt.
+# Stops are scattered around the Magic Valley with a mix of all-day and three hour arrival windows.
+# Run from the repository root:
+#   python -m benchmarks.dispatch_solver --stops 300 --crews 30
+import argparse
+import os
+import random
+import time
+
+os.environ.setdefault("DATABASE_URL", "sqlite://")
+
+from dispatch import plan_dispatch
+
+
+DEPOT = (42.5558, -114.4701)
+
+
+def synthetic_day(stops: int, crews: int, seed: int) -> tuple[list[dict], dict]:
+    rng = random.Random(seed)
+    jobs, coordinates = [], {}
+    for n in range(stops):
+        address = f"{n} Synthetic Rd"
+        coordinates[address] = (DEPOT[0] + rng.uniform(-0.12, 0.12), DEPOT[1] + rng.uniform(-0.16, 0.16))
+        if rng.random() < 0.5:
+            window = "08:00-17:00"
+        else:
+            opens = rng.randrange(8, 15)
+            window = f"{opens:02d}:00-{opens + 3:02d}:00"
+        jobs.append({"jobId": n, "employeeId": n % crews + 1, "customerId": n, "address": address, "arrivalWindow": window})
+    return jobs, coordinates
+
+
+def summarize(plan: dict) -> tuple[float, float]:
+    return (sum(route["driveMinutes"] for route in plan["routes"]),
+            sum(route["lateMinutes"] for route in plan["routes"]))
+
+
+def main(stops: int, crews: int, repeat: int, seed: int):
+    jobs, coordinates = synthetic_day(stops, crews, seed)
+    for name, time_limit in (("nearest neighbour", 0.0), ("+ 2-opt", 0.5)):
+        timings = []
+        for _ in range(repeat):
+            began = time.perf_counter()
+            plan = plan_dispatch(jobs, coordinates, depot=DEPOT, time_limit=time_limit)
+            timings.append(time.perf_counter() - began)
+        drive, late = summarize(plan)
+        print(f"{name:18} best {min(timings) * 1000:7.1f} ms   drive {drive:8.1f} min   late {late:8.1f} min")
+    print(f"{stops} stops across {crews} crews")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--stops", type=int, default=300)
+    parser.add_argument("--crews", type=int, default=30)
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--seed", type=int, default=7)
+    args = parser.parse_args()
+    main(args.stops, args.crews, args.repeat, args.seed)
@@ -0,0 +1,77 @@
+# Compares the two ways a page of /job can be built:
+#   orm:     select(Job) -> Job objects -> jsonable_encoder -> json.dumps (FastAPI's default path)
+#   columns: select of Job's columns -> dicts from the row tuples -> orjson (what the list routes do now)
+# Run from the repository root:
+#   python -m benchmarks.job_list_json --rows 1000 --repeat 20
+import argparse
+import asyncio
+import json
+import os
+import time
+from datetime import datetime, timedelta
+
+os.environ.setdefault("DATABASE_URL", "sqlite://")
+
+from fastapi.encoders import jsonable_encoder
+from sqlalchemy.ext.asyncio import create_async_engine
+from sqlalchemy.pool import StaticPool
+from sqlmodel import SQLModel, select
+from sqlmodel.ext.asyncio.session import AsyncSession
+
+from fast_json import dumps, rows_as_dicts, select_columns
+from schema import Job
+
+
+async def seed(engine, rows: int):
+    async with engine.begin() as conn:
+        await conn.run_sync(SQLModel.metadata.create_all)
+    start = datetime(2025, 5, 1, 8)
+    async with AsyncSession(engine) as db:
+        await db.exec(Job.__table__.insert(), params=[
+            {"arrivalWindow": "08:00-10:00", "clockIn": start + timedelta(hours=n), "clockOut": start + timedelta(hours=n, minutes=90),
+             "employeeId": n % 7 + 1, "payment": n % 2 == 0, "isActive": True, "comments": "Back gate code 1234",
+             "customerId": n % 50 + 1}
+            for n in range(rows)
+        ])
+        await db.commit()
+
+
+async def orm_page(db: AsyncSession) -> bytes:
+    jobs = (await db.exec(select(Job).order_by(Job.jobId))).all()
+    return json.dumps(jsonable_encoder(jobs)).encode()
+
+
+async def column_page(db: AsyncSession) -> bytes:
+    return dumps(rows_as_dicts(await db.exec(select_columns(Job).order_by(Job.jobId))))
+
+
+async def timed(engine, build, repeat: int) -> list[float]:
+    timings = []
+    for _ in range(repeat):
+        async with AsyncSession(engine) as db:
+            began = time.perf_counter()
+            await build(db)
+            timings.append(time.perf_counter() - began)
+    return timings
+
+
+async def main(rows: int, repeat: int):
+    engine = create_async_engine("sqlite+aiosqlite://", poolclass=StaticPool)
+    await seed(engine, rows)
+    async with AsyncSession(engine) as db:
+        assert json.loads(await orm_page(db)) == json.loads(await column_page(db))
+
+    results = {name: await timed(engine, build, repeat) for name, build in (("orm", orm_page), ("columns", column_page))}
+    best = {name: min(timings) for name, timings in results.items()}
+    for name, timings in results.items():
+        print(f"{name:8} best {best[name] * 1000:8.2f} ms   mean {sum(timings) / len(timings) * 1000:8.2f} ms")
+    print(f"speedup  {best['orm'] / best['columns']:.1f}x for {rows} jobs")
+    await engine.dispose()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--rows", type=int, default=1000)
+    parser.add_argument("--repeat", type=int, default=20)
+    args = parser.parse_args()
+    asyncio.run(main(args.rows, args.repeat))
@@ -0,0 +1,255 @@
+# Drives the API with concurrent clients against a seeded database and reports latency percentiles
+# and throughput per route. Requests go through the whole ASGI app (middleware, validation,
+# serialization and real SQL) in process, or to a running server with --url.
+#
+# The database comes from DATABASE_URL (a throwaway SQLite file by default). Its tables are created
+# and, when it has no customers yet, seeded with --customers/--jobs/... rows. Point it at a scratch
+# Postgres, not one with real data: the write routes add and change rows.
+#
+# Run from the repository root:
+#   python -m benchmarks.load --concurrency 10 --requests 200
+#   python -m benchmarks.load --save-baseline   # store the numbers in benchmarks/load_baseline.json
+# With a baseline stored, a route whose p95 grows or whose requests/sec drops by more than
+# --tolerance fails the run with exit code 1, as does any unexpected status code.
+# The baseline holds each route's p95 and requests/sec relative to REFERENCE_ROUTE in the same run,
+# so it carries over between machines. A slowdown shared by every route (middleware, say) cancels
+# out and shows up only in the printed absolute numbers. Write routes queue for the database's write
+# lock, which makes their tail swing about 2x between identical runs on SQLite, so they're held to
+# the looser --write-tolerance.
+import argparse
+import asyncio
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+from datetime import date, datetime, timedelta
+from pathlib import Path
+from typing import Callable, NamedTuple
+
+os.environ.setdefault("DATABASE_URL", f"sqlite:///{Path(tempfile.gettempdir()) / 'qoty_load_test.db'}")
+
+import httpx
+from sqlalchemy import func
+from sqlmodel import SQLModel, select
+from sqlmodel.ext.asyncio.session import AsyncSession
+
+from database import async_engine
+from main import app
+from reports import refresh_reports
+from schema import Customer, Employee, Expense, Invoice, Job, Services
+
+
+BASELINE = Path(__file__).with_name("load_baseline.json")
+# The cheapest route through the whole stack, every other route is measured against it
+REFERENCE_ROUTE = "GET /services"
+SEASON_START = datetime(2025, 3, 3, 7)
+FIRST_NAMES = ["Ann", "Bob", "Carla", "Dev", "Elena", "Frank", "Grace", "Hiro", "Ines", "Jamal", "Kate", "Luis"]
+LAST_NAMES = ["Lee", "Johnson", "Martinez", "Nguyen", "Okafor", "Patel", "Quinn", "Rossi", "Smith", "Tanaka"]
+STREETS = ["Elm St", "Maple Ave", "Addison Ave", "Blue Lakes Blvd", "Falls Ave", "Kimberly Rd", "Pole Line Rd"]
+
+
+class Volumes(NamedTuple):
+    customers: int
+    employees: int
+    jobs: int
+    invoices: int
+    expenses: int
+
+
+class Scenario(NamedTuple):
+    name: str
+    method: str
+    expected: int
+    # Builds (path, query params, JSON body) for one request
+    build: Callable[[random.Random], tuple[str, dict | None, dict | None]]
+
+
+def customer_row(rng: random.Random, n: int) -> dict:
+    first, last = rng.choice(FIRST_NAMES), rng.choice(LAST_NAMES)
+    address = f"{rng.randint(1, 9999)} {rng.choice(STREETS)}"
+    return {"fName": first, "lName": f"{last}{n % 97}", "phoneNumber": f"208-555-{n % 10000:04d}",
+            "email": f"{first}.{last}{n}@example.com".lower(), "billingAddress": address, "physicalAddress": address,
+            "lastPaymentDate": "", "lastServiceDate": "", "isResidential": n % 5 != 0, "comments": ""}
+
+
+def job_row(rng: random.Random, volumes: Volumes) -> dict:
+    clock_in = SEASON_START + timedelta(days=rng.randrange(200), hours=rng.randrange(10))
+    return {"arrivalWindow": "08:00-12:00", "serviceDate": clock_in.date(), "clockIn": clock_in,
+            "clockOut": clock_in + timedelta(minutes=rng.randint(30, 180)),
+            "employeeId": rng.randint(1, volumes.employees), "payment": rng.random() < 0.7, "isActive": False,
+            "comments": "", "invoiceId": rng.randint(1, volumes.invoices), "customerId": rng.randint(1, volumes.customers)}
+
+
+# Seeds with one executemany per table, like the other benchmarks. Skipped when customers already exist.
+async def seed(volumes: Volumes, rng: random.Random) -> bool:
+    async with async_engine.begin() as conn:
+        await conn.run_sync(SQLModel.metadata.create_all)
+    async with AsyncSession(async_engine) as db:
+        if (await db.exec(select(func.count()).select_from(Customer))).one():
+            return False
+        await db.exec(Services.__table__.insert(), params=[
+            {"service": name, "price": price} for name, price in (("Mowing", 45), ("Edging", 20), ("Aeration", 90))])
+        await db.exec(Employee.__table__.insert(), params=[
+            {"fName": rng.choice(FIRST_NAMES), "lName": rng.choice(LAST_NAMES), "birthDate": "1990-01-01",
+             "phoneNumber": "", "email": f"crew{n}@example.com", "address": "", "laborRate": 16.0 + n % 8,
+             "weeklyHours": 0} for n in range(volumes.employees)])
+        await db.exec(Customer.__table__.insert(), params=[customer_row(rng, n) for n in range(volumes.customers)])
+        await db.exec(Invoice.__table__.insert(), params=[
+            {"lotSize": "", "invoiceDate": (SEASON_START + timedelta(days=n % 200)).date(),
+             "dueDate": (SEASON_START + timedelta(days=n % 200 + 14)).date(), "emailStatus": True, "productsUsed": "",
+             "acceptedBy": "", "applyTax": True, "taxAmount": 2.7, "totalEstimate": 47.7, "paid": rng.random() < 0.8}
+            for n in range(volumes.invoices)])
+        await db.exec(Job.__table__.insert(), params=[job_row(rng, volumes) for _ in range(volumes.jobs)])
+        await db.exec(Expense.__table__.insert(), params=[
+            {"expenseDate": (SEASON_START + timedelta(days=rng.randrange(200))).date(), "store": "Co-op",
+             "itemsPurchased": "Fuel", "totalAmount": round(rng.uniform(5, 120), 2), "reason": "",
+             "purchasedBy": rng.randint(1, volumes.employees), "linkedJob": rng.randint(1, volumes.jobs)}
+            for _ in range(volumes.expenses)])
+        await db.commit()
+        await refresh_reports(db, full=True)
+    return True
+
+
+def scenarios(volumes: Volumes) -> list[Scenario]:
+    def week(rng):
+        return (SEASON_START + timedelta(days=rng.randrange(200))).date().isoformat()
+
+    def job_update(rng):
+        job_id = rng.randint(1, volumes.jobs)
+        body = {key: value.isoformat() if isinstance(value, (date, datetime)) else value
+                for key, value in job_row(rng, volumes).items()}
+        return f"/job/{job_id}", {"jobId": job_id}, {"jobId": job_id, **body}
+
+    return [
+        Scenario("GET /services", "GET", 200, lambda rng: ("/services", None, None)),
+        Scenario("GET /customer page", "GET", 200, lambda rng: (
+            "/customer", {"limit": 100, "after": rng.randrange(volumes.customers)}, None)),
+        Scenario("GET /customer/search", "GET", 200, lambda rng: (
+            "/customer/search", {"q": f"{rng.choice(FIRST_NAMES)} {rng.choice(LAST_NAMES)}"}, None)),
+        Scenario("GET /job by employee", "GET", 200, lambda rng: (
+            "/job", {"limit": 100, "employeeId": rng.randint(1, volumes.employees), "sort": "-clockIn"}, None)),
+        Scenario("GET /invoice unpaid", "GET", 200, lambda rng: (
+            "/invoice", {"limit": 100, "paid": False, "after": rng.randrange(volumes.invoices)}, None)),
+        Scenario("GET /expense by employee", "GET", 200, lambda rng: (
+            "/expense", {"limit": 100, "purchasedBy": rng.randint(1, volumes.employees)}, None)),
+        Scenario("GET /reports/revenue", "GET", 200, lambda rng: ("/reports/revenue", None, None)),
+        Scenario("GET /payroll/{week}", "GET", 200, lambda rng: (f"/payroll/{week(rng)}", None, None)),
+        Scenario("POST /customer", "POST", 201, lambda rng: (
+            "/customer", None, customer_row(rng, rng.randrange(1_000_000)))),
+        Scenario("POST /expense", "POST", 201, lambda rng: ("/expense", None, {
+            "expenseDate": week(rng), "store": "Co-op", "itemsPurchased": "Seed", "totalAmount": "18.40",
+            "reason": "", "purchasedBy": rng.randint(1, volumes.employees)})),
+        Scenario("PUT /job/{id}", "PUT", 201, job_update),
+    ]
+
+
+# Nearest-rank percentile of sorted timings
+def percentile(timings: list[float], fraction: float) -> float:
+    return timings[min(len(timings) - 1, max(0, round(fraction * len(timings)) - 1))]
+
+
+# Sends `requests` requests for one scenario from `concurrency` clients at once
+async def run_scenario(client: httpx.AsyncClient, scenario: Scenario, requests: int, concurrency: int,
+                       rng: random.Random) -> dict:
+    calls = [scenario.build(rng) for _ in range(requests)]
+    timings, failures = [], []
+
+    async def worker():
+        while calls:
+            path, params, body = calls.pop()
+            began = time.perf_counter()
+            response = await client.request(scenario.method, path, params=params, json=body)
+            timings.append(time.perf_counter() - began)
+            if response.status_code != scenario.expected:
+                failures.append(f"{response.status_code} {response.text[:200]}")
+
+    began = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    elapsed = time.perf_counter() - began
+    timings.sort()
+    return {"requests": requests, "rps": round(requests / elapsed, 1), "failures": failures,
+            **{name: round(percentile(timings, fraction) * 1000, 2)
+               for name, fraction in (("p50", 0.50), ("p95", 0.95), ("p99", 0.99))}}
+
+
+# Each route's p95 as a multiple of REFERENCE_ROUTE's median, which is steadier than its p95,
+# and its requests/sec as a share of REFERENCE_ROUTE's
+def relative(results: dict) -> dict:
+    reference = results[REFERENCE_ROUTE]
+    return {name: {"p95": round(result["p95"] / reference["p50"], 2),
+                   "rps": round(result["rps"] / reference["rps"], 3)}
+            for name, result in results.items() if name != REFERENCE_ROUTE}
+
+
+# Routes whose relative p95 or throughput is more than `tolerance` (`write_tolerance` for anything
+# but GET) worse than the baseline
+def regressions(results: dict, baseline: dict, tolerance: float, write_tolerance: float) -> list[str]:
+    found = []
+    for name, result in relative(results).items():
+        expected = baseline.get(name)
+        if not expected:
+            continue
+        allowed = tolerance if name.startswith("GET ") else write_tolerance
+        if result["p95"] > expected["p95"] * (1 + allowed):
+            found.append(f"{name}: p95 {result['p95']}x the {REFERENCE_ROUTE} median, baseline {expected['p95']}x")
+        if result["rps"] < expected["rps"] / (1 + allowed):
+            found.append(f"{name}: req/s {result['rps']}x {REFERENCE_ROUTE}, baseline {expected['rps']}x")
+    return found
+
+
+async def main(args) -> int:
+    rng = random.Random(args.seed)
+    volumes = Volumes(args.customers, args.employees, args.jobs, args.invoices, args.expenses)
+    if args.url:
+        client = httpx.AsyncClient(base_url=args.url, timeout=60)
+    else:
+        if await seed(volumes, rng):
+            print(f"seeded {os.environ['DATABASE_URL']} with {volumes}")
+        client = httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://load-test", timeout=60)
+
+    results = {}
+    async with client:
+        for scenario in scenarios(volumes):
+            # REFERENCE_ROUTE always runs, the others are measured against it
+            wanted = not args.route or any(part in scenario.name for part in args.route)
+            if not wanted and scenario.name != REFERENCE_ROUTE:
+                continue
+            await run_scenario(client, scenario, min(args.concurrency, args.requests), args.concurrency, rng)  # warm up
+            results[scenario.name] = await run_scenario(client, scenario, args.requests, args.concurrency, rng)
+    await async_engine.dispose()
+
+    print(f"{'route':26} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9} {'req/s':>9}  errors")
+    for name, result in results.items():
+        print(f"{name:26} {result['p50']:9.2f} {result['p95']:9.2f} {result['p99']:9.2f} "
+              f"{result['rps']:9.1f}  {len(result['failures'])}")
+    failed = [f"{name}: {failure}" for name, result in results.items() for failure in result["failures"][:3]]
+
+    if args.save_baseline:
+        args.baseline.write_text(json.dumps(relative(results), indent=2) + "\n")
+        print(f"baseline saved to {args.baseline}")
+    elif args.baseline.exists():
+        failed += regressions(results, json.loads(args.baseline.read_text()), args.tolerance, args.write_tolerance)
+    for failure in failed:
+        print(f"FAIL {failure}")
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--url", help="load test a running server instead of the app in process")
+    parser.add_argument("--concurrency", type=int, default=10)
+    parser.add_argument("--requests", type=int, default=200, help="requests per route")
+    parser.add_argument("--route", action="append", help="only run routes whose name contains this, repeatable")
+    parser.add_argument("--customers", type=int, default=5000)
+    parser.add_argument("--employees", type=int, default=25)
+    parser.add_argument("--jobs", type=int, default=20000)
+    parser.add_argument("--invoices", type=int, default=10000)
+    parser.add_argument("--expenses", type=int, default=5000)
+    parser.add_argument("--seed", type=int, default=7)
+    parser.add_argument("--baseline", type=Path, default=BASELINE)
+    parser.add_argument("--save-baseline", action="store_true")
+    parser.add_argument("--tolerance", type=float, default=0.5, help="allowed slowdown before failing, 0.5 = 50%%")
+    parser.add_argument("--write-tolerance", type=float, default=1.5, help="allowed slowdown for POST/PUT routes")
+    sys.exit(asyncio.run(main(parser.parse_args())))
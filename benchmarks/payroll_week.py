@@ -0,0 +1,86 @@
+# Times GET /payroll's aggregate (payroll.weekly_payroll) and the weeklyHours refresh that
+# follows every job write, against a season of closed jobs for every employee.
+# Run from the repository root:
+#   python -m benchmarks.payroll_week --employees 25 --weeks 30 --repeat 20
+import argparse
+import asyncio
+import os
+import time
+from datetime import date, datetime, timedelta
+
+os.environ.setdefault("DATABASE_URL", "sqlite://")
+
+from sqlalchemy.ext.asyncio import create_async_engine
+from sqlalchemy.pool import StaticPool
+from sqlmodel import SQLModel
+from sqlmodel.ext.asyncio.session import AsyncSession
+
+from payroll import refresh_weekly_hours, weekly_payroll
+from schema import Employee, Job
+
+
+SEASON_START = date(2025, 3, 3)
+
+
+# Five jobs a day, six days a week, for each employee
+async def seed(engine, employees: int, weeks: int) -> int:
+    async with engine.begin() as conn:
+        await conn.run_sync(SQLModel.metadata.create_all)
+    jobs = []
+    for day in range(weeks * 7):
+        if day % 7 == 6:
+            continue
+        for employee in range(1, employees + 1):
+            for visit in range(5):
+                clock_in = datetime.combine(SEASON_START + timedelta(days=day), datetime.min.time()) + timedelta(hours=7 + visit * 2)
+                jobs.append({"arrivalWindow": "", "clockIn": clock_in, "clockOut": clock_in + timedelta(minutes=95),
+                             "employeeId": employee, "payment": False, "isActive": False, "comments": ""})
+    async with AsyncSession(engine) as db:
+        await db.exec(Employee.__table__.insert(), params=[
+            {"empId": n, "fName": "Crew", "lName": str(n), "birthDate": "", "phoneNumber": "", "email": "",
+             "address": "", "laborRate": 18.0 + n % 5, "weeklyHours": 0}
+            for n in range(1, employees + 1)
+        ])
+        await db.exec(Job.__table__.insert(), params=jobs)
+        await db.commit()
+    return len(jobs)
+
+
+async def timed(engine, run, repeat: int) -> list[float]:
+    timings = []
+    for _ in range(repeat):
+        async with AsyncSession(engine) as db:
+            began = time.perf_counter()
+            await run(db)
+            timings.append(time.perf_counter() - began)
+    return timings
+
+
+async def main(employees: int, weeks: int, repeat: int):
+    engine = create_async_engine("sqlite+aiosqlite://", poolclass=StaticPool)
+    jobs = await seed(engine, employees, weeks)
+    week = SEASON_START + timedelta(weeks=weeks // 2)
+
+    async def one_employee(db):
+        await refresh_weekly_hours(db, {1}, today=week)
+        await db.commit()
+
+    async def every_employee(db):
+        await refresh_weekly_hours(db, today=week)
+        await db.commit()
+
+    print(f"{jobs} jobs, {employees} employees, {weeks} weeks")
+    for name, run in (("payroll week", lambda db: weekly_payroll(db, week)),
+                      ("weeklyHours 1", one_employee), ("weeklyHours all", every_employee)):
+        timings = await timed(engine, run, repeat)
+        print(f"{name:16} best {min(timings) * 1000:8.2f} ms   mean {sum(timings) / len(timings) * 1000:8.2f} ms")
+    await engine.dispose()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--employees", type=int, default=25)
+    parser.add_argument("--weeks", type=int, default=30)
+    parser.add_argument("--repeat", type=int, default=20)
+    args = parser.parse_args()
+    asyncio.run(main(args.employees, args.weeks, args.repeat))
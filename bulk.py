@@ -0,0 +1,160 @@
+import json
+
+from fastapi import HTTPException, Request
+from pydantic import ValidationError
+from sqlalchemy import delete, func, literal, update
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import MANYTOONE
+from sqlmodel import select
+from sqlmodel.ext.asyncio.session import AsyncSession
+
+
+MAX_BULK_ROWS = 5000
+
+DIALECT_INSERTS = {
+    "postgresql": postgresql.insert,
+    "sqlite": sqlite.insert,
+}
+
+
+# Reads a bulk request body: a JSON array, or NDJSON with one object per line
+async def read_bulk_body(request: Request) -> list:
+    body = await request.body()
+    try:
+        if request.headers.get("content-type", "").startswith("application/x-ndjson"):
+            rows = [json.loads(line) for line in body.splitlines() if line.strip()]
+        else:
+            rows = json.loads(body)
+    except json.JSONDecodeError:
+        raise HTTPException(status_code=400, detail="Body must be a JSON array or NDJSON")
+    if not isinstance(rows, list) or not all(isinstance(row, dict) for row in rows):
+        raise HTTPException(status_code=400, detail="Body must be a JSON array of objects")
+    if len(rows) > MAX_BULK_ROWS:
+        raise HTTPException(status_code=413, detail=f"At most {MAX_BULK_ROWS} rows per request")
+    return rows
+
+
+def primary_key(model):
+    return model.__table__.primary_key.columns.values()[0]
+
+
+# INSERT ... ON CONFLICT (pk) DO UPDATE for every non key column.
+# A version column counts writes, so an update bumps it rather than taking the sent value.
+def upsert_statement(db: AsyncSession, model):
+    insert = DIALECT_INSERTS[db.bind.dialect.name]
+    table = model.__table__
+    statement = insert(table)
+    key = primary_key(model)
+    values = {column.name: statement.excluded[column.name] for column in table.columns if not column.primary_key}
+    if "version" in table.columns:
+        values["version"] = table.c.version + 1
+    return statement.on_conflict_do_update(index_elements=[key.name], set_=values)
+
+
+# The `columns` of one row as they are before the statement it's added to writes the row.
+# It's a materialized CTE that the write's WHERE reads, so SQLite evaluates it before changing
+# anything, and it locks the row FOR UPDATE on Postgres so a concurrent write can't slip in.
+def previous_values(model, key_value, columns):
+    return (select(*columns).where(primary_key(model) == key_value).with_for_update()
+            .cte("previous").prefix_with("MATERIALIZED"))
+
+
+def reads_first(cte):
+    return select(func.count()).select_from(cte).scalar_subquery() >= 0
+
+
+# RETURNING columns for the values previous_values() read, as previous_<name>
+def previous_returning(cte) -> list:
+    return [select(column).scalar_subquery().label(f"previous_{column.name}") for column in cte.c]
+
+
+def previous_from(row, columns) -> dict:
+    return {column.name: row[f"previous_{column.name}"] for column in columns}
+
+
+# Creates or replaces one row in a single INSERT ... ON CONFLICT DO UPDATE, so two requests
+# for the same new key can't both try to create it. Returns whether the row was created (new
+# rows start at version 1 and every update bumps the version) and the `previous` columns as they
+# were before the write, all None for a new row.
+async def upsert_row(db: AsyncSession, model, values: dict, previous=()) -> tuple[bool, dict]:
+    table = model.__table__
+    values = {name: value for name, value in values.items() if name != "version"}
+    statement = upsert_statement(db, model)
+    returning = [table.c.version]
+    if previous:
+        before = previous_values(model, values[primary_key(model).name], previous)
+        source = select(*(literal(value, type_=table.c[name].type).label(name) for name, value in values.items()))
+        statement = statement.from_select(list(values), source.where(reads_first(before)))
+        returning += previous_returning(before)
+    else:
+        statement = statement.values(**values)
+    row = (await db.exec(statement.returning(*returning))).mappings().one()
+    return row["version"] == 1, previous_from(row, previous)
+
+
+# Deletes the rows matching `conditions` with DELETE ... RETURNING their keys and any `returning`
+# columns, so an empty result means nothing matched. Beforehand it does what the ORM did on delete
+# for each relationship: link table rows go, and child rows' foreign keys are set to NULL.
+async def delete_rows(db: AsyncSession, model, *conditions, returning=()) -> list:
+    key = primary_key(model)
+    for relationship in model.__mapper__.relationships:
+        if relationship.direction is MANYTOONE:
+            continue
+        parent_column, child_column = relationship.synchronize_pairs[0]
+        matching = child_column.in_(select(parent_column).where(*conditions))
+        if relationship.secondary is not None:
+            await db.exec(delete(relationship.secondary).where(matching))
+        else:
+            await db.exec(update(child_column.table).where(matching).values({child_column.name: None}))
+    try:
+        return (await db.exec(delete(model.__table__).where(*conditions).returning(key, *returning))).all()
+    except IntegrityError as error:
+        await db.rollback()
+        raise HTTPException(status_code=409, detail=f"Delete rejected, still referenced: {error.orig}")
+
+
+# Validates every row, then writes them all in one transaction.
+# Rows carrying a primary key are upserted, the rest are inserted and get a new key.
+# Either every row is written or none are: invalid rows come back as a 422 listing each row's errors.
+async def bulk_upsert(db: AsyncSession, model, rows: list[dict], check=None) -> list[dict]:
+    key = primary_key(model)
+    valid, errors = [], []
+    for index, row in enumerate(rows):
+        try:
+            item = model.model_validate(row)
+            if check:
+                check(item)
+        except ValidationError as error:
+            errors.append({"index": index, "status": "error", "detail": error.errors(include_url=False, include_context=False)})
+            continue
+        except ValueError as error:
+            errors.append({"index": index, "status": "error", "detail": str(error)})
+            continue
+        valid.append((index, item.model_dump()))
+    if errors:
+        raise HTTPException(status_code=422, detail=errors)
+
+    upserts = [(index, values) for index, values in valid if values[key.name] is not None]
+    inserts = [(index, {name: value for name, value in values.items() if name != key.name})
+               for index, values in valid if values[key.name] is None]
+
+    results = []
+    try:
+        for status, batch, statement in (
+            ("upserted", upserts, upsert_statement(db, model)),
+            ("created", inserts, model.__table__.insert()),
+        ):
+            if not batch:
+                continue
+            # Sent as one executemany, with RETURNING rows kept in the same order as the input
+            keys = (await db.exec(
+                statement.returning(key, sort_by_parameter_order=True),
+                params=[values for _, values in batch],
+            )).scalars().all()
+            results += [{"index": index, "status": status, key.name: value} for (index, _), value in zip(batch, keys)]
+        await db.commit()
+    except IntegrityError as error:
+        await db.rollback()
+        raise HTTPException(status_code=409, detail=f"Bulk write rejected: {error.orig}")
+    return sorted(results, key=lambda result: result["index"])
@@ -0,0 +1,101 @@
+import hashlib
+import time
+
+from decouple import config
+
+try:
+    import redis.asyncio as redis
+except ImportError:  # only needed when REDIS_URL is set
+    redis = None
+
+
+REFERENCE_CACHE_TTL = config("REFERENCE_CACHE_TTL", default=3600, cast=float)
+REDIS_URL = config("REDIS_URL", default="")
+
+
+# In-process cache whose entries expire `ttl` seconds after they are stored.
+# Hits and misses are counted so the hit rate can be checked at /debug/cache.
+class TTLCache:
+    def __init__(self, ttl: float, maxsize: int = 256):
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._entries: dict = {}
+
+    def get(self, key, default=None):
+        entry = self._entries.get(key)
+        if entry is not None and entry[0] > time.monotonic():
+            self.hits += 1
+            return entry[1]
+        self._entries.pop(key, None)
+        self.misses += 1
+        return default
+
+    def set(self, key, value):
+        if len(self._entries) >= self.maxsize and key not in self._entries:
+            self._entries.pop(next(iter(self._entries)))
+        self._entries[key] = (time.monotonic() + self.ttl, value)
+
+    def delete(self, key):
+        self._entries.pop(key, None)
+
+    def clear(self):
+        self._entries.clear()
+
+    def stats(self) -> dict:
+        return {"size": len(self._entries), "hits": self.hits, "misses": self.misses}
+
+
+def etag_for(body: bytes) -> str:
+    return '"' + hashlib.sha1(body).hexdigest() + '"'
+
+
+# Holds the serialized JSON of small, rarely changing tables along with its ETag.
+# Entries live in process by default. With REDIS_URL set they live in Redis instead,
+# so an invalidation by one uvicorn worker is seen by all of them.
+class ReferenceCache:
+    def __init__(self, ttl: float, redis_url: str = "", prefix: str = "qoty:reference:"):
+        if redis_url and redis is None:
+            raise RuntimeError("REDIS_URL is set but the redis package is not installed")
+        self.ttl = ttl
+        self.prefix = prefix
+        self.local = TTLCache(ttl)
+        self.redis = redis.from_url(redis_url) if redis_url else None
+
+    # Returns (etag, body) or None on a miss
+    async def get(self, key: str) -> tuple[str, bytes] | None:
+        if self.redis is None:
+            return self.local.get(key)
+        body = await self.redis.get(self.prefix + key)
+        if body is None:
+            self.local.misses += 1
+            return None
+        self.local.hits += 1
+        return etag_for(body), body
+
+    async def set(self, key: str, body: bytes) -> tuple[str, bytes]:
+        entry = (etag_for(body), body)
+        if self.redis is None:
+            self.local.set(key, entry)
+        else:
+            await self.redis.set(self.prefix + key, body, ex=int(self.ttl))
+        return entry
+
+    async def invalidate(self, key: str):
+        if self.redis is None:
+            self.local.delete(key)
+        else:
+            await self.redis.delete(self.prefix + key)
+
+    async def close(self):
+        if self.redis is not None:
+            await self.redis.aclose()
+
+    def stats(self) -> dict:
+        stats = self.local.stats()
+        stats["backend"] = "redis" if self.redis is not None else "memory"
+        return stats
+
+
+reference_cache = ReferenceCache(ttl=REFERENCE_CACHE_TTL, redis_url=REDIS_URL)
@@ -0,0 +1,6 @@
+import os
+
+
+# database.py reads DATABASE_URL on import. Tests that touch the database swap in their own
+# in-memory SQLite engine (see sqlite_db in test_main.py), so this only has to be a valid URL.
+os.environ.setdefault("DATABASE_URL", "sqlite://")
@@ -1,9 +1,163 @@
+import time
+
 from decouple import config
-from sqlmodel import Session, create_engine
+from sqlalchemy import event, func
+from sqlalchemy.engine import make_url
+from sqlalchemy.ext.asyncio import create_async_engine
+from sqlmodel import Session, create_engine, select
+from sqlmodel.ext.asyncio.session import AsyncSession
+
+from metrics import record_query
+from query_log import query_diagnostics
+
+
+# Async drivers used for the API when ASYNC_DATABASE_URL isn't set explicitly
+ASYNC_DRIVERS = {
+    "postgresql": "postgresql+asyncpg",
+    "sqlite": "sqlite+aiosqlite",
+}
+
+
+def async_url(url: str) -> str:
+    url = make_url(url)
+    return url.set(drivername=ASYNC_DRIVERS[url.get_backend_name()]).render_as_string(hide_password=False)
+
 
 DATABASE_URL = config("DATABASE_URL")
-engine = create_engine(DATABASE_URL)
+ASYNC_DATABASE_URL = config("ASYNC_DATABASE_URL", default="") or async_url(DATABASE_URL)
+
+# Pool sizing per worker process. Keep workers * (DB_POOL_SIZE + DB_MAX_OVERFLOW)
+# below the max_connections setting on the Postgres server.
+DB_POOL_SIZE = config("DB_POOL_SIZE", default=5, cast=int)
+DB_MAX_OVERFLOW = config("DB_MAX_OVERFLOW", default=10, cast=int)
+DB_POOL_TIMEOUT = config("DB_POOL_TIMEOUT", default=30, cast=float)
+DB_POOL_RECYCLE = config("DB_POOL_RECYCLE", default=1800, cast=int)
+DB_POOL_PRE_PING = config("DB_POOL_PRE_PING", default=True, cast=bool)
+
+
+# SQLite uses single-connection pools that don't take sizing options
+def pool_options(url: str) -> dict:
+    if make_url(url).get_backend_name() == "sqlite":
+        return {}
+    return {
+        "pool_size": DB_POOL_SIZE,
+        "max_overflow": DB_MAX_OVERFLOW,
+        "pool_timeout": DB_POOL_TIMEOUT,
+        "pool_recycle": DB_POOL_RECYCLE,
+        "pool_pre_ping": DB_POOL_PRE_PING,
+    }
+
+
+# The sync engine is kept for Alembic and scripts, the API routes use async_engine
+engine = create_engine(DATABASE_URL, **pool_options(DATABASE_URL))
+async_engine = create_async_engine(ASYNC_DATABASE_URL, **pool_options(ASYNC_DATABASE_URL))
+
+
+# Counts pool activity and how long checkouts wait to get a connection.
+# The pool has no event for the start of a checkout, so its connect() is wrapped to time
+# each one as it happens. Sessions check out lazily, on their first statement.
+class PoolStats:
+    def __init__(self, pool):
+        self.pool = pool
+        self.connects = 0
+        self.checkouts = 0
+        self.invalidations = 0
+        self.wait_count = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+        self._connect = pool.connect
+        pool.connect = self._timed_connect
+        event.listen(pool, "connect", self._on_connect)
+        event.listen(pool, "checkout", self._on_checkout)
+        event.listen(pool, "invalidate", self._on_invalidate)
+
+    def _timed_connect(self):
+        start = time.perf_counter()
+        try:
+            return self._connect()
+        finally:
+            self.record_wait(time.perf_counter() - start)
+
+    def _on_connect(self, dbapi_connection, connection_record):
+        self.connects += 1
+
+    def _on_checkout(self, dbapi_connection, connection_record, connection_proxy):
+        self.checkouts += 1
+
+    def _on_invalidate(self, dbapi_connection, connection_record, exception):
+        self.invalidations += 1
+
+    def record_wait(self, seconds: float):
+        self.wait_count += 1
+        self.wait_total += seconds
+        self.wait_max = max(self.wait_max, seconds)
+
+    def snapshot(self) -> dict:
+        stats = {
+            "pool": type(self.pool).__name__,
+            "connects": self.connects,
+            "checkouts": self.checkouts,
+            "invalidations": self.invalidations,
+            "waitCount": self.wait_count,
+            "waitAvgMs": self.wait_total / self.wait_count * 1000 if self.wait_count else 0.0,
+            "waitMaxMs": self.wait_max * 1000,
+        }
+        # Only queue pools know their size, overflow and idle counts
+        if hasattr(self.pool, "checkedout"):
+            stats.update({
+                "size": self.pool.size(),
+                "checkedOut": self.pool.checkedout(),
+                "idle": self.pool.checkedin(),
+                "overflow": max(self.pool.overflow(), 0),
+                "maxOverflow": DB_MAX_OVERFLOW,
+            })
+        return stats
+
+
+pool_stats = PoolStats(async_engine.sync_engine.pool)
+
+
+# Times every statement, adding it to the SQL time of the request being served (see metrics.py)
+# and passing it to the slow-query log when query diagnostics are on (see query_log.py)
+def start_query_timer(conn, cursor, statement, parameters, context, executemany):
+    context._query_start = time.perf_counter()
+
+
+def stop_query_timer(conn, cursor, statement, parameters, context, executemany):
+    seconds = time.perf_counter() - context._query_start
+    record_query(seconds, statement)
+    if query_diagnostics.enabled:
+        query_diagnostics.check_statement(conn, statement, parameters, context, executemany, seconds)
+
+
+def time_queries(engine):
+    event.listen(engine.sync_engine, "before_cursor_execute", start_query_timer)
+    event.listen(engine.sync_engine, "after_cursor_execute", stop_query_timer)
+
+
+time_queries(async_engine)
+
+
+# Keys for pg_try_advisory_xact_lock, one per background job that only one process should run at a time
+ADVISORY_LOCKS = {"geocode": 730101, "reports": 730102, "schedule": 730103}
+
+
+# Takes a transaction-level advisory lock on Postgres, released on commit or rollback.
+# Returns False when another session holds it. SQLite allows one writer at a time anyway.
+async def try_advisory_lock(db: AsyncSession, name: str) -> bool:
+    if db.bind.dialect.name != "postgresql":
+        return True
+    return (await db.exec(select(func.pg_try_advisory_xact_lock(ADVISORY_LOCKS[name])))).first()
+
 
 def get_db():
     with Session(engine) as session:
-        yield session
\ No newline at end of file
+        yield session
+
+
+# expire_on_commit=False so rows can still be read after commit without another round trip.
+# The session only takes a connection from the pool when it runs its first statement,
+# so requests served from a cache never check one out.
+async def get_async_db():
+    async with AsyncSession(async_engine, expire_on_commit=False) as session:
+        yield session
@@ -0,0 +1,170 @@
+import math
+import re
+import time
+from collections import defaultdict
+
+from decouple import config
+
+
+DISPATCH_SPEED_KMH = config("DISPATCH_SPEED_KMH", default=40, cast=float)
+DISPATCH_SERVICE_MINUTES = config("DISPATCH_SERVICE_MINUTES", default=30, cast=float)
+DISPATCH_DAY_START = config("DISPATCH_DAY_START", default="08:00")
+# Seconds the 2-opt pass may spend improving all of a day's routes
+DISPATCH_TIME_LIMIT = config("DISPATCH_TIME_LIMIT", default=0.5, cast=float)
+# Where crews leave from in the morning. Without it each route starts at its first stop.
+DEPOT_LAT = config("DEPOT_LAT", default=None, cast=lambda value: float(value) if value else None)
+DEPOT_LNG = config("DEPOT_LNG", default=None, cast=lambda value: float(value) if value else None)
+
+# Minutes of slack left in a window count this much against picking that stop next,
+# so a stop whose window closes soon beats a slightly nearer one that can wait
+WINDOW_SLACK_WEIGHT = 0.05
+
+WINDOW_PATTERN = re.compile(r"(\d{1,2}):(\d{2})\s*-\s*(\d{1,2}):(\d{2})")
+EARTH_RADIUS_KM = 6371.0
+
+
+def parse_clock(value: str) -> int:
+    hours, minutes = value.split(":")
+    return int(hours) * 60 + int(minutes)
+
+
+def format_clock(minutes: float) -> str:
+    minutes = round(minutes)
+    return f"{minutes // 60:02d}:{minutes % 60:02d}"
+
+
+# "08:00-10:00" as minutes after midnight. Windows that can't be read allow the whole day.
+def parse_window(window: str) -> tuple[int, int]:
+    match = WINDOW_PATTERN.search(window or "")
+    if not match:
+        return 0, 24 * 60
+    start_hour, start_minute, end_hour, end_minute = map(int, match.groups())
+    return start_hour * 60 + start_minute, end_hour * 60 + end_minute
+
+
+def haversine_km(a: tuple[float, float], b: tuple[float, float]) -> float:
+    lat1, lng1, lat2, lng2 = map(math.radians, (*a, *b))
+    h = math.sin((lat2 - lat1) / 2) ** 2 + math.cos(lat1) * math.cos(lat2) * math.sin((lng2 - lng1) / 2) ** 2
+    return 2 * EARTH_RADIUS_KM * math.asin(math.sqrt(h))
+
+
+# Driving minutes between every pair of points. Index 0 is the depot; without one
+# it's a point zero minutes from everywhere, so the route may start at any stop.
+def travel_minutes(points: list[tuple[float, float]], depot: tuple[float, float] | None, speed_kmh: float) -> list[list[float]]:
+    per_km = 60 / speed_kmh
+    places = [depot] + points
+    size = len(places)
+    travel = [[0.0] * size for _ in range(size)]
+    for i in range(size):
+        for j in range(i + 1, size):
+            if places[i] is None:
+                continue
+            travel[i][j] = travel[j][i] = haversine_km(places[i], places[j]) * per_km
+    return travel
+
+
+# Walks a route from the depot, waiting for windows that haven't opened yet.
+# Returns the minutes spent past closed windows, minutes driven and when each visit starts.
+def evaluate(route: list[int], travel, windows, start: float, service: float) -> tuple[float, float, list[float]]:
+    clock, previous, late, driven, starts = start, 0, 0.0, 0.0, []
+    for stop in route:
+        clock += travel[previous][stop]
+        driven += travel[previous][stop]
+        opens, closes = windows[stop]
+        clock = max(clock, opens)
+        late += max(0.0, clock - closes)
+        starts.append(clock)
+        clock += service
+        previous = stop
+    return late, driven, starts
+
+
+# Builds a route by always going to the stop that can be started soonest without missing
+# its window, nudged towards stops whose window is about to close.
+# Once every remaining window would be missed, the one that closes first goes next.
+def nearest_neighbour(travel, windows, start: float, service: float) -> list[int]:
+    unvisited = set(range(1, len(travel)))
+    route, clock, previous = [], start, 0
+    while unvisited:
+        def urgency(stop):
+            begins = max(clock + travel[previous][stop], windows[stop][0])
+            if begins > windows[stop][1]:
+                return 1, windows[stop][1], stop
+            return 0, begins + WINDOW_SLACK_WEIGHT * (windows[stop][1] - begins), stop
+
+        stop = min(unvisited, key=urgency)
+        clock = max(clock + travel[previous][stop], windows[stop][0]) + service
+        route.append(stop)
+        unvisited.remove(stop)
+        previous = stop
+    return route
+
+
+# Reverses segments of the route while that shortens the drive without making any visit later
+# than its window allows. Stops improving at `deadline` (a time.perf_counter() value).
+def two_opt(route: list[int], travel, windows, start: float, service: float, deadline: float) -> list[int]:
+    late, _, _ = evaluate(route, travel, windows, start, service)
+    improved = True
+    while improved and time.perf_counter() < deadline:
+        improved = False
+        for i in range(len(route) - 1):
+            before = route[i - 1] if i else 0
+            for j in range(i + 1, len(route)):
+                after = route[j + 1] if j + 1 < len(route) else None
+                delta = travel[before][route[j]] - travel[before][route[i]]
+                if after is not None:
+                    delta += travel[route[i]][after] - travel[route[j]][after]
+                if delta > -1e-9:
+                    continue
+                candidate = route[:i] + route[i:j + 1][::-1] + route[j + 1:]
+                candidate_late, _, _ = evaluate(candidate, travel, windows, start, service)
+                if candidate_late <= late:
+                    route, late, improved = candidate, candidate_late, True
+            if time.perf_counter() >= deadline:
+                break
+    return route
+
+
+# Orders one crew's stops. `stops` are dicts with "point" (lat, lng) and "window" (opens, closes).
+def plan_route(stops: list[dict], depot: tuple[float, float] | None, start: float, service: float,
+               speed_kmh: float, deadline: float) -> dict:
+    travel = travel_minutes([stop["point"] for stop in stops], depot, speed_kmh)
+    windows = [(0, 24 * 60)] + [stop["window"] for stop in stops]
+    route = nearest_neighbour(travel, windows, start, service)
+    route = two_opt(route, travel, windows, start, service, deadline)
+    late, driven, starts = evaluate(route, travel, windows, start, service)
+    visits = []
+    for stop, begins in zip(route, starts):
+        visit = dict(stops[stop - 1])
+        visit["eta"] = format_clock(begins)
+        visit["late"] = begins > windows[stop][1]
+        visits.append(visit)
+    return {"stops": visits, "driveMinutes": round(driven, 1), "lateMinutes": round(late, 1)}
+
+
+# Plans every crew's day. `jobs` are dicts with jobId, employeeId, customerId, address and arrivalWindow;
+# `coordinates` maps each address to (lat, lng) or None. Jobs whose address couldn't be placed are left out
+# and listed under "unlocated" so they can be scheduled by hand.
+def plan_dispatch(jobs: list[dict], coordinates: dict, depot: tuple[float, float] | None = None,
+                  day_start: str = DISPATCH_DAY_START, service: float = DISPATCH_SERVICE_MINUTES,
+                  speed_kmh: float = DISPATCH_SPEED_KMH, time_limit: float = DISPATCH_TIME_LIMIT) -> dict:
+    crews, unlocated = defaultdict(list), []
+    for job in jobs:
+        point = coordinates.get(job["address"])
+        if point is None:
+            unlocated.append(job["jobId"])
+            continue
+        crews[job["employeeId"]].append({**job, "point": point, "window": parse_window(job["arrivalWindow"])})
+
+    finish = time.perf_counter() + time_limit
+    routes = []
+    crews = sorted(crews.items(), key=lambda crew: (crew[0] is None, crew[0] or 0))
+    for n, (employee_id, stops) in enumerate(crews):
+        # Each crew gets an even share of whatever time is left
+        now = time.perf_counter()
+        deadline = now + max(0.0, finish - now) / (len(crews) - n)
+        route = plan_route(stops, depot, parse_clock(day_start), service, speed_kmh, deadline)
+        for visit in route["stops"]:
+            del visit["point"], visit["window"]
+        routes.append({"employeeId": employee_id, **route})
+    return {"routes": routes, "unlocated": unlocated}
@@ -0,0 +1,52 @@
+from fastapi import HTTPException
+from sqlalchemy.orm import joinedload, selectinload
+
+from schema import Customer, CustomerExpanded, Job, JobExpanded
+
+
+# Loader for each relationship that can be requested with ?expand=.
+# Collections use selectinload (one extra IN query for the whole page),
+# many-to-one relationships are joined into the main query.
+JOB_EXPANSIONS = {
+    "servicesProvided": selectinload(Job.servicesProvided),
+    "extraExpenses": selectinload(Job.extraExpenses),
+    "invoice": joinedload(Job.invoice),
+    "customer": joinedload(Job.customer),
+}
+
+CUSTOMER_EXPANSIONS = {
+    "jobs": selectinload(Customer.jobs),
+    "city": selectinload(Customer.city),
+    "frequency": joinedload(Customer.frequency),
+}
+
+
+# Accepts repeated (?expand=a&expand=b) or comma separated (?expand=a,b) names
+def parse_expand(expand: list[str], expansions: dict) -> list[str]:
+    names = [name.strip() for value in expand for name in value.split(",") if name.strip()]
+    unknown = [name for name in names if name not in expansions]
+    if unknown:
+        raise HTTPException(status_code=400, detail=f"Cannot expand {', '.join(unknown)}. Options: {', '.join(expansions)}")
+    return names
+
+
+def expand_options(names: list[str], expansions: dict) -> list:
+    return [expansions[name] for name in names]
+
+
+# Copies a loaded row into its expanded read model, leaving out relationships that weren't requested
+def expand_row(read_model, row, names: list[str]) -> dict | None:
+    if row is None:
+        return None
+    columns = row.model_dump()
+    expanded = read_model(**columns, **{name: getattr(row, name) for name in names})
+    not_requested = set(read_model.model_fields) - set(columns) - set(names)
+    return expanded.model_dump(mode="json", exclude=not_requested)
+
+
+def expand_job(row, names: list[str]) -> dict | None:
+    return expand_row(JobExpanded, row, names)
+
+
+def expand_customer(row, names: list[str]) -> dict | None:
+    return expand_row(CustomerExpanded, row, names)
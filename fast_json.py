@@ -0,0 +1,48 @@
+from decimal import Decimal
+
+import orjson
+from fastapi import HTTPException
+from sqlmodel import select
+from starlette.responses import JSONResponse
+
+
+# Money columns come out as strings, matching what pydantic writes for Decimal
+def orjson_default(value):
+    if isinstance(value, Decimal):
+        return str(value)
+    raise TypeError(f"Type is not JSON serializable: {type(value).__name__}")
+
+
+def dumps(content) -> bytes:
+    return orjson.dumps(content, default=orjson_default)
+
+
+# JSON response rendered with orjson, used as the app's default response class
+class FastJSONResponse(JSONResponse):
+    def render(self, content) -> bytes:
+        return dumps(content)
+
+
+# Accepts repeated (?fields=a&fields=b) or comma separated (?fields=a,b) column names
+def parse_fields(fields: list[str], model) -> list[str]:
+    names = [name.strip() for value in fields for name in value.split(",") if name.strip()]
+    columns = model.__table__.columns
+    unknown = [name for name in names if name not in columns]
+    if unknown:
+        raise HTTPException(status_code=400, detail=f"Unknown fields {', '.join(unknown)}. Options: {', '.join(columns.keys())}")
+    return names
+
+
+# Selects a table's columns as plain tuples, skipping ORM object construction and the identity map.
+# With `fields` only those columns are read, plus the primary key so pages can still be followed with after=.
+def select_columns(model, fields: list[str] | None = None):
+    columns = model.__table__.columns
+    if fields:
+        columns = [column for column in columns if column.primary_key or column.name in fields]
+    return select(*columns)
+
+
+# Builds one dict per row straight from the column tuples
+def rows_as_dicts(result) -> list[dict]:
+    keys = list(result.keys())
+    return [dict(zip(keys, row)) for row in result.all()]
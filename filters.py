@@ -0,0 +1,51 @@
+from datetime import date, datetime, time, timedelta
+
+from schema import Customer, Expense, Invoice, Job
+
+
+# Columns each list route may sort by
+CUSTOMER_SORTS = {
+    "customerId": Customer.customerId,
+    "lName": Customer.lName,
+    "frequencyId": Customer.frequencyId,
+}
+
+INVOICE_SORTS = {
+    "invoiceId": Invoice.invoiceId,
+    "invoiceDate": Invoice.invoiceDate,
+    "dueDate": Invoice.dueDate,
+    "totalEstimate": Invoice.totalEstimate,
+}
+
+EXPENSE_SORTS = {
+    "expenseId": Expense.expenseId,
+    "expenseDate": Expense.expenseDate,
+    "totalAmount": Expense.totalAmount,
+}
+
+JOB_SORTS = {
+    "jobId": Job.jobId,
+    "clockIn": Job.clockIn,
+    "employeeId": Job.employeeId,
+    "customerId": Job.customerId,
+}
+
+
+# Adds `column == value` for every filter the caller passed, skipping the ones left as None
+def where_equal(query, *filters):
+    for column, value in filters:
+        if value is not None:
+            query = query.where(column == value)
+    return query
+
+
+# Adds an inclusive date range. Timestamp columns cover the whole of the `end` day.
+def where_between(query, column, start: date | None, end: date | None, timestamps: bool = False):
+    if start is not None:
+        query = query.where(column >= (datetime.combine(start, time.min) if timestamps else start))
+    if end is not None:
+        if timestamps:
+            query = query.where(column < datetime.combine(end + timedelta(days=1), time.min))
+        else:
+            query = query.where(column <= end)
+    return query
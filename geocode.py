@@ -0,0 +1,180 @@
+import asyncio
+import logging
+import time
+from datetime import timedelta
+from typing import NamedTuple
+
+import httpx
+from decouple import config
+from sqlmodel import or_, select
+from sqlmodel.ext.asyncio.session import AsyncSession
+
+from bulk import DIALECT_INSERTS
+from database import async_engine, try_advisory_lock
+from schema import Customer, GeocodeCache, utcnow
+
+
+logger = logging.getLogger(__name__)
+
+GEOCODER_URL = config("GEOCODER_URL", default="https://nominatim.openstreetmap.org/search")
+GEOCODER_USER_AGENT = config("GEOCODER_USER_AGENT", default="queen-of-the-yard-dispatch")
+GEOCODER_TIMEOUT = config("GEOCODER_TIMEOUT", default=10, cast=float)
+# Seconds between lookups. Nominatim's usage policy allows one request per second.
+GEOCODER_DELAY = config("GEOCODER_DELAY", default=1.0, cast=float)
+# Off by default: the worker sends customer addresses to GEOCODER_URL, a third-party service,
+# so a deployment has to turn it on (in one process) explicitly.
+GEOCODER_WORKER = config("GEOCODER_WORKER", default=False, cast=bool)
+GEOCODER_BATCH_SIZE = config("GEOCODER_BATCH_SIZE", default=20, cast=int)
+GEOCODER_POLL_INTERVAL = config("GEOCODER_POLL_INTERVAL", default=60, cast=float)
+# Seconds before an address whose lookup errored is tried again, doubling with each failure up to the max
+GEOCODER_RETRY_DELAY = config("GEOCODER_RETRY_DELAY", default=3600, cast=float)
+GEOCODER_MAX_RETRY_DELAY = config("GEOCODER_MAX_RETRY_DELAY", default=7 * 24 * 3600, cast=float)
+# Seconds every lookup pauses after a 429 that doesn't say how long to wait with Retry-After
+GEOCODER_RATE_LIMIT_PAUSE = config("GEOCODER_RATE_LIMIT_PAUSE", default=600, cast=float)
+
+
+# Addresses placed (or found not to exist) and the ones whose lookup errored
+class GeocodeBatch(NamedTuple):
+    found: dict[str, tuple[float, float] | None]
+    failed: list[str]
+
+
+# Looks addresses up with a Nominatim compatible search API, at most one every `delay` seconds.
+# A 429 stops the batch and pauses all lookups until `resume_at` (a time.monotonic() value).
+class Geocoder:
+    def __init__(self, url: str = GEOCODER_URL, delay: float = GEOCODER_DELAY,
+                 transport: httpx.AsyncBaseTransport | None = None):
+        self.url = url
+        self.delay = delay
+        self.transport = transport
+        self._last_lookup = 0.0
+        self.resume_at = 0.0
+
+    # found maps each address to (lat, lng), or None when the address couldn't be placed.
+    # Addresses left over when a 429 stops the batch are in neither list.
+    async def lookup_many(self, addresses: list[str]) -> GeocodeBatch:
+        batch = GeocodeBatch({}, [])
+        async with httpx.AsyncClient(headers={"User-Agent": GEOCODER_USER_AGENT},
+                                     timeout=GEOCODER_TIMEOUT, transport=self.transport) as http:
+            for address in addresses:
+                if time.monotonic() < self.resume_at:
+                    break
+                wait = self._last_lookup + self.delay - time.monotonic()
+                if wait > 0:
+                    await asyncio.sleep(wait)
+                self._last_lookup = time.monotonic()
+                try:
+                    response = await http.get(self.url, params={"q": address, "format": "json", "limit": 1})
+                    if response.status_code == 429:
+                        self.pause(response.headers.get("Retry-After", ""))
+                        break
+                    response.raise_for_status()
+                    results = response.json()
+                except (httpx.HTTPError, ValueError):
+                    logger.warning("Geocoding failed for %r", address, exc_info=True)
+                    batch.failed.append(address)
+                    continue
+                batch.found[address] = (float(results[0]["lat"]), float(results[0]["lon"])) if results else None
+        return batch
+
+    def pause(self, retry_after: str):
+        seconds = float(retry_after) if retry_after.isdigit() else GEOCODER_RATE_LIMIT_PAUSE
+        logger.warning("Geocoder is rate limited, pausing lookups for %.0f seconds", seconds)
+        self.resume_at = time.monotonic() + seconds
+
+
+geocoder = Geocoder()
+
+
+# Coordinates of the addresses already in the geocodecache table, None for ones that couldn't be placed.
+# Addresses that haven't been looked up yet, or whose lookup errored, are left out.
+async def cached_coordinates(db: AsyncSession, addresses: set[str]) -> dict[str, tuple[float, float] | None]:
+    if not addresses:
+        return {}
+    cached = (await db.exec(
+        select(GeocodeCache).where(GeocodeCache.address.in_(addresses), GeocodeCache.retryAt.is_(None))
+    )).all()
+    return {row.address: (row.lat, row.lng) if row.lat is not None else None for row in cached}
+
+
+def retry_delay(attempts: int) -> timedelta:
+    return timedelta(seconds=min(GEOCODER_RETRY_DELAY * 2 ** (attempts - 1), GEOCODER_MAX_RETRY_DELAY))
+
+
+# Inserts lookups, replacing only rows left by failed attempts. An address another process already
+# stored is kept as it is, so concurrent inserts don't conflict.
+async def store_coordinates(db: AsyncSession, found: dict[str, tuple[float, float] | None]):
+    statement = DIALECT_INSERTS[db.bind.dialect.name](GeocodeCache.__table__)
+    now = utcnow()
+    await db.exec(
+        statement.on_conflict_do_update(
+            index_elements=["address"],
+            set_={"lat": statement.excluded.lat, "lng": statement.excluded.lng,
+                  "geocodedAt": statement.excluded.geocodedAt, "attempts": 0, "retryAt": None},
+            where=GeocodeCache.__table__.c.retryAt.is_not(None),
+        ),
+        params=[{"address": address, "lat": point[0] if point else None, "lng": point[1] if point else None,
+                 "geocodedAt": now} for address, point in found.items()],
+    )
+
+
+# Records failed lookups ({address: attempts so far, including this one}) so the address waits out
+# retry_delay before it's looked up again, instead of heading every batch
+async def store_failures(db: AsyncSession, attempts: dict[str, int]):
+    statement = DIALECT_INSERTS[db.bind.dialect.name](GeocodeCache.__table__)
+    now = utcnow()
+    await db.exec(
+        statement.on_conflict_do_update(
+            index_elements=["address"],
+            set_={"geocodedAt": statement.excluded.geocodedAt, "attempts": statement.excluded.attempts,
+                  "retryAt": statement.excluded.retryAt},
+            where=GeocodeCache.__table__.c.retryAt.is_not(None),
+        ),
+        params=[{"address": address, "lat": None, "lng": None, "geocodedAt": now, "attempts": count,
+                 "retryAt": now + retry_delay(count)} for address, count in attempts.items()],
+    )
+
+
+# Geocodes up to `limit` customer addresses that aren't in the cache yet, then ones whose retry is due,
+# and stores them. Only one process runs a batch at a time, the others skip it. Lookups that errored
+# are recorded with a retry time so they don't hold up the rest. Returns how many addresses were stored.
+async def geocode_pending(db: AsyncSession, geocoder: Geocoder, limit: int = GEOCODER_BATCH_SIZE) -> int:
+    if not await try_advisory_lock(db, "geocode"):
+        return 0
+    pending = (await db.exec(
+        select(Customer.physicalAddress, GeocodeCache.attempts, GeocodeCache.retryAt).distinct()
+        .outerjoin(GeocodeCache, GeocodeCache.address == Customer.physicalAddress)
+        .where(or_(GeocodeCache.address.is_(None), GeocodeCache.retryAt <= utcnow()), Customer.physicalAddress != "")
+        .order_by(GeocodeCache.retryAt.nulls_first(), Customer.physicalAddress)
+        .limit(limit)
+    )).all()
+    if not pending:
+        return 0
+    batch = await geocoder.lookup_many([row.physicalAddress for row in pending])
+    if batch.found:
+        await store_coordinates(db, batch.found)
+    if batch.failed:
+        attempts = {row.physicalAddress: row.attempts or 0 for row in pending}
+        await store_failures(db, {address: attempts[address] + 1 for address in batch.failed})
+    await db.commit()
+    return len(batch.found)
+
+
+# Keeps geocoding new customer addresses until `stop` is set, so /dispatch only reads the cache
+async def run_geocode_worker(stop: asyncio.Event, geocoder: Geocoder = geocoder):
+    while not stop.is_set():
+        try:
+            async with AsyncSession(async_engine) as db:
+                stored = await geocode_pending(db, geocoder)
+        except Exception:
+            logger.exception("Geocoding failed")
+            stored = 0
+        # A full batch stored means more may be waiting, so the next one starts straight away
+        # unless the geocoder is rate limited
+        wait = 0 if stored >= GEOCODER_BATCH_SIZE else GEOCODER_POLL_INTERVAL
+        wait = max(wait, geocoder.resume_at - time.monotonic())
+        if wait > 0:
+            try:
+                await asyncio.wait_for(stop.wait(), timeout=wait)
+            except asyncio.TimeoutError:
+                pass
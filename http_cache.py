@@ -0,0 +1,140 @@
+import gzip
+import hashlib
+import zlib
+
+from decouple import config
+from starlette.datastructures import Headers, MutableHeaders
+
+try:
+    import brotli
+except ImportError:  # gzip is used when brotli isn't installed
+    brotli = None
+
+
+HTTP_COMPRESS_MIN_SIZE = config("HTTP_COMPRESS_MIN_SIZE", default=1000, cast=int)
+HTTP_COMPRESS_LEVEL = config("HTTP_COMPRESS_LEVEL", default=6, cast=int)
+
+
+def weak_etag(body: bytes) -> str:
+    return 'W/"' + hashlib.sha1(body).hexdigest() + '"'
+
+
+# Weak comparison, so W/"abc" and "abc" match as If-None-Match requires
+def etag_matches(if_none_match: str, etag: str) -> bool:
+    if if_none_match.strip() == "*":
+        return True
+    opaque = etag.removeprefix("W/")
+    return any(tag.strip().removeprefix("W/") == opaque for tag in if_none_match.split(","))
+
+
+# Picks brotli or gzip from an Accept-Encoding header, skipping encodings sent with q=0
+def pick_encoding(accept_encoding: str) -> str | None:
+    accepted = set()
+    for part in accept_encoding.split(","):
+        name, _, params = part.partition(";")
+        try:
+            weight = float(params.split("=", 1)[1]) if "=" in params else 1.0
+        except ValueError:
+            weight = 1.0
+        if weight > 0:
+            accepted.add(name.strip().lower())
+    if brotli is not None and "br" in accepted:
+        return "br"
+    if "gzip" in accepted:
+        return "gzip"
+    return None
+
+
+def compress(body: bytes, encoding: str) -> bytes:
+    if encoding == "br":
+        return brotli.compress(body)
+    return gzip.compress(body, compresslevel=HTTP_COMPRESS_LEVEL)
+
+
+# Compresses a streamed body chunk by chunk, flushing each one so NDJSON rows still arrive as they're read
+class StreamCompressor:
+    def __init__(self, encoding: str):
+        self.encoding = encoding
+        if encoding == "br":
+            self._compressor = brotli.Compressor()
+        else:
+            self._compressor = zlib.compressobj(HTTP_COMPRESS_LEVEL, zlib.DEFLATED, zlib.MAX_WBITS | 16)
+
+    def compress(self, chunk: bytes, last: bool) -> bytes:
+        if self.encoding == "br":
+            data = self._compressor.process(chunk)
+            return data + (self._compressor.finish() if last else self._compressor.flush())
+        data = self._compressor.compress(chunk)
+        return data + self._compressor.flush(zlib.Z_FINISH if last else zlib.Z_SYNC_FLUSH)
+
+
+# Conditional GETs and compression for every GET route.
+# A complete response gets a weak ETag from its body (unless the route set its own) and
+# becomes a bodiless 304 when it matches If-None-Match; bodies over HTTP_COMPRESS_MIN_SIZE are compressed.
+# Streamed responses are compressed as they go. Paths under `exclude_paths` pass through untouched.
+class HttpCacheMiddleware:
+    def __init__(self, app, exclude_paths: tuple[str, ...] = (), minimum_size: int = HTTP_COMPRESS_MIN_SIZE):
+        self.app = app
+        self.exclude_paths = exclude_paths
+        self.minimum_size = minimum_size
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope["method"] != "GET" or scope["path"].startswith(self.exclude_paths):
+            await self.app(scope, receive, send)
+            return
+        request_headers = Headers(scope=scope)
+        encoding = pick_encoding(request_headers.get("accept-encoding", ""))
+        if_none_match = request_headers.get("if-none-match")
+        start = None
+        compressor = None
+        streaming = False
+
+        async def send_wrapper(message):
+            nonlocal start, compressor, streaming
+            if message["type"] == "http.response.start":
+                start = message
+                return
+            if message["type"] != "http.response.body":
+                await send(message)
+                return
+            body = message.get("body", b"")
+            more_body = message.get("more_body", False)
+            if not streaming:
+                headers = MutableHeaders(raw=start["headers"])
+                if not more_body:
+                    await self.send_complete(send, start, headers, body, encoding, if_none_match)
+                    return
+                streaming = True
+                if encoding and "content-encoding" not in headers:
+                    compressor = StreamCompressor(encoding)
+                    headers["Content-Encoding"] = encoding
+                    headers.add_vary_header("Accept-Encoding")
+                    del headers["Content-Length"]
+                await send(start)
+            if compressor:
+                body = compressor.compress(body, last=not more_body)
+            await send({"type": "http.response.body", "body": body, "more_body": more_body})
+
+        await self.app(scope, receive, send_wrapper)
+
+    async def send_complete(self, send, start, headers, body, encoding, if_none_match):
+        if start["status"] == 200:
+            if "etag" not in headers:
+                headers["ETag"] = weak_etag(body)
+            if "cache-control" not in headers:
+                headers["Cache-Control"] = "private, no-cache"
+            if if_none_match and etag_matches(if_none_match, headers["etag"]):
+                not_modified = MutableHeaders()
+                for name in ("etag", "cache-control", "vary"):
+                    if name in headers:
+                        not_modified[name] = headers[name]
+                await send({"type": "http.response.start", "status": 304, "headers": not_modified.raw})
+                await send({"type": "http.response.body", "body": b""})
+                return
+        if encoding and len(body) >= self.minimum_size and "content-encoding" not in headers:
+            body = compress(body, encoding)
+            headers["Content-Encoding"] = encoding
+            headers["Content-Length"] = str(len(body))
+            headers.add_vary_header("Accept-Encoding")
+        await send(start)
+        await send({"type": "http.response.body", "body": body})
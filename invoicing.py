@@ -0,0 +1,127 @@
+import argparse
+import asyncio
+from datetime import date, datetime, time, timedelta
+from decimal import ROUND_HALF_UP, Decimal
+
+from decouple import config
+from sqlalchemy import bindparam, func
+from sqlmodel import and_, or_, select
+from sqlmodel.ext.asyncio.session import AsyncSession
+
+from database import async_engine
+from schema import Expense, Invoice, Job, ServiceLink, Services
+
+
+TAX_RATE = config("TAX_RATE", default="0.06", cast=Decimal)
+INVOICE_APPLY_TAX = config("INVOICE_APPLY_TAX", default=True, cast=bool)
+INVOICE_DUE_DAYS = config("INVOICE_DUE_DAYS", default=14, cast=int)
+
+CENTS = Decimal("0.01")
+
+
+def money(value) -> Decimal:
+    return Decimal(str(value or 0)).quantize(CENTS, rounding=ROUND_HALF_UP)
+
+
+# Finished jobs that haven't been billed, worked between `start` and `end`.
+# Jobs without a scheduled serviceDate are placed by the day they were clocked in.
+def uninvoiced_jobs(start: date, end: date) -> list:
+    return [
+        Job.isActive.is_(False),
+        Job.invoiceId.is_(None),
+        Job.customerId.is_not(None),
+        or_(
+            and_(Job.serviceDate >= start, Job.serviceDate <= end),
+            and_(Job.serviceDate.is_(None),
+                 Job.clockIn >= datetime.combine(start, time.min),
+                 Job.clockIn < datetime.combine(end + timedelta(days=1), time.min)),
+        ),
+    ]
+
+
+# Bills every customer for their finished, uninvoiced jobs in the date range, all in one transaction.
+# The candidate jobs are read once, with their service prices and extra expenses, and locked
+# (FOR UPDATE SKIP LOCKED on Postgres) so a concurrent run can't bill them too. Invoice totals
+# are built from exactly those rows, every invoice is written with one executemany
+# INSERT ... RETURNING, and only those jobs are linked with one executemany UPDATE by jobId.
+# A job finished after the read is left for the next run.
+async def generate_invoices(db: AsyncSession, start: date, end: date, invoice_date: date) -> dict:
+    service_totals = (
+        select(ServiceLink.jobId, func.sum(Services.price).label("amount"))
+        .join(Services, Services.serviceId == ServiceLink.serviceId)
+        .group_by(ServiceLink.jobId)
+        .subquery()
+    )
+    expense_totals = (
+        select(Expense.linkedJob, func.sum(Expense.totalAmount).label("amount"))
+        .where(Expense.linkedJob.is_not(None))
+        .group_by(Expense.linkedJob)
+        .subquery()
+    )
+    jobs = (await db.exec(
+        select(Job.jobId, Job.customerId,
+               func.coalesce(service_totals.c.amount, 0).label("services"),
+               func.coalesce(expense_totals.c.amount, 0).label("expenses"))
+        .outerjoin(service_totals, service_totals.c.jobId == Job.jobId)
+        .outerjoin(expense_totals, expense_totals.c.linkedJob == Job.jobId)
+        .where(*uninvoiced_jobs(start, end))
+        .order_by(Job.customerId, Job.jobId)
+        .with_for_update(of=Job, skip_locked=True)
+    )).all()
+    if not jobs:
+        return {"invoices": [], "jobs": 0}
+
+    jobs_by_customer = {}
+    for job in jobs:
+        jobs_by_customer.setdefault(job.customerId, []).append(job)
+
+    due_date = invoice_date + timedelta(days=INVOICE_DUE_DAYS)
+    invoices = []
+    for customer_jobs in jobs_by_customer.values():
+        subtotal = sum((money(job.services) + money(job.expenses) for job in customer_jobs), Decimal("0.00"))
+        tax = money(subtotal * TAX_RATE) if INVOICE_APPLY_TAX else Decimal("0.00")
+        invoices.append({"lotSize": "", "invoiceDate": invoice_date, "dueDate": due_date, "emailStatus": False,
+                         "productsUsed": "", "acceptedBy": "", "applyTax": INVOICE_APPLY_TAX,
+                         "taxAmount": tax, "totalEstimate": subtotal + tax, "paid": False})
+
+    invoice_ids = (await db.exec(
+        Invoice.__table__.insert().returning(Invoice.invoiceId, sort_by_parameter_order=True),
+        params=invoices,
+    )).scalars().all()
+
+    job_table = Job.__table__
+    await db.exec(
+        job_table.update()
+        .where(job_table.c.jobId == bindparam("billedJob"))
+        .values(invoiceId=bindparam("newInvoice")),
+        params=[{"billedJob": job.jobId, "newInvoice": invoice_id}
+                for customer_jobs, invoice_id in zip(jobs_by_customer.values(), invoice_ids)
+                for job in customer_jobs],
+    )
+    await db.commit()
+
+    return {
+        "invoices": [{"invoiceId": invoice_id, "customerId": customer_id, "jobs": len(customer_jobs),
+                      "taxAmount": invoice["taxAmount"], "totalEstimate": invoice["totalEstimate"]}
+                     for (customer_id, customer_jobs), invoice_id, invoice
+                     in zip(jobs_by_customer.items(), invoice_ids, invoices)],
+        "jobs": len(jobs),
+    }
+
+
+# Month-end billing from the command line:
+#   python invoicing.py --start 2025-05-01 --end 2025-05-31
+async def main(start: date, end: date, invoice_date: date):
+    async with AsyncSession(async_engine, expire_on_commit=False) as db:
+        result = await generate_invoices(db, start, end, invoice_date)
+    total = sum(invoice["totalEstimate"] for invoice in result["invoices"])
+    print(f"Created {len(result['invoices'])} invoices covering {result['jobs']} jobs, totalling ${total:,.2f}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Invoice finished jobs for a date range")
+    parser.add_argument("--start", type=date.fromisoformat, required=True)
+    parser.add_argument("--end", type=date.fromisoformat, required=True)
+    parser.add_argument("--invoice-date", type=date.fromisoformat, default=date.today())
+    args = parser.parse_args()
+    asyncio.run(main(args.start, args.end, args.invoice_date))
@@ -1,36 +1,84 @@
+import asyncio
+import logging
 import os
 import re
-from fastapi import Depends, FastAPI, HTTPException
-from sqlmodel import Session, select
+from contextlib import asynccontextmanager
+from datetime import date, timedelta
+
+import httpx
+from fastapi import Depends, FastAPI, HTTPException, Query, Request
+from fastapi.exceptions import RequestValidationError
+from fastapi.responses import PlainTextResponse, Response, StreamingResponse
+from pydantic import ValidationError
+from sqlmodel import select
+from sqlmodel.ext.asyncio.session import AsyncSession
 from square.client import Client
 from square.http.auth.o_auth_2 import BearerAuthCredentials
 
-import smtplib
-from email.mime.multipart import MIMEMultipart
-from email.mime.text import MIMEText
-
 from dotenv import load_dotenv
-import requests
 
-from database import get_db
-from schema import Customer, Invoice, Job, User, Employee, Expense, Services, Frequency, ServiceArea
+from bulk import bulk_upsert, delete_rows, read_bulk_body, upsert_row
+from cache import reference_cache
+from database import get_async_db, pool_stats
+from dispatch import DEPOT_LAT, DEPOT_LNG, plan_dispatch
+from expand import (CUSTOMER_EXPANSIONS, JOB_EXPANSIONS, expand_customer, expand_job, expand_options,
+                    parse_expand)
+from fast_json import FastJSONResponse, dumps, parse_fields, rows_as_dicts, select_columns
+from filters import CUSTOMER_SORTS, EXPENSE_SORTS, INVOICE_SORTS, JOB_SORTS, where_between, where_equal
+from geocode import GEOCODER_WORKER, cached_coordinates, run_geocode_worker
+from http_cache import HttpCacheMiddleware, etag_matches
+from invoicing import generate_invoices
+from metrics import MetricsMiddleware, render
+from outbox import OUTBOX_WORKER, queue_email, run_outbox_worker
+from pagination import MAX_PAGE_SIZE, keyset_page, parse_sort, stream_ndjson
+from patch import partial_update
+from payroll import refresh_weekly_hours, weekly_payroll
+from profiling import PROFILER_ENABLED, PROFILER_MAX_SECONDS, profile_event_loop
+from query_log import query_diagnostics
+from reports import REPORTS_WORKER, refresh_reports, run_report_refresher
+from scheduling import SCHEDULE_HORIZON_DAYS, schedule_jobs
+from search import MAX_SEARCH_RESULTS, customer_index, rank_customers
+from square_api import SquareClient, get_square, payments_cache, square
+from schema import (Customer, Invoice, Job, User, Employee, Expense, Services, Frequency, ServiceArea, ExpenseSummary,
+                    LaborSummary, ReceivablesSummary, RevenueSummary)
 
 
-URL = "https://connect.squareupsandbox.com/v2"
-TOKEN = os.getenv("TOKEN")
 SQ_APPLICATION_ID = os.getenv("SQ_APPLICATION_ID")
 SQ_APPLICATION_SECRET = os.getenv("SQ_APPLICATION_SECRET")
 SQUARE_ACCESS_TOKEN = "SQUARE_ACCESS_TOKEN"#os.getenv("SQUARE_ACCESS_TOKEN")
 
-
-app = FastAPI()
+logger = logging.getLogger(__name__)
+
+
+# Opens the shared Square connection pool and starts the email outbox, report refresh and geocoding
+# workers on startup, then stops them on shutdown. OUTBOX_WORKER and REPORTS_WORKER default on;
+# GEOCODER_WORKER calls an external service and only starts when set.
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    await square.start()
+    stop_outbox = asyncio.Event()
+    outbox_worker = asyncio.create_task(run_outbox_worker(stop_outbox)) if OUTBOX_WORKER else None
+    report_refresher = asyncio.create_task(run_report_refresher(stop_outbox)) if REPORTS_WORKER else None
+    geocode_worker = asyncio.create_task(run_geocode_worker(stop_outbox)) if GEOCODER_WORKER else None
+    yield
+    stop_outbox.set()
+    if outbox_worker:
+        await outbox_worker
+    if report_refresher:
+        await report_refresher
+    if geocode_worker:
+        await geocode_worker
+    await square.close()
+    await reference_cache.close()
+
+
+app = FastAPI(lifespan=lifespan, default_response_class=FastJSONResponse)
+# ETags, 304s and gzip/brotli for GET routes. Payments always come straight from Square.
+app.add_middleware(HttpCacheMiddleware, exclude_paths=("/payments", "/metrics", "/debug/profile"))
+# Latency, SQL time and query count per route for /metrics
+app.add_middleware(MetricsMiddleware)
 load_dotenv()
-
-
-headers: dict[str, str] = {
-    'Authorization': f'Bearer {TOKEN}',
-    'Content-Type': 'application/json',
-}
+logging.basicConfig(level=os.getenv("LOG_LEVEL", "INFO"), format="%(asctime)s %(levelname)s %(name)s: %(message)s")
 
 
 client = Client(
@@ -39,48 +87,74 @@ client = Client(
     environment='sandbox')
 
 
+# Table models are built from the request body without type conversion, so dates,
+# timestamps and amounts would reach the database as strings. This validates them properly.
+def validate_body(model, body):
+    try:
+        return model.model_validate({name: getattr(body, name) for name in body.model_fields_set})
+    except ValidationError as error:
+        raise RequestValidationError(error.errors())
+
+
+# Serves every row of a small reference table from the cache, loading it on a miss.
+# The ETag lets browsers revalidate with If-None-Match and get a 304 instead of the body.
+async def cached_table(request: Request, db: AsyncSession, model) -> Response:
+    key = model.__tablename__
+    entry = await reference_cache.get(key)
+    if entry is None:
+        rows = (await db.exec(select(model))).all()
+        entry = await reference_cache.set(key, dumps([row.model_dump(mode="json") for row in rows]))
+    etag, body = entry
+    headers = {"ETag": etag, "Cache-Control": "no-cache"}
+    if etag_matches(request.headers.get("if-none-match", ""), etag):
+        return Response(status_code=304, headers=headers)
+    return Response(body, media_type="application/json", headers=headers)
+
+
 #
 # *** SERVICES ***
 #
 
 
-@app.get("/services", tags=["Services"])
-async def get_services(db: Session = Depends(get_db)) -> list[Services]:
-    return db.exec(select(Services)).all()
+# Served from the reference cache, which the write routes below invalidate
+@app.get("/services", tags=["Services"], response_model=list[Services])
+async def get_services(request: Request, db: AsyncSession = Depends(get_async_db)) -> Response:
+    return await cached_table(request, db, Services)
 
 
 # Creates a service
 @app.post("/services", tags=["Services"])
-async def create_service(service: Services, db: Session = Depends(get_db)):
+async def create_service(service: Services, db: AsyncSession = Depends(get_async_db)):
     db.add(service)
-    db.commit()
+    await db.commit()
+    await reference_cache.invalidate(Services.__tablename__)
     raise HTTPException(status_code=201, detail="Service Created")
 
 
+# Creates or updates many services in one transaction from a JSON array or NDJSON body
+@app.post("/services/bulk", tags=["Services"], status_code=201)
+async def bulk_services(request: Request, db: AsyncSession = Depends(get_async_db)) -> list[dict]:
+    results = await bulk_upsert(db, Services, await read_bulk_body(request))
+    await reference_cache.invalidate(Services.__tablename__)
+    return results
+
+
 # # Updates or Creates a Service
 @app.put("/services/{service}", tags=["Services"])
-async def update_service(serviceId: int, updated_service: Services, db: Session = Depends(get_db)):
-    existing_service = db.get(Services, serviceId)
-    if not existing_service:
-        db.add(updated_service)
-        db.commit()
-        raise HTTPException(status_code=201, detail="Service Created")
-    
-    for key, value in updated_service.model_dump().items():
-        setattr(existing_service, key, value)
-    db.add(existing_service)
-    db.commit()
-    raise HTTPException(status_code=201, detail="Service Updated")
+async def update_service(serviceId: int, updated_service: Services, db: AsyncSession = Depends(get_async_db)):
+    created, _ = await upsert_row(db, Services, {**updated_service.model_dump(), "serviceId": serviceId})
+    await db.commit()
+    await reference_cache.invalidate(Services.__tablename__)
+    raise HTTPException(status_code=201, detail="Service Created" if created else "Service Updated")
 
 
 # Delete a service by serviceId
 @app.delete("/services/{serviceId}", tags=["Services"])
-async def delete_service(serviceId: int, db: Session = Depends(get_db)):
-    service = db.get(Services, serviceId)
-    if not service:
+async def delete_service(serviceId: int, db: AsyncSession = Depends(get_async_db)):
+    if not await delete_rows(db, Services, Services.serviceId == serviceId):
         raise HTTPException(status_code=404, detail="Service not found")
-    db.delete(service)
-    db.commit()
+    await db.commit()
+    await reference_cache.invalidate(Services.__tablename__)
     raise HTTPException(status_code=200, detail="Service Deleted")
 
 
@@ -88,43 +162,45 @@ async def delete_service(serviceId: int, db: Session = Depends(get_db)):
 # ***FREQUENCY***
 #
 
-@app.get("/frequency", tags=["Frequency"])
-async def get_frequency(db: Session = Depends(get_db)) -> list[Frequency]:
-    return db.exec(select(Frequency)).all()
+# Served from the reference cache, which the write routes below invalidate
+@app.get("/frequency", tags=["Frequency"], response_model=list[Frequency])
+async def get_frequency(request: Request, db: AsyncSession = Depends(get_async_db)) -> Response:
+    return await cached_table(request, db, Frequency)
 
 
 # Creates a frequency for time of service
 @app.post("/frequency", tags=["Frequency"])
-async def create_frequency(frequency: Frequency, db: Session = Depends(get_db)):
+async def create_frequency(frequency: Frequency, db: AsyncSession = Depends(get_async_db)):
     db.add(frequency)
-    db.commit()
+    await db.commit()
+    await reference_cache.invalidate(Frequency.__tablename__)
     raise HTTPException(status_code=201, detail="Frequency Created")
 
 
+# Creates or updates many frequencies in one transaction from a JSON array or NDJSON body
+@app.post("/frequency/bulk", tags=["Frequency"], status_code=201)
+async def bulk_frequency(request: Request, db: AsyncSession = Depends(get_async_db)) -> list[dict]:
+    results = await bulk_upsert(db, Frequency, await read_bulk_body(request))
+    await reference_cache.invalidate(Frequency.__tablename__)
+    return results
+
+
 # Updates or Creates a Service
 @app.put("/frequency/{frequencyId}", tags=["Frequency"])
-async def update_frequency(frequencyId: int, updated_frequency: Frequency, db: Session = Depends(get_db)):
-    existing_frequency = db.get(Frequency, frequencyId)
-    if not existing_frequency:
-        db.add(updated_frequency)
-        db.commit()
-        raise HTTPException(status_code=201, detail="Frequency Created")
-    
-    for key, value in updated_frequency.model_dump().items():
-        setattr(existing_frequency, key, value)
-    db.add(existing_frequency)
-    db.commit()
-    raise HTTPException(status_code=201, detail="Frequency Updated")
+async def update_frequency(frequencyId: int, updated_frequency: Frequency, db: AsyncSession = Depends(get_async_db)):
+    created, _ = await upsert_row(db, Frequency, {**updated_frequency.model_dump(), "frequencyId": frequencyId})
+    await db.commit()
+    await reference_cache.invalidate(Frequency.__tablename__)
+    raise HTTPException(status_code=201, detail="Frequency Created" if created else "Frequency Updated")
 
 
 # Delete frequency of service by frequencyId
 @app.delete("/frequency/{frequencyId}", tags=["Frequency"])
-async def delete_frequency(frequencyId: int, db: Session = Depends(get_db)):
-    frequencies = db.get(Frequency, frequencyId)
-    if not frequencies:
+async def delete_frequency(frequencyId: int, db: AsyncSession = Depends(get_async_db)):
+    if not await delete_rows(db, Frequency, Frequency.frequencyId == frequencyId):
         raise HTTPException(status_code=404, detail="Frequency of service not found")
-    db.delete(frequencies)
-    db.commit()
+    await db.commit()
+    await reference_cache.invalidate(Frequency.__tablename__)
     raise HTTPException(status_code=200, detail="Frequency Deleted")
 
 
@@ -133,42 +209,45 @@ async def delete_frequency(frequencyId: int, db: Session = Depends(get_db)):
 #
 
 
-@app.get("/servicearea", tags=["Service Area"])
-async def get_service_area(db: Session = Depends(get_db)) -> list[ServiceArea]:
-    return db.exec(select(ServiceArea)).all()
+# Served from the reference cache, which the write routes below invalidate
+@app.get("/servicearea", tags=["Service Area"], response_model=list[ServiceArea])
+async def get_service_area(request: Request, db: AsyncSession = Depends(get_async_db)) -> Response:
+    return await cached_table(request, db, ServiceArea)
 
 
 # Creates a Service Area
 @app.post("/servicearea", tags=["Service Area"])
-async def create_service_area(serviceArea: ServiceArea, db: Session = Depends(get_db)):
+async def create_service_area(serviceArea: ServiceArea, db: AsyncSession = Depends(get_async_db)):
     db.add(serviceArea)
-    db.commit()
+    await db.commit()
+    await reference_cache.invalidate(ServiceArea.__tablename__)
     raise HTTPException(status_code=201, detail="Service Area Created")
 
 
+# Creates or updates many service area towns in one transaction from a JSON array or NDJSON body
+@app.post("/servicearea/bulk", tags=["Service Area"], status_code=201)
+async def bulk_service_area(request: Request, db: AsyncSession = Depends(get_async_db)) -> list[dict]:
+    results = await bulk_upsert(db, ServiceArea, await read_bulk_body(request))
+    await reference_cache.invalidate(ServiceArea.__tablename__)
+    return results
+
+
 # Updates or Creates a town within the service area
 @app.put("/servicearea/{serviceAreaId}", tags=["Service Area"])
-async def update_service_area(serviceAreaId: int, updated_serviceArea: ServiceArea, db: Session = Depends(get_db)):
-    existing_serviceArea = db.get(ServiceArea, serviceAreaId)
-    if not existing_serviceArea:
-        db.add(updated_serviceArea)
-        db.commit()
-        raise HTTPException(status_code=201, detail="Service Area Created")
-    for key, value in updated_serviceArea.model_dump().items():
-        setattr(existing_serviceArea, key, value)
-    db.add(existing_serviceArea)
-    db.commit()
-    raise HTTPException(status_code=201, detail="Service Area Updated")
+async def update_service_area(serviceAreaId: int, updated_serviceArea: ServiceArea, db: AsyncSession = Depends(get_async_db)):
+    created, _ = await upsert_row(db, ServiceArea, {**updated_serviceArea.model_dump(), "serviceAreaId": serviceAreaId})
+    await db.commit()
+    await reference_cache.invalidate(ServiceArea.__tablename__)
+    raise HTTPException(status_code=201, detail="Service Area Created" if created else "Service Area Updated")
 
 
 # Delete a town in a service area by serviceAreaId
 @app.delete("/servicearea/{serviceAreaId}", tags=["Service Area"])
-async def delete_service_area(serviceAreaId: int, db: Session = Depends(get_db)):
-    serviceArea = db.get(ServiceArea, serviceAreaId)
-    if not serviceArea:
+async def delete_service_area(serviceAreaId: int, db: AsyncSession = Depends(get_async_db)):
+    if not await delete_rows(db, ServiceArea, ServiceArea.serviceAreaId == serviceAreaId):
         raise HTTPException(status_code=404, detail="Service Area not found")
-    db.delete(serviceArea)
-    db.commit()
+    await db.commit()
+    await reference_cache.invalidate(ServiceArea.__tablename__)
     raise HTTPException(status_code=200, detail="Service Area Deleted")
 
 
@@ -177,46 +256,98 @@ async def delete_service_area(serviceAreaId: int, db: Session = Depends(get_db))
 #
 
 
-#Returns a customer by Id or a list of all customers
+#Returns a customer by Id or a list of customers, paged by customerId with limit/after.
+# stream=true streams every matching row as NDJSON instead.
+# expand=jobs,city,frequency includes those relationships, loaded in a fixed number of queries.
+# isResidential/frequencyId filter the list and sort orders it (prefix with - for descending).
+# fields=customerId,fName,lName reads and returns only those columns (the id is always included),
+# for a single customer too.
 @app.get("/customer", tags=["Customer"])
-async def get_customers(custId: int = None, db: Session = Depends(get_db)):
+async def get_customers(custId: int = None, limit: int = Query(default=None, ge=1, le=MAX_PAGE_SIZE),
+                        after: int = None, stream: bool = False, expand: list[str] = Query(default=[]),
+                        isResidential: bool = None, frequencyId: int = None, sort: str = None,
+                        fields: list[str] = Query(default=[]), db: AsyncSession = Depends(get_async_db)):
+    sort = parse_sort(sort, CUSTOMER_SORTS)
+    fields = parse_fields(fields, Customer)
+    expand = parse_expand(expand, CUSTOMER_EXPANSIONS)
+    if fields and expand:
+        raise HTTPException(status_code=400, detail="fields and expand can't be combined")
+    options = expand_options(expand, CUSTOMER_EXPANSIONS)
     if custId:
-        return [db.get(Customer, custId)]
-    return db.exec(select(Customer)).all()
+        if fields:
+            query = select_columns(Customer, fields).where(Customer.customerId == custId)
+            return FastJSONResponse(rows_as_dicts(await db.exec(query)))
+        customer = await db.get(Customer, custId, options=options)
+        return [expand_customer(customer, expand) if expand else customer]
+    query = select(Customer).options(*options) if expand else select_columns(Customer, fields)
+    query = where_equal(query, (Customer.isResidential, isResidential), (Customer.frequencyId, frequencyId))
+    query = await keyset_page(db, query, Customer.customerId, after, limit, sort)
+    if stream:
+        to_json = (lambda row: dumps(expand_customer(row, expand))) if expand else None
+        return await stream_ndjson(db, query, to_json=to_json)
+    if expand:
+        return FastJSONResponse([expand_customer(customer, expand) for customer in (await db.exec(query)).all()])
+    return FastJSONResponse(rows_as_dicts(await db.exec(query)))
+
+
+# Finds customers by name, email, phone number or address, tolerating typos and partial words.
+# Returns the best `limit` matches, best first, each with a score from 0 to 1.
+@app.get("/customer/search", tags=["Customer"])
+async def search_customers(q: str = Query(min_length=1), limit: int = Query(default=20, ge=1, le=MAX_SEARCH_RESULTS),
+                           fields: list[str] = Query(default=[]), db: AsyncSession = Depends(get_async_db)):
+    fields = parse_fields(fields, Customer)
+    scores = dict(await rank_customers(db, q, limit))
+    if not scores:
+        return FastJSONResponse([])
+    rows = rows_as_dicts(await db.exec(select_columns(Customer, fields).where(Customer.customerId.in_(scores))))
+    rows.sort(key=lambda row: (-scores[row["customerId"]], row["customerId"]))
+    return FastJSONResponse([{**row, "score": round(scores[row["customerId"]], 3)} for row in rows])
 
 
 # Creates a customer
 @app.post("/customer", tags=["Customer"])
-async def create_customer(customer: Customer, db: Session = Depends(get_db)):
+async def create_customer(customer: Customer, db: AsyncSession = Depends(get_async_db)):
     db_customer = Customer(**customer.model_dump())
     db.add(db_customer)
-    db.commit()
+    await db.commit()
+    customer_index.invalidate()
     raise HTTPException(status_code=201, detail="Customer Created")
 
 
+# Creates or updates many customers in one transaction from a JSON array or NDJSON body
+@app.post("/customer/bulk", tags=["Customer"], status_code=201)
+async def bulk_customers(request: Request, db: AsyncSession = Depends(get_async_db)) -> list[dict]:
+    results = await bulk_upsert(db, Customer, await read_bulk_body(request))
+    customer_index.invalidate()
+    return results
+
+
 # Updates or Creates a Customer
 @app.put("/customer/{customerId}", tags=["Customer"])
-async def update_customer(custId: int, updated_customer: Customer, db: Session = Depends(get_db)):
-    existing_customer = db.get(Customer, custId)
-    if not existing_customer:
-        db.add(updated_customer)
-        db.commit()
-        raise HTTPException(status_code=201, detail="Customer Created")
-    for key, value in updated_customer.model_dump().items():
-        setattr(existing_customer, key, value)
-    db.add(existing_customer)
-    db.commit()
-    raise HTTPException(status_code=201, detail="Customer Updated")
+async def update_customer(custId: int, updated_customer: Customer, db: AsyncSession = Depends(get_async_db)):
+    created, _ = await upsert_row(db, Customer, {**updated_customer.model_dump(), "customerId": custId})
+    await db.commit()
+    customer_index.invalidate()
+    raise HTTPException(status_code=201, detail="Customer Created" if created else "Customer Updated")
+
+
+# Changes only the fields sent with one UPDATE ... RETURNING and returns the updated customer.
+# Include the version last read to get a 409 instead of overwriting someone else's change.
+@app.patch("/customer/{customerId}", tags=["Customer"])
+async def patch_customer(customerId: int, changes: dict, db: AsyncSession = Depends(get_async_db)):
+    customer, _ = await partial_update(db, Customer, customerId, changes)
+    await db.commit()
+    customer_index.invalidate()
+    return FastJSONResponse(customer)
 
 
 # Deletes a customer by CustomerId
 @app.delete("/customer/{customerId}", tags=["Customer"])
-async def delete_customer(custId: int, db: Session = Depends(get_db)):
-    customer = db.get(Customer, custId)
-    if not customer:
+async def delete_customer(custId: int, db: AsyncSession = Depends(get_async_db)):
+    if not await delete_rows(db, Customer, Customer.customerId == custId):
         raise HTTPException(status_code=404, detail="Customer not found")
-    db.delete(customer)
-    db.commit()
+    await db.commit()
+    customer_index.invalidate()
     raise HTTPException(status_code=200, detail="Customer Deleted")
 
 
@@ -227,44 +358,49 @@ async def delete_customer(custId: int, db: Session = Depends(get_db)):
 
 #Returns an employee by Id or a list of all employees
 @app.get("/employee", tags=["Employee"])
-async def get_employee(EmpId: int = None, db: Session = Depends(get_db)):
+async def get_employee(EmpId: int = None, db: AsyncSession = Depends(get_async_db)):
     if EmpId:
-        return [db.get(Employee, EmpId)]
-    return db.exec(select(Employee)).all()
+        return [await db.get(Employee, EmpId)]
+    return (await db.exec(select(Employee))).all()
 
 
 # Creates an Employee
 @app.post("/employee", tags=["Employee"])
-async def create_employee(employee: Employee, db: Session = Depends(get_db)):
+async def create_employee(employee: Employee, db: AsyncSession = Depends(get_async_db)):
     db_employee = Employee(**employee.model_dump())
     db.add(db_employee)
-    db.commit()
+    await db.commit()
     raise HTTPException(status_code=201, detail="Employee Created")
 
 
+# Creates or updates many employees in one transaction from a JSON array or NDJSON body
+@app.post("/employee/bulk", tags=["Employee"], status_code=201)
+async def bulk_employees(request: Request, db: AsyncSession = Depends(get_async_db)) -> list[dict]:
+    return await bulk_upsert(db, Employee, await read_bulk_body(request))
+
+
 # Updates or Creates a Employee
 @app.put("/employee/{EmpId}", tags=["Employee"])
-async def update_employee(EmpId: int, updated_employee: Employee, db: Session = Depends(get_db)):
-    existing_employee = db.get(Employee, EmpId)
-    if not existing_employee:
-        db.add(updated_employee)
-        db.commit()
-        raise HTTPException(status_code=201, detail="Employee Created")
-    for key, value in updated_employee.model_dump().items():
-        setattr(existing_employee, key, value)
-    db.add(existing_employee)
-    db.commit()
-    raise HTTPException(status_code=201, detail="Employee Updated")
+async def update_employee(EmpId: int, updated_employee: Employee, db: AsyncSession = Depends(get_async_db)):
+    created, _ = await upsert_row(db, Employee, {**updated_employee.model_dump(), "empId": EmpId})
+    await db.commit()
+    raise HTTPException(status_code=201, detail="Employee Created" if created else "Employee Updated")
+
+
+# Changes only the fields sent and returns the updated employee, see patch_customer
+@app.patch("/employee/{empId}", tags=["Employee"])
+async def patch_employee(empId: int, changes: dict, db: AsyncSession = Depends(get_async_db)):
+    employee, _ = await partial_update(db, Employee, empId, changes)
+    await db.commit()
+    return FastJSONResponse(employee)
 
 
 # Delete an employee by EmpId
 @app.delete("/employee/{EmpId}", tags=["Employee"])
-async def delete_employee(EmpId: int, db: Session = Depends(get_db)):
-    employee = db.get(Employee, EmpId)
-    if not employee:
+async def delete_employee(EmpId: int, db: AsyncSession = Depends(get_async_db)):
+    if not await delete_rows(db, Employee, Employee.empId == EmpId):
         raise HTTPException(status_code=404, detail="Employee not found")
-    db.delete(employee)
-    db.commit()
+    await db.commit()
     raise HTTPException(status_code=200, detail="Employee Deleted")
 
 
@@ -273,51 +409,53 @@ async def delete_employee(EmpId: int, db: Session = Depends(get_db)):
 #
 
 
+EMAIL_PATTERN = r"^[a-zA-Z0-9_.+-]+@[a-zA-Z0-9-]+\.[a-zA-Z0-9-.]+$"
+
+
+def check_user_email(user: User):
+    if not re.match(EMAIL_PATTERN, user.email):
+        raise ValueError("Invalid email address")
+
+
 @app.get("/user", tags=['Users'])
-async def get_user(db: Session = Depends(get_db)) -> list[User]:
-    return db.exec(select(User)).all()
+async def get_user(db: AsyncSession = Depends(get_async_db)) -> list[User]:
+    return (await db.exec(select(User))).all()
 
 
 # Creates a user
 @app.post("/user", tags=['Users'])
-async def create_user(user: User, db: Session = Depends(get_db)):
+async def create_user(user: User, db: AsyncSession = Depends(get_async_db)):
     email = user.email
 
-    email_pattern = r"^[a-zA-Z0-9_.+-]+@[a-zA-Z0-9-]+\.[a-zA-Z0-9-.]+$"
-
-    if not re.match(email_pattern, email):
+    if not re.match(EMAIL_PATTERN, email):
         raise HTTPException(status_code=400, detail="Invalid email address")
 
     db_user = User(**user.model_dump())
     db.add(db_user)
-    db.commit()
+    await db.commit()
     raise HTTPException(status_code=201, detail="User Created")
 
 
+# Creates or updates many users in one transaction from a JSON array or NDJSON body
+@app.post("/user/bulk", tags=['Users'], status_code=201)
+async def bulk_users(request: Request, db: AsyncSession = Depends(get_async_db)) -> list[dict]:
+    return await bulk_upsert(db, User, await read_bulk_body(request), check=check_user_email)
+
+
 # Updates or Creates a User
 @app.put("/user/{userId}", tags=['Users'])
-async def update_user(userId: int, updated_user: User, db: Session = Depends(get_db)):
-    existing_user = db.get(User, userId)
-    if not existing_user:
-        #create_user(updated_user)
-        db.add(updated_user)
-        db.commit()
-        raise HTTPException(status_code=201, detail="User created")
-    for key, value in updated_user.model_dump().items():
-        setattr(existing_user, key, value)
-    db.add(existing_user)
-    db.commit()
-    raise HTTPException(status_code=201, detail="User Updated.")
+async def update_user(userId: int, updated_user: User, db: AsyncSession = Depends(get_async_db)):
+    created, _ = await upsert_row(db, User, {**updated_user.model_dump(), "userId": userId})
+    await db.commit()
+    raise HTTPException(status_code=201, detail="User created" if created else "User Updated.")
 
 
 # Delete a user by userId
 @app.delete("/user/{userId}", tags=['Users'])
-async def delete_user(userId: int, db: Session = Depends(get_db)):
-    user = db.get(User, userId)
-    if not user:
+async def delete_user(userId: int, db: AsyncSession = Depends(get_async_db)):
+    if not await delete_rows(db, User, User.userId == userId):
         raise HTTPException(status_code=404, detail="User not found")
-    db.delete(user)
-    db.commit()
+    await db.commit()
     raise HTTPException(status_code=200, detail="User Deleted")
 
 
@@ -326,94 +464,175 @@ async def delete_user(userId: int, db: Session = Depends(get_db)):
 #
 
 
-#Returns a invoice by Id or a list of all invoices
+#Returns a invoice by Id or a list of invoices, paged by invoiceId with limit/after.
+# stream=true streams every matching row as NDJSON instead.
+# paid and the invoiceDate/dueDate ranges (inclusive) filter the list, sort orders it.
+# fields= picks the columns to return.
 @app.get("/invoice", tags=["Invoice"])
-async def get_invoice(invoiceId: int = None, db: Session = Depends(get_db)):
+async def get_invoice(invoiceId: int = None, limit: int = Query(default=None, ge=1, le=MAX_PAGE_SIZE),
+                      after: int = None, stream: bool = False, paid: bool = None,
+                      invoiceDateFrom: date = None, invoiceDateTo: date = None,
+                      dueDateFrom: date = None, dueDateTo: date = None, sort: str = None,
+                      fields: list[str] = Query(default=[]), db: AsyncSession = Depends(get_async_db)):
+    sort = parse_sort(sort, INVOICE_SORTS)
+    fields = parse_fields(fields, Invoice)
     if invoiceId:
-        return [db.get(Invoice, invoiceId)]
-    return db.exec(select(Invoice)).all()
+        if fields:
+            query = select_columns(Invoice, fields).where(Invoice.invoiceId == invoiceId)
+            return FastJSONResponse(rows_as_dicts(await db.exec(query)))
+        return [await db.get(Invoice, invoiceId)]
+    query = where_equal(select_columns(Invoice, fields), (Invoice.paid, paid))
+    query = where_between(query, Invoice.invoiceDate, invoiceDateFrom, invoiceDateTo)
+    query = where_between(query, Invoice.dueDate, dueDateFrom, dueDateTo)
+    query = await keyset_page(db, query, Invoice.invoiceId, after, limit, sort)
+    if stream:
+        return await stream_ndjson(db, query)
+    return FastJSONResponse(rows_as_dicts(await db.exec(query)))
 
 
 # Creates an Invoice
 @app.post("/invoice", tags=["Invoice"])
-async def create_invoice(invoice: Invoice, db: Session = Depends(get_db)):
-    db_invoice = Invoice(**invoice.model_dump())
+async def create_invoice(invoice: Invoice, db: AsyncSession = Depends(get_async_db)):
+    db_invoice = validate_body(Invoice, invoice)
     db.add(db_invoice)
-    db.commit()
+    await db.commit()
     raise HTTPException(status_code=201, detail="Invoice Created")
 
 
+# Creates or updates many invoices in one transaction from a JSON array or NDJSON body
+@app.post("/invoice/bulk", tags=["Invoice"], status_code=201)
+async def bulk_invoices(request: Request, db: AsyncSession = Depends(get_async_db)) -> list[dict]:
+    return await bulk_upsert(db, Invoice, await read_bulk_body(request))
+
+
+# Invoices every customer's finished, uninvoiced jobs worked between start and end (inclusive)
+# and links the jobs to their new invoice, all in one transaction. Also runnable as `python invoicing.py`.
+@app.post("/invoice/generate", tags=["Invoice"], status_code=201)
+async def generate_invoices_for_range(start: date, end: date, invoiceDate: date = None,
+                                      db: AsyncSession = Depends(get_async_db)) -> dict:
+    if end < start:
+        raise HTTPException(status_code=400, detail="end must not be before start")
+    return await generate_invoices(db, start, end, invoiceDate or date.today())
+
+
 # Updates or Creates a Invoice
 @app.put("/invoice/{invoiceId}", tags=["Invoice"])
-async def update_invoice(invoiceId: int, updated_invoice: Invoice, db: Session = Depends(get_db)):
-    existing_invoice = db.get(Invoice, invoiceId)
-    if not existing_invoice:
-        db.add(updated_invoice)
-        db.commit()
-        raise HTTPException(status_code=201, detail="Invoice Created")
-    for key, value in updated_invoice.model_dump().items():
-        setattr(existing_invoice, key, value)
-    db.add(existing_invoice)
-    db.commit()
-    raise HTTPException(status_code=201, detail="Invoice Updated")
+async def update_invoice(invoiceId: int, updated_invoice: Invoice, db: AsyncSession = Depends(get_async_db)):
+    created, _ = await upsert_row(db, Invoice, {**validate_body(Invoice, updated_invoice).model_dump(), "invoiceId": invoiceId})
+    await db.commit()
+    raise HTTPException(status_code=201, detail="Invoice Created" if created else "Invoice Updated")
+
+
+# Changes only the fields sent and returns the updated invoice, see patch_customer
+@app.patch("/invoice/{invoiceId}", tags=["Invoice"])
+async def patch_invoice(invoiceId: int, changes: dict, db: AsyncSession = Depends(get_async_db)):
+    invoice, _ = await partial_update(db, Invoice, invoiceId, changes)
+    await db.commit()
+    return FastJSONResponse(invoice)
 
 
 # Deletes a invoice by invoiceId
 @app.delete("/invoice/{invoiceId}", tags=["Invoice"])
-async def delete_invoice(invoiceId: int, db: Session = Depends(get_db)):
-    invoice = db.get(Invoice, invoiceId)
-    if not invoice:
+async def delete_invoice(invoiceId: int, db: AsyncSession = Depends(get_async_db)):
+    if not await delete_rows(db, Invoice, Invoice.invoiceId == invoiceId):
         raise HTTPException(status_code=404, detail="Invoice not found")
-    db.delete(invoice)
-    db.commit()
+    await db.commit()
     raise HTTPException(status_code=200, detail="Invoice Deleted")
 
 
+# Queues the invoice to be emailed to the customer on its job, or to to_email when given.
+# The outbox worker sends it in the background and sets emailStatus once it's delivered.
+@app.post("/invoice/{invoiceId}/email", tags=["Invoice"])
+async def email_invoice(invoiceId: int, to_email: str = None, db: AsyncSession = Depends(get_async_db)):
+    invoice = await db.get(Invoice, invoiceId)
+    if not invoice:
+        raise HTTPException(status_code=404, detail="Invoice not found")
+    if not to_email:
+        to_email = (await db.exec(
+            select(Customer.email).join(Job, Job.customerId == Customer.customerId).where(Job.invoiceId == invoiceId)
+        )).first()
+    if not to_email:
+        raise HTTPException(status_code=400, detail="No email address for this invoice")
+
+    body = (
+        f"Invoice #{invoice.invoiceId}\n"
+        f"Invoice date: {invoice.invoiceDate}\n"
+        f"Due date: {invoice.dueDate}\n"
+        f"Tax: ${invoice.taxAmount:.2f}\n"
+        f"Total: ${invoice.totalEstimate:.2f}\n"
+    )
+    queue_email(db, to_email, f"Queen of the Yard Invoice #{invoice.invoiceId}", body, invoice_id=invoice.invoiceId)
+    await db.commit()
+    raise HTTPException(status_code=202, detail="Invoice Email Queued")
+
+
 #
 # *** EXPENSE ***
 #
 
 
-#Returns an expense by Id or a list of all Expenses
+#Returns an expense by Id or a list of Expenses, paged by expenseId with limit/after.
+# stream=true streams every matching row as NDJSON instead.
+# purchasedBy/linkedJob and the expenseDate range (inclusive) filter the list, sort orders it.
+# fields= picks the columns to return.
 @app.get("/expense", tags=["Expense"])
-async def get_expense(ExpenseId: int = None, db: Session = Depends(get_db)):
+async def get_expense(ExpenseId: int = None, limit: int = Query(default=None, ge=1, le=MAX_PAGE_SIZE),
+                      after: int = None, stream: bool = False, purchasedBy: int = None, linkedJob: int = None,
+                      expenseDateFrom: date = None, expenseDateTo: date = None, sort: str = None,
+                      fields: list[str] = Query(default=[]), db: AsyncSession = Depends(get_async_db)):
+    sort = parse_sort(sort, EXPENSE_SORTS)
+    fields = parse_fields(fields, Expense)
     if ExpenseId:
-        return [db.get(Expense, ExpenseId)]
-    return db.exec(select(Expense)).all()
+        if fields:
+            query = select_columns(Expense, fields).where(Expense.expenseId == ExpenseId)
+            return FastJSONResponse(rows_as_dicts(await db.exec(query)))
+        return [await db.get(Expense, ExpenseId)]
+    query = where_equal(select_columns(Expense, fields),
+                        (Expense.purchasedBy, purchasedBy), (Expense.linkedJob, linkedJob))
+    query = where_between(query, Expense.expenseDate, expenseDateFrom, expenseDateTo)
+    query = await keyset_page(db, query, Expense.expenseId, after, limit, sort)
+    if stream:
+        return await stream_ndjson(db, query)
+    return FastJSONResponse(rows_as_dicts(await db.exec(query)))
 
 
 # Creates an Expense
 @app.post("/expense", tags=["Expense"])
-async def create_expense(expense: Expense, db: Session = Depends(get_db)):
-    db_expense = Expense(**expense.model_dump())
+async def create_expense(expense: Expense, db: AsyncSession = Depends(get_async_db)):
+    db_expense = validate_body(Expense, expense)
     db.add(db_expense)
-    db.commit()
+    await db.commit()
     raise HTTPException(status_code=201, detail="Expense Created")
 
 
+# Creates or updates many expenses in one transaction from a JSON array or NDJSON body
+@app.post("/expense/bulk", tags=["Expense"], status_code=201)
+async def bulk_expenses(request: Request, db: AsyncSession = Depends(get_async_db)) -> list[dict]:
+    return await bulk_upsert(db, Expense, await read_bulk_body(request))
+
+
 # Updates or Creates a Expense
 @app.put("/expense/{EmpId}", tags=["Expense"])
-async def update_expense(EmpId: int, updated_expense: Expense, db: Session = Depends(get_db)):
-    existing_expense = db.get(Expense, EmpId)
-    if not existing_expense:
-        db.add(updated_expense)
-        db.commit()
-        raise HTTPException(status_code=201, detail="Expense Created")
-    for key, value in updated_expense.model_dump().items():
-        setattr(existing_expense, key, value)
-    db.add(existing_expense)
-    db.commit()
-    raise HTTPException(status_code=201, detail="Expense Updated")
+async def update_expense(EmpId: int, updated_expense: Expense, db: AsyncSession = Depends(get_async_db)):
+    created, _ = await upsert_row(db, Expense, {**validate_body(Expense, updated_expense).model_dump(), "expenseId": EmpId})
+    await db.commit()
+    raise HTTPException(status_code=201, detail="Expense Created" if created else "Expense Updated")
+
+
+# Changes only the fields sent and returns the updated expense, see patch_customer
+@app.patch("/expense/{expenseId}", tags=["Expense"])
+async def patch_expense(expenseId: int, changes: dict, db: AsyncSession = Depends(get_async_db)):
+    expense, _ = await partial_update(db, Expense, expenseId, changes)
+    await db.commit()
+    return FastJSONResponse(expense)
 
 
 # Delete an expense by expenseId
 @app.delete("/expense/{expenseId}", tags=["Expense"])
-async def delete_expense(expenseId: int, db: Session = Depends(get_db)):
-    expense = db.get(Expense, expenseId)
-    if not expense:
+async def delete_expense(expenseId: int, db: AsyncSession = Depends(get_async_db)):
+    if not await delete_rows(db, Expense, Expense.expenseId == expenseId):
         raise HTTPException(status_code=404, detail="Expense not found")
-    db.delete(expense)
-    db.commit()
+    await db.commit()
     raise HTTPException(status_code=200, detail="Expense Deleted")
 
 
@@ -422,67 +641,276 @@ async def delete_expense(expenseId: int, db: Session = Depends(get_db)):
 #
 
 
-#Returns a job by Id or a list of all jobs
+#Returns a job by Id or a list of jobs, paged by jobId with limit/after.
+# stream=true streams every matching row as NDJSON instead.
+# expand=servicesProvided,extraExpenses,invoice,customer includes those relationships,
+# loaded in a fixed number of queries.
+# isActive/employeeId/customerId and the clockIn day range (inclusive) filter the list, sort orders it.
+# fields= picks the columns to return and can't be combined with expand.
 @app.get("/job", tags=["Job"])
-async def get_jobs(jobId: int = None, db: Session = Depends(get_db)):
+async def get_jobs(jobId: int = None, limit: int = Query(default=None, ge=1, le=MAX_PAGE_SIZE),
+                   after: int = None, stream: bool = False, expand: list[str] = Query(default=[]),
+                   isActive: bool = None, employeeId: int = None, customerId: int = None,
+                   clockInFrom: date = None, clockInTo: date = None, sort: str = None,
+                   fields: list[str] = Query(default=[]), db: AsyncSession = Depends(get_async_db)):
+    sort = parse_sort(sort, JOB_SORTS)
+    fields = parse_fields(fields, Job)
+    expand = parse_expand(expand, JOB_EXPANSIONS)
+    if fields and expand:
+        raise HTTPException(status_code=400, detail="fields and expand can't be combined")
+    options = expand_options(expand, JOB_EXPANSIONS)
     if jobId:
-        return [db.get(Job, jobId)]
-    return db.exec(select(Job)).all()
+        if fields:
+            query = select_columns(Job, fields).where(Job.jobId == jobId)
+            return FastJSONResponse(rows_as_dicts(await db.exec(query)))
+        job = await db.get(Job, jobId, options=options)
+        return [expand_job(job, expand) if expand else job]
+    query = select(Job).options(*options) if expand else select_columns(Job, fields)
+    query = where_equal(query, (Job.isActive, isActive), (Job.employeeId, employeeId), (Job.customerId, customerId))
+    query = where_between(query, Job.clockIn, clockInFrom, clockInTo, timestamps=True)
+    query = await keyset_page(db, query, Job.jobId, after, limit, sort)
+    if stream:
+        to_json = (lambda row: dumps(expand_job(row, expand))) if expand else None
+        return await stream_ndjson(db, query, to_json=to_json)
+    if expand:
+        return FastJSONResponse([expand_job(job, expand) for job in (await db.exec(query)).all()])
+    return FastJSONResponse(rows_as_dicts(await db.exec(query)))
 
 
 # Creates a Job
 @app.post("/job", tags=["Job"])
-async def create_job(job: Job, db: Session = Depends(get_db)):
+async def create_job(job: Job, db: AsyncSession = Depends(get_async_db)):
+    job = validate_body(Job, job)
     db.add(job)
-    db.commit()
+    await refresh_weekly_hours(db, {job.employeeId})
+    await db.commit()
     raise HTTPException(status_code=201, detail="Job Created")
 
 
+# Creates or updates many jobs in one transaction from a JSON array or NDJSON body
+@app.post("/job/bulk", tags=["Job"], status_code=201)
+async def bulk_jobs(request: Request, db: AsyncSession = Depends(get_async_db)) -> list[dict]:
+    results = await bulk_upsert(db, Job, await read_bulk_body(request))
+    await refresh_weekly_hours(db)
+    await db.commit()
+    return results
+
+
+# Creates upcoming jobs for every customer on a recurring frequency, from `start` (today by default)
+# through `through` (SCHEDULE_HORIZON_DAYS ahead by default). Only jobs missing since the last run are added.
+@app.post("/job/schedule", tags=["Job"], status_code=201)
+async def schedule_recurring_jobs(start: date = None, through: date = None,
+                                  db: AsyncSession = Depends(get_async_db)) -> dict:
+    start = start or date.today()
+    through = through or start + timedelta(days=SCHEDULE_HORIZON_DAYS)
+    if through < start:
+        raise HTTPException(status_code=400, detail="through must not be before start")
+    scheduled = await schedule_jobs(db, start, through)
+    if scheduled is None:
+        raise HTTPException(status_code=409, detail="Jobs are already being scheduled")
+    return scheduled
+
+
 # Updates or Creates a Job
 @app.put("/job/{JobId}", tags=["Job"])
-async def update_job(jobId: int, updated_job: Job, db: Session = Depends(get_db)):
-    existing_job = db.get(Job, jobId)
-    if not existing_job:
-        db.add(updated_job)
-        db.commit()
-        raise HTTPException(status_code=201, detail="Job Created")
-    for key, value in updated_job.model_dump().items():
-        setattr(existing_job, key, value)
-    db.add(existing_job)
-    db.commit()
-    raise HTTPException(status_code=201, detail="Job Updated")
+async def update_job(jobId: int, updated_job: Job, db: AsyncSession = Depends(get_async_db)):
+    job = validate_body(Job, updated_job)
+    created, previous = await upsert_row(db, Job, {**job.model_dump(), "jobId": jobId}, previous=(Job.employeeId,))
+    await refresh_weekly_hours(db, {previous["employeeId"], job.employeeId})
+    await db.commit()
+    raise HTTPException(status_code=201, detail="Job Created" if created else "Job Updated")
+
+
+# Changes only the fields sent and returns the updated job, see patch_customer.
+# Clocking in or out is just {"clockOut": "..."}. The weeklyHours of the job's employee,
+# and of its previous one when it moved, are recounted.
+@app.patch("/job/{jobId}", tags=["Job"])
+async def patch_job(jobId: int, changes: dict, db: AsyncSession = Depends(get_async_db)):
+    job, previous = await partial_update(db, Job, jobId, changes, previous=(Job.employeeId,))
+    await refresh_weekly_hours(db, {previous["employeeId"], job["employeeId"]})
+    await db.commit()
+    return FastJSONResponse(job)
 
 
 # Deletes a Job by JobId
 @app.delete("/job/{JobId}", tags=["Job"])
-async def delete_job(jobId: int, db: Session = Depends(get_db)):
-    job = db.get(Job, jobId)
-    if not job:
+async def delete_job(jobId: int, db: AsyncSession = Depends(get_async_db)):
+    deleted = await delete_rows(db, Job, Job.jobId == jobId, returning=(Job.employeeId,))
+    if not deleted:
         raise HTTPException(status_code=404, detail="Job not found")
-    db.delete(job)
-    db.commit()
+    await refresh_weekly_hours(db, {deleted[0].employeeId})
+    await db.commit()
     raise HTTPException(status_code=200, detail="Job Deleted")
 
 
-# Email Submission
+# Deletes every job matching the filters in one DELETE ... RETURNING, e.g. isActive=false&started=false
+# to clear cancelled jobs (completed jobs are inactive too, but were clocked in). started=false keeps
+# only jobs never clocked in, serviceDate range is inclusive. Invoiced jobs are never deleted, and at
+# least one filter is required so a bare DELETE /job can't empty the table.
+@app.delete("/job", tags=["Job"])
+async def delete_jobs(isActive: bool = None, employeeId: int = None, customerId: int = None,
+                      serviceDateFrom: date = None, serviceDateTo: date = None, started: bool = None,
+                      db: AsyncSession = Depends(get_async_db)) -> dict:
+    query = where_equal(select(Job.jobId), (Job.isActive, isActive), (Job.employeeId, employeeId),
+                        (Job.customerId, customerId))
+    query = where_between(query, Job.serviceDate, serviceDateFrom, serviceDateTo)
+    if started is not None:
+        query = query.where(Job.clockIn.is_not(None) if started else Job.clockIn.is_(None))
+    if query.whereclause is None:
+        raise HTTPException(status_code=400, detail="At least one filter is required")
+    deleted = await delete_rows(db, Job, query.whereclause, Job.invoiceId.is_(None), returning=(Job.employeeId,))
+    await refresh_weekly_hours(db, {row.employeeId for row in deleted})
+    await db.commit()
+    return {"deleted": len(deleted), "jobIds": [row.jobId for row in deleted]}
+
+
+#
+# *** DISPATCH ***
+#
+
+
+# Orders each crew's active jobs for a day into a route.
+# Customer addresses are geocoded by the background worker (geocode.py) and only read from
+# its cache here, then a nearest neighbour route that respects arrival windows is shortened
+# with 2-opt. Jobs whose address couldn't be, or hasn't yet been, geocoded are listed under "unlocated".
+@app.get("/dispatch/{day}", tags=["Dispatch"])
+async def get_dispatch(day: date, db: AsyncSession = Depends(get_async_db)) -> dict:
+    rows = (await db.exec(
+        select(Job.jobId, Job.employeeId, Job.customerId, Job.arrivalWindow, Customer.physicalAddress)
+        .join(Customer, Job.customerId == Customer.customerId)
+        .where(Job.isActive.is_(True), Job.serviceDate == day)
+        .order_by(Job.jobId)
+    )).all()
+    jobs = [{"jobId": row.jobId, "employeeId": row.employeeId, "customerId": row.customerId,
+             "address": row.physicalAddress, "arrivalWindow": row.arrivalWindow} for row in rows]
+    coordinates = await cached_coordinates(db, {job["address"] for job in jobs})
+    # Nothing else needs the connection while the plan is solved
+    await db.close()
+    depot = (DEPOT_LAT, DEPOT_LNG) if DEPOT_LAT is not None and DEPOT_LNG is not None else None
+    # The solver is CPU bound, so it runs off the event loop
+    plan = await asyncio.to_thread(plan_dispatch, jobs, coordinates, depot)
+    return {"date": day.isoformat(), **plan}
+
+
+#
+# *** REPORTS ***
+#
+
+
+# Summary rows for months between start and end (inclusive, any day within the month)
+def report_months(model, month_column, start: date | None, end: date | None):
+    query = select_columns(model)
+    if start:
+        query = query.where(month_column >= start.replace(day=1))
+    if end:
+        query = query.where(month_column <= end.replace(day=1))
+    return query
+
+
+# Invoiced and collected totals per month of invoiceDate
+@app.get("/reports/revenue", tags=["Reports"])
+async def get_revenue_report(start: date = None, end: date = None, db: AsyncSession = Depends(get_async_db)):
+    query = report_months(RevenueSummary, RevenueSummary.month, start, end).order_by(RevenueSummary.month)
+    return FastJSONResponse(rows_as_dicts(await db.exec(query)))
+
+
+# Expense totals per month and employee (Expense.purchasedBy)
+@app.get("/reports/expenses", tags=["Reports"])
+async def get_expense_report(start: date = None, end: date = None, employeeId: int = None,
+                             db: AsyncSession = Depends(get_async_db)):
+    query = report_months(ExpenseSummary, ExpenseSummary.month, start, end)
+    query = where_equal(query, (ExpenseSummary.employeeId, employeeId))
+    return FastJSONResponse(rows_as_dicts(await db.exec(query.order_by(ExpenseSummary.month, ExpenseSummary.employeeId))))
+
+
+# Hours on the clock and their cost at Employee.laborRate, per month and employee
+@app.get("/reports/labor", tags=["Reports"])
+async def get_labor_report(start: date = None, end: date = None, employeeId: int = None,
+                           db: AsyncSession = Depends(get_async_db)):
+    query = report_months(LaborSummary, LaborSummary.month, start, end)
+    query = where_equal(query, (LaborSummary.employeeId, employeeId))
+    return FastJSONResponse(rows_as_dicts(await db.exec(query.order_by(LaborSummary.month, LaborSummary.employeeId))))
+
+
+# Unpaid invoice totals by the month they fall due
+@app.get("/reports/receivables", tags=["Reports"])
+async def get_receivables_report(db: AsyncSession = Depends(get_async_db)):
+    query = select_columns(ReceivablesSummary).order_by(ReceivablesSummary.dueMonth)
+    return FastJSONResponse(rows_as_dicts(await db.exec(query)))
+
 
+# Rebuilds the report summaries now. They're also refreshed every REPORT_REFRESH_INTERVAL seconds.
+# full=true rebuilds every month rather than just the recent ones, after back-dated edits.
+@app.post("/reports/refresh", tags=["Reports"])
+async def refresh_report_summaries(full: bool = False, db: AsyncSession = Depends(get_async_db)) -> dict:
+    refreshed = await refresh_reports(db, full=full)
+    if refreshed is None:
+        raise HTTPException(status_code=409, detail="Reports are already being refreshed")
+    return refreshed
 
-def send_email(smtp_server, smtp_port, from_email, password, subject, body, to_email):
-    # Set up the server
-    server = smtplib.SMTP(smtp_server, smtp_port)
-    server.starttls()
-    server.login(from_email, password)
 
-    # Create the email
-    msg = MIMEMultipart()
-    msg['From'] = from_email
-    msg['To'] = to_email
-    msg['Subject'] = subject
-    msg.attach(MIMEText(body, 'plain'))
+#
+# *** PAYROLL ***
+#
+
+
+# Hours, overtime and labor cost for each employee for the Monday to Sunday week containing `week`
+@app.get("/payroll/{week}", tags=["Payroll"])
+async def get_payroll(week: date, db: AsyncSession = Depends(get_async_db)):
+    return FastJSONResponse(await weekly_payroll(db, week))
+
+
+#
+# *** DIAGNOSTICS ***
+#
+
+
+# Connection pool usage for sizing workers against Postgres max_connections
+@app.get("/debug/pool", tags=["Diagnostics"])
+async def get_pool_status() -> dict:
+    return pool_stats.snapshot()
+
+
+# Hit and miss counts for the payment and reference table caches
+@app.get("/debug/cache", tags=["Diagnostics"])
+async def get_cache_stats() -> dict:
+    return {"payments": payments_cache.stats(), "reference": reference_cache.stats()}
 
-    # Send the email
-    server.send_message(msg)
-    server.quit()
+
+# Slow-query log and N+1 detector settings, with the most recent statements each one flagged
+@app.get("/debug/queries", tags=["Diagnostics"])
+async def get_query_diagnostics() -> dict:
+    return {**query_diagnostics.settings(), "slowQueries": list(query_diagnostics.slow_queries),
+            "repeatedQueries": list(query_diagnostics.repeated_queries)}
+
+
+# Switches query diagnostics on or off and tunes them without a restart. Only the given settings change.
+@app.put("/debug/queries", tags=["Diagnostics"])
+async def update_query_diagnostics(enabled: bool = None, slowMs: float = Query(default=None, ge=0),
+                                   sampleRate: float = Query(default=None, ge=0, le=1),
+                                   repeatThreshold: int = Query(default=None, ge=2)) -> dict:
+    for name, value in (("enabled", enabled), ("slow_ms", slowMs), ("sample_rate", sampleRate),
+                        ("repeat_threshold", repeatThreshold)):
+        if value is not None:
+            setattr(query_diagnostics, name, value)
+    return query_diagnostics.settings()
+
+
+# Request latency, SQL time and query counts per route, and Square/SMTP call times, for Prometheus to scrape
+@app.get("/metrics", tags=["Diagnostics"], response_class=PlainTextResponse)
+async def get_metrics() -> PlainTextResponse:
+    return PlainTextResponse(render(), media_type="text/plain; version=0.0.4")
+
+
+# Samples the event loop's stack for `seconds` while requests carry on, and returns the collapsed
+# stacks for a flame graph (e.g. flamegraph.pl or speedscope). Only available with PROFILER_ENABLED.
+@app.get("/debug/profile", tags=["Diagnostics"], response_class=PlainTextResponse)
+async def get_profile(seconds: float = Query(default=5, gt=0), interval: float = Query(default=0.005, ge=0.001, le=1)):
+    if not PROFILER_ENABLED:
+        raise HTTPException(status_code=404, detail="Profiler is disabled, set PROFILER_ENABLED=True")
+    if seconds > PROFILER_MAX_SECONDS:
+        raise HTTPException(status_code=400, detail=f"seconds can be at most {PROFILER_MAX_SECONDS}")
+    return PlainTextResponse(await profile_event_loop(seconds, interval))
 
 
 #########################################################
@@ -496,22 +924,57 @@ def send_email(smtp_server, smtp_port, from_email, password, subject, body, to_e
 
 
 #Retrieves a list of payments taken by the account making the request.
+# Every page is followed through Square's cursor and streamed out as a JSON array as it arrives.
+# Finished listings are cached for SQUARE_CACHE_TTL seconds per set of query parameters.
 @app.get("/payments", tags=["Square Payment"])
-async def list_payments():
-    response = requests.get(url=f"{URL}/payments", headers=headers)
+async def list_payments(begin_time: str = None, end_time: str = None, location_id: str = None,
+                        square: SquareClient = Depends(get_square)):
+    params = {"begin_time": begin_time, "end_time": end_time, "location_id": location_id}
+    params = {key: value for key, value in params.items() if value is not None}
+    cache_key = tuple(sorted(params.items()))
+
+    payments = payments_cache.get(cache_key)
+    if payments is not None:
+        return payments
+
+    response = await square.get("/payments", params=params)
 
     if response.status_code == 200:
-        payments = response.json()['payments']
-        print(payments)
-        return payments
+        first_page = response.json()
+        # A single page is returned whole, only longer listings are streamed
+        if not first_page.get("cursor"):
+            payments = first_page.get("payments", [])
+            payments_cache.set(cache_key, payments)
+            return payments
+        pages = square.paginate("/payments", "payments", params, first_page=first_page)
+        return StreamingResponse(stream_payments(pages, cache_key), media_type="application/json")
     else:
-        print(f"Error: {response.status_code}, {response.text}")
+        logger.warning("Square payments listing failed: %s %s", response.status_code, response.text)
         raise HTTPException(status_code=404, detail="Payment not found")
 
+
+# The 200 status has already been sent by the time a later page fails, so the array is closed with
+# a final {"error": ...} element instead, and the incomplete listing isn't cached.
+async def stream_payments(pages, cache_key):
+    payments = []
+    yield b"["
+    try:
+        async for page in pages:
+            for payment in page:
+                yield (b"," if payments else b"") + dumps(payment)
+                payments.append(payment)
+    except (httpx.HTTPStatusError, HTTPException) as error:
+        logger.warning("Square payments listing failed after %d payments: %s", len(payments), error)
+        yield (b"," if payments else b"") + dumps({"error": "Square stopped responding, the listing is incomplete"})
+        yield b"]"
+        return
+    yield b"]"
+    payments_cache.set(cache_key, payments)
+
 # Gets a Payment by ID
 @app.get("/payments/{payment_id}", tags=["Square Payment"])
-async def GetPayment(payment_id: str) -> dict:
-    response = requests.get(url=f"{URL}/payments/{payment_id}", headers=headers)
+async def GetPayment(payment_id: str, square: SquareClient = Depends(get_square)) -> dict:
+    response = await square.get(f"/payments/{payment_id}")
     
     if response.status_code == 200:
         return response.json()
@@ -521,7 +984,8 @@ async def GetPayment(payment_id: str) -> dict:
 
 # Creates a Payment in Square. Dollar amount is in cents. 100 = $1.00
 @app.post("/payments", tags=["Square Payment"])
-async def create_payment(amount: int, source_id: str, idempotency_key: str):
+async def create_payment(amount: int, source_id: str, idempotency_key: str,
+                         square: SquareClient = Depends(get_square)):
     payload = {
         "source_id": source_id,
         "idempotency_key": idempotency_key,
@@ -531,10 +995,10 @@ async def create_payment(amount: int, source_id: str, idempotency_key: str):
         }
     }
 
-    url = f"{URL}/payments"
-    response = requests.post(url, json=payload, headers=headers)
+    response = await square.post("/payments", json=payload)
 
     if response.status_code == 200:
+        payments_cache.clear()
         return response.json()
     else:
         error_detail = response.json()["errors"][0]["detail"] if "errors" in response.json() else response.text
@@ -0,0 +1,177 @@
+import threading
+import time
+from bisect import bisect_left
+from collections import Counter as StatementCounter
+from contextlib import contextmanager
+from contextvars import ContextVar
+from dataclasses import dataclass
+
+from query_log import query_diagnostics
+
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+QUERY_COUNT_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50, 100)
+
+
+def escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def format_labels(names: tuple[str, ...], values: tuple, extra: str = "") -> str:
+    pairs = [f'{name}="{escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+# Minimal Prometheus metrics, rendered in the text exposition format by render().
+# Observations can come from the event loop and worker threads, so updates take a lock.
+class Counter:
+    kind = "counter"
+
+    def __init__(self, name: str, documentation: str, labels: tuple[str, ...] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labels = labels
+        self._values: dict = {}
+        self._lock = threading.Lock()
+        REGISTRY.append(self)
+
+    def inc(self, amount: float = 1, **labels):
+        key = tuple(labels[name] for name in self.labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def samples(self):
+        with self._lock:
+            for key, value in self._values.items():
+                yield f"{self.name}{format_labels(self.labels, key)} {value}"
+
+
+class Histogram:
+    kind = "histogram"
+
+    def __init__(self, name: str, documentation: str, labels: tuple[str, ...] = (), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labels = labels
+        self.buckets = tuple(buckets)
+        self._values: dict = {}  # labels -> [count per bucket..., +Inf count, sum]
+        self._lock = threading.Lock()
+        REGISTRY.append(self)
+
+    def observe(self, value: float, **labels):
+        key = tuple(labels[name] for name in self.labels)
+        with self._lock:
+            counts = self._values.setdefault(key, [0] * (len(self.buckets) + 2))
+            counts[bisect_left(self.buckets, value)] += 1
+            counts[-1] += value
+
+    def samples(self):
+        with self._lock:
+            for key, counts in self._values.items():
+                cumulative = 0
+                for bound, count in zip((*self.buckets, "+Inf"), counts):
+                    cumulative += count
+                    le = f'le="{bound}"'
+                    yield f"{self.name}_bucket{format_labels(self.labels, key, le)} {cumulative}"
+                yield f"{self.name}_count{format_labels(self.labels, key)} {cumulative}"
+                yield f"{self.name}_sum{format_labels(self.labels, key)} {counts[-1]}"
+
+
+REGISTRY: list = []
+
+
+def render() -> str:
+    lines = []
+    for metric in REGISTRY:
+        lines.append(f"# HELP {metric.name} {metric.documentation}")
+        lines.append(f"# TYPE {metric.name} {metric.kind}")
+        lines.extend(metric.samples())
+    return "\n".join(lines) + "\n"
+
+
+request_seconds = Histogram("http_request_duration_seconds", "Time to serve a request, including the response body",
+                            ("method", "route", "status"))
+request_db_seconds = Histogram("http_request_db_seconds", "Time a request spent running SQL",
+                               ("method", "route"))
+request_queries = Histogram("http_request_db_queries", "SQL statements run by a request",
+                            ("method", "route"), buckets=QUERY_COUNT_BUCKETS)
+external_seconds = Histogram("external_call_duration_seconds", "Time spent calling Square and the SMTP server",
+                             ("service", "operation", "outcome"))
+db_queries = Counter("db_queries_total", "SQL statements run, inside and outside requests")
+db_seconds = Counter("db_query_seconds_total", "Time spent running SQL, inside and outside requests")
+
+
+# SQL time and statement count for the request being served. `statements` counts each
+# distinct statement when the request is sampled for N+1 detection (see query_log.py).
+@dataclass
+class RequestStats:
+    db_seconds: float = 0.0
+    queries: int = 0
+    statements: StatementCounter | None = None
+
+
+current_request: ContextVar[RequestStats | None] = ContextVar("current_request", default=None)
+
+
+# Called from the cursor events in database.py for every statement
+def record_query(seconds: float, statement: str):
+    db_queries.inc()
+    db_seconds.inc(seconds)
+    stats = current_request.get()
+    if stats is not None:
+        stats.db_seconds += seconds
+        stats.queries += 1
+        if stats.statements is not None:
+            stats.statements[statement] += 1
+
+
+# Times a call to another service. outcome is "error" when the block raises.
+@contextmanager
+def external_call(service: str, operation: str):
+    start = time.perf_counter()
+    outcome = "ok"
+    try:
+        yield
+    except BaseException:
+        outcome = "error"
+        raise
+    finally:
+        external_seconds.observe(time.perf_counter() - start, service=service, operation=operation, outcome=outcome)
+
+
+# Records latency, SQL time and statement count for every HTTP request, labelled by the
+# route's path template (/job/{JobId}) so ids don't turn into separate series.
+# Added last so it sits outside the other middleware and times the whole response.
+class MetricsMiddleware:
+    def __init__(self, app, exclude_paths: tuple[str, ...] = ("/metrics",)):
+        self.app = app
+        self.exclude_paths = exclude_paths
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope["path"].startswith(self.exclude_paths):
+            await self.app(scope, receive, send)
+            return
+        stats = RequestStats(statements=query_diagnostics.sample_request())
+        token = current_request.set(stats)
+        status = 500
+        start = time.perf_counter()
+
+        async def send_wrapper(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            current_request.reset(token)
+            route = getattr(scope.get("route"), "path", None) or "unmatched"
+            method = scope["method"]
+            request_seconds.observe(time.perf_counter() - start, method=method, route=route, status=status)
+            request_db_seconds.observe(stats.db_seconds, method=method, route=route)
+            request_queries.observe(stats.queries, method=method, route=route)
+            if stats.statements:
+                query_diagnostics.report_repeats(method, route, stats.statements)
@@ -0,0 +1,158 @@
+import asyncio
+import logging
+import smtplib
+from datetime import timedelta
+from email.mime.multipart import MIMEMultipart
+from email.mime.text import MIMEText
+
+from decouple import config
+from sqlmodel import select, update
+from sqlmodel.ext.asyncio.session import AsyncSession
+
+from database import async_engine
+from metrics import external_call
+from schema import EmailOutbox, Invoice, utcnow
+
+
+logger = logging.getLogger(__name__)
+
+SMTP_SERVER = config("SMTP_SERVER", default="smtp.gmail.com")
+SMTP_PORT = config("SMTP_PORT", default=587, cast=int)
+SMTP_USER = config("SMTP_USER", default="")
+SMTP_PASSWORD = config("SMTP_PASSWORD", default="")
+SMTP_STARTTLS = config("SMTP_STARTTLS", default=True, cast=bool)
+EMAIL_FROM = config("EMAIL_FROM", default=SMTP_USER)
+
+OUTBOX_WORKER = config("OUTBOX_WORKER", default=True, cast=bool)
+OUTBOX_BATCH_SIZE = config("OUTBOX_BATCH_SIZE", default=50, cast=int)
+OUTBOX_POLL_INTERVAL = config("OUTBOX_POLL_INTERVAL", default=5, cast=float)
+OUTBOX_MAX_ATTEMPTS = config("OUTBOX_MAX_ATTEMPTS", default=5, cast=int)
+OUTBOX_RETRY_DELAY = config("OUTBOX_RETRY_DELAY", default=30, cast=float)
+
+
+# Holds one authenticated SMTP session open and sends every message through it,
+# reconnecting only when the server drops the connection.
+class SmtpSender:
+    def __init__(self, smtp_factory=smtplib.SMTP):
+        self.smtp_factory = smtp_factory
+        self._server = None
+
+    def _connect(self):
+        server = self.smtp_factory(SMTP_SERVER, SMTP_PORT)
+        if SMTP_STARTTLS:
+            server.starttls()
+        if SMTP_USER:
+            server.login(SMTP_USER, SMTP_PASSWORD)
+        self._server = server
+
+    def send(self, msg):
+        with external_call("smtp", "send"):
+            if self._server is None:
+                self._connect()
+            try:
+                self._server.send_message(msg)
+            except smtplib.SMTPServerDisconnected:
+                self._server = None
+                self._connect()
+                self._server.send_message(msg)
+
+    # Sends each message, returning None for a delivered message or the error that stopped it
+    def send_many(self, messages) -> list[Exception | None]:
+        results = []
+        for msg in messages:
+            try:
+                self.send(msg)
+                results.append(None)
+            except smtplib.SMTPServerDisconnected as error:
+                self._server = None
+                results.append(error)
+            except (smtplib.SMTPException, OSError) as error:
+                results.append(error)
+        return results
+
+    def close(self):
+        if self._server is not None:
+            try:
+                self._server.quit()
+            except (smtplib.SMTPException, OSError):
+                pass
+            self._server = None
+
+
+def build_message(email: EmailOutbox) -> MIMEMultipart:
+    msg = MIMEMultipart()
+    msg['From'] = EMAIL_FROM
+    msg['To'] = email.toEmail
+    msg['Subject'] = email.subject
+    msg.attach(MIMEText(email.body, 'plain'))
+    return msg
+
+
+# Adds an email to the outbox. It's sent once the caller commits and the worker picks it up.
+def queue_email(db: AsyncSession, to_email: str, subject: str, body: str, invoice_id: int | None = None) -> EmailOutbox:
+    email = EmailOutbox(toEmail=to_email, subject=subject, body=body, invoiceId=invoice_id)
+    db.add(email)
+    return email
+
+
+# Sends one batch of due emails and records the outcome of each.
+# Returns how many emails were picked up so the worker knows whether to keep going.
+async def deliver_batch(db: AsyncSession, sender: SmtpSender, batch_size: int = OUTBOX_BATCH_SIZE) -> int:
+    now = utcnow()
+    # SKIP LOCKED lets several workers drain the outbox without sending anything twice
+    emails = (await db.exec(
+        select(EmailOutbox)
+        .where(EmailOutbox.status == "pending", EmailOutbox.nextAttemptAt <= now)
+        .order_by(EmailOutbox.emailId)
+        .limit(batch_size)
+        .with_for_update(skip_locked=True)
+    )).all()
+    if not emails:
+        return 0
+
+    results = await asyncio.to_thread(sender.send_many, [build_message(email) for email in emails])
+
+    invoice_ids = []
+    for email, error in zip(emails, results):
+        email.attempts += 1
+        if error is None:
+            email.status = "sent"
+            email.sentAt = now
+            email.lastError = None
+            if email.invoiceId is not None:
+                invoice_ids.append(email.invoiceId)
+        else:
+            email.lastError = str(error)
+            if email.attempts >= OUTBOX_MAX_ATTEMPTS:
+                email.status = "failed"
+            else:
+                email.nextAttemptAt = now + timedelta(seconds=OUTBOX_RETRY_DELAY * 2 ** (email.attempts - 1))
+        db.add(email)
+
+    if invoice_ids:
+        await db.exec(update(Invoice).where(Invoice.invoiceId.in_(invoice_ids)).values(emailStatus=True))
+    await db.commit()
+    return len(emails)
+
+
+# Drains the outbox until `stop` is set. The SMTP session stays open while there is
+# mail to send and is closed once the outbox is empty.
+async def run_outbox_worker(stop: asyncio.Event, sender: SmtpSender | None = None):
+    sender = sender or SmtpSender()
+    try:
+        while not stop.is_set():
+            try:
+                async with AsyncSession(async_engine, expire_on_commit=False) as db:
+                    picked_up = await deliver_batch(db, sender)
+            except Exception:
+                logger.exception("Outbox delivery failed")
+                picked_up = 0
+            if picked_up < OUTBOX_BATCH_SIZE:
+                if picked_up == 0:
+                    await asyncio.to_thread(sender.close)
+                try:
+                    await asyncio.wait_for(stop.wait(), timeout=OUTBOX_POLL_INTERVAL)
+                except asyncio.TimeoutError:
+                    pass
+    finally:
+        await asyncio.to_thread(sender.close)
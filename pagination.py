@@ -0,0 +1,72 @@
+from fastapi import HTTPException
+from fastapi.responses import StreamingResponse
+from sqlmodel import and_, or_, select
+from sqlmodel.ext.asyncio.session import AsyncSession
+
+from fast_json import dumps
+
+
+MAX_PAGE_SIZE = 1000
+STREAM_CHUNK_SIZE = 500
+
+
+# Parses ?sort=column (ascending) or ?sort=-column (descending) against the columns a route allows
+def parse_sort(sort: str | None, columns: dict):
+    if not sort:
+        return None
+    descending = sort.startswith("-")
+    name = sort.lstrip("-")
+    if name not in columns:
+        raise HTTPException(status_code=400, detail=f"Cannot sort by {name}. Options: {', '.join(columns)}")
+    return columns[name], descending
+
+
+# Orders a query and returns the rows after the `after` cursor, which is always a primary key.
+# Keyset pagination stays fast on deep pages because the database seeks straight
+# to the cursor through an index instead of counting past an OFFSET.
+# When sorting by another column the primary key breaks ties, and the cursor row's
+# sort value is looked up so the page starts right after it. NULLs sort last.
+async def keyset_page(db: AsyncSession, query, key, after: int | None = None, limit: int | None = None, sort=None):
+    column, descending = sort or (key, False)
+    if column is key:
+        query = query.order_by(key.desc() if descending else key)
+        if after is not None:
+            query = query.where(key < after if descending else key > after)
+    else:
+        order = column.desc() if descending else column.asc()
+        query = query.order_by(order.nulls_last(), key.desc() if descending else key)
+        if after is not None:
+            cursor = (await db.exec(select(key, column).where(key == after))).first()
+            if cursor is None:
+                raise HTTPException(status_code=400, detail=f"No row with id {after} to page after")
+            value = cursor[1]
+            after_key = key < after if descending else key > after
+            if value is None:
+                query = query.where(and_(column.is_(None), after_key))
+            else:
+                past_value = column < value if descending else column > value
+                query = query.where(or_(past_value, and_(column == value, after_key), column.is_(None)))
+    if limit is not None:
+        query = query.limit(limit)
+    return query
+
+
+# Streams query results as newline delimited JSON, one row per line.
+# yield_per fetches rows from a server-side cursor in chunks so memory stays flat.
+# A select of columns is written straight from the row tuples. For a select of
+# ORM objects, `to_json` turns each object into its JSON line as bytes.
+async def stream_ndjson(db: AsyncSession, query, chunk_size: int = STREAM_CHUNK_SIZE, to_json=None) -> StreamingResponse:
+    query = query.execution_options(yield_per=chunk_size)
+    if to_json is None:
+        result = await db.stream(query)
+        keys = list(result.keys())
+        to_line = lambda row: dumps(dict(zip(keys, row)))
+    else:
+        result = await db.stream_scalars(query)
+        to_line = to_json
+
+    async def rows():
+        async for chunk in result.partitions():
+            yield b"".join(to_line(row) + b"\n" for row in chunk)
+
+    return StreamingResponse(rows(), media_type="application/x-ndjson")
@@ -0,0 +1,76 @@
+from functools import lru_cache
+from typing import Annotated
+
+from fastapi import HTTPException
+from fastapi.exceptions import RequestValidationError
+from pydantic import TypeAdapter, ValidationError
+from sqlalchemy import update
+from sqlmodel import select
+from sqlmodel.ext.asyncio.session import AsyncSession
+
+from bulk import previous_from, previous_returning, previous_values, primary_key, reads_first
+
+
+# Counts the writes to a row, for optimistic concurrency
+VERSION = "version"
+
+
+@lru_cache(maxsize=None)
+def field_adapter(model, name: str) -> TypeAdapter:
+    info = model.model_fields[name]
+    return TypeAdapter(Annotated[info.annotation, info])
+
+
+# Validates each field of a sparse PATCH body on its own, since there's no full object to validate.
+# The primary key and version can't be changed, and fields that aren't columns are rejected.
+def validate_changes(model, changes: dict) -> dict:
+    key = primary_key(model)
+    values, errors = {}, []
+    for name, value in changes.items():
+        if name == VERSION:
+            continue
+        if name == key.name or name not in model.model_fields or name not in model.__table__.columns:
+            errors.append({"type": "extra_forbidden", "loc": ("body", name), "msg": "Field can't be changed",
+                           "input": value})
+            continue
+        try:
+            values[name] = field_adapter(model, name).validate_python(value)
+        except ValidationError as error:
+            errors += [{**detail, "loc": ("body", name, *detail["loc"])}
+                       for detail in error.errors(include_url=False, include_context=False)]
+    if VERSION in changes and type(changes[VERSION]) is not int:
+        errors.append({"type": "int_type", "loc": ("body", VERSION), "msg": "Input should be a valid integer",
+                       "input": changes[VERSION]})
+    if errors:
+        raise RequestValidationError(errors)
+    if not values:
+        raise HTTPException(status_code=400, detail="No fields to update")
+    return values
+
+
+# Writes only the fields in `changes` with a single UPDATE ... RETURNING and returns the updated row,
+# along with the `previous` columns as they were before the update (see bulk.previous_values).
+# The row's version goes up by one. When `changes` carries the version the client last read, the
+# update only applies if the row is still at that version, otherwise it's refused with a 409.
+# The caller commits.
+async def partial_update(db: AsyncSession, model, key_value, changes: dict, previous=()) -> tuple[dict, dict]:
+    values = validate_changes(model, changes)
+    table = model.__table__
+    key = primary_key(model)
+    statement = (update(table).where(key == key_value)
+                 .values(**values, **{VERSION: table.c[VERSION] + 1})
+                 .returning(*table.columns))
+    if VERSION in changes:
+        statement = statement.where(table.c[VERSION] == changes[VERSION])
+    if previous:
+        before = previous_values(model, key_value, previous)
+        statement = statement.where(reads_first(before)).returning(*previous_returning(before))
+    row = (await db.exec(statement)).mappings().first()
+    if row is not None:
+        return {column.name: row[column.name] for column in table.columns}, previous_from(row, previous)
+    # Only reached when nothing was updated, to tell a missing row from a stale version
+    current = (await db.exec(select(table.c[VERSION]).where(key == key_value))).first()
+    if current is None:
+        raise HTTPException(status_code=404, detail=f"{model.__name__} not found")
+    raise HTTPException(status_code=409, detail=f"{model.__name__} was changed by someone else, it's now at version "
+                                                f"{current}")
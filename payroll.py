@@ -0,0 +1,96 @@
+from datetime import date, datetime, time, timedelta
+from decimal import ROUND_HALF_UP, Decimal
+
+from decouple import config
+from sqlalchemy import Float, Integer, and_, cast, func, literal_column, update
+from sqlmodel import select
+from sqlmodel.ext.asyncio.session import AsyncSession
+
+from schema import Employee, Job
+
+
+OVERTIME_AFTER_HOURS = config("OVERTIME_AFTER_HOURS", default=40, cast=float)
+OVERTIME_MULTIPLIER = config("OVERTIME_MULTIPLIER", default="1.5", cast=Decimal)
+
+CENTS = Decimal("0.01")
+
+
+# Hours from one clock time to another, in SQL. SQLite counts whole seconds, since
+# julianday differences pick up floating point error (2.4999999 hours for 2:30).
+def hours_between(db: AsyncSession, start, end):
+    if db.bind.dialect.name == "sqlite":
+        return (cast(func.strftime("%s", end), Integer) - cast(func.strftime("%s", start), Integer)) / 3600.0
+    return func.extract("epoch", end - start) / 3600
+
+
+def job_hours(db: AsyncSession):
+    return cast(hours_between(db, Job.clockIn, Job.clockOut), Float)
+
+
+# Monday 00:00 of the week `day` falls in, and the Monday after
+def week_bounds(day: date) -> tuple[datetime, datetime]:
+    monday = datetime.combine(day - timedelta(days=day.weekday()), time.min)
+    return monday, monday + timedelta(days=7)
+
+
+# Closed jobs (clocked in and out) that started within [start, end)
+def closed_jobs_between(start: datetime, end: datetime) -> list:
+    return [Job.clockIn >= start, Job.clockIn < end, Job.clockOut.is_not(None)]
+
+
+# Hours and pay for every employee for the week `day` falls in, from one grouped query.
+# Hours past OVERTIME_AFTER_HOURS are paid at OVERTIME_MULTIPLIER times the labor rate.
+async def weekly_payroll(db: AsyncSession, day: date) -> dict:
+    start, end = week_bounds(day)
+    hours = job_hours(db)
+    rows = (await db.exec(
+        select(Employee.empId, Employee.fName, Employee.lName, Employee.laborRate,
+               func.count(Job.jobId).label("jobs"), func.coalesce(func.sum(hours), 0).label("hours"))
+        .select_from(Employee)
+        .outerjoin(Job, and_(Job.employeeId == Employee.empId, *closed_jobs_between(start, end)))
+        .group_by(Employee.empId, Employee.fName, Employee.lName, Employee.laborRate)
+        .order_by(Employee.empId)
+    )).all()
+
+    employees = []
+    for row in rows:
+        worked = Decimal(str(round(row.hours, 2)))
+        regular = min(worked, Decimal(str(OVERTIME_AFTER_HOURS)))
+        overtime = worked - regular
+        rate = Decimal(str(row.laborRate))
+        pay = (regular * rate + overtime * rate * OVERTIME_MULTIPLIER).quantize(CENTS, rounding=ROUND_HALF_UP)
+        employees.append({"empId": row.empId, "fName": row.fName, "lName": row.lName, "laborRate": row.laborRate,
+                          "jobs": row.jobs, "hours": float(worked), "regularHours": float(regular),
+                          "overtimeHours": float(overtime), "laborCost": pay})
+    return {
+        "weekStart": start.date().isoformat(),
+        "weekEnd": (end - timedelta(days=1)).date().isoformat(),
+        "employees": employees,
+        "totalHours": float(sum(Decimal(str(employee["hours"])) for employee in employees)),
+        "totalCost": sum((employee["laborCost"] for employee in employees), Decimal("0.00")),
+    }
+
+
+# Sets Employee.weeklyHours to the hours on closed jobs so far this week, for just the given
+# employees (every employee when None), with a single UPDATE whose correlated subquery uses
+# the job employeeId and clockIn indexes. Called whenever jobs are written, so the column
+# follows jobs as they close instead of being kept by hand. Only rows whose hours change are written,
+# and their version goes up like any other write, so a PATCH holding the old version gets a 409.
+async def refresh_weekly_hours(db: AsyncSession, employee_ids: set | None = None, today: date | None = None):
+    if employee_ids is not None:
+        employee_ids = {employee_id for employee_id in employee_ids if employee_id is not None}
+        if not employee_ids:
+            return
+    start, end = week_bounds(today or date.today())
+    hours = (
+        select(func.coalesce(func.sum(job_hours(db)), literal_column("0")))
+        .where(Job.employeeId == Employee.empId, *closed_jobs_between(start, end))
+        .scalar_subquery()
+    )
+    statement = (update(Employee)
+                 .values(weeklyHours=hours, version=Employee.version + 1)
+                 .where(Employee.weeklyHours.is_distinct_from(hours))
+                 .execution_options(synchronize_session=False))
+    if employee_ids is not None:
+        statement = statement.where(Employee.empId.in_(employee_ids))
+    await db.exec(statement)
@@ -0,0 +1,59 @@
+import asyncio
+import sys
+import threading
+from collections import Counter
+
+from decouple import config
+
+
+# The profiler samples the event loop's stack, so it stays off unless asked for
+PROFILER_ENABLED = config("PROFILER_ENABLED", default=False, cast=bool)
+PROFILER_MAX_SECONDS = config("PROFILER_MAX_SECONDS", default=60, cast=float)
+
+
+def stack_of(frame) -> str:
+    names = []
+    while frame is not None:
+        code = frame.f_code
+        names.append(f"{code.co_name} ({code.co_filename.rsplit('/', 1)[-1]}:{frame.f_lineno})")
+        frame = frame.f_back
+    return ";".join(reversed(names))
+
+
+# Samples one thread's Python stack every `interval` seconds from a background thread and counts
+# how often each stack was seen. The result is in collapsed stack format ("a;b;c 12" per line),
+# which flamegraph.pl and speedscope read. Idle time shows up as the event loop's select() call.
+class SamplingProfiler:
+    def __init__(self, thread_id: int, interval: float = 0.005):
+        self.thread_id = thread_id
+        self.interval = interval
+        self.samples: Counter = Counter()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="sampling-profiler", daemon=True)
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            if frame is not None:
+                self.samples[stack_of(frame)] += 1
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+
+    def collapsed(self) -> str:
+        return "".join(f"{stack} {count}\n" for stack, count in self.samples.most_common())
+
+
+# Profiles the calling event loop thread for `seconds` while it keeps serving requests
+async def profile_event_loop(seconds: float, interval: float) -> str:
+    profiler = SamplingProfiler(threading.get_ident(), interval)
+    profiler.start()
+    try:
+        await asyncio.sleep(seconds)
+    finally:
+        profiler.stop()
+    return profiler.collapsed()
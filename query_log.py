@@ -0,0 +1,92 @@
+import logging
+import random
+import time
+from collections import Counter, deque
+
+from decouple import config
+
+
+logger = logging.getLogger(__name__)
+
+QUERY_DIAGNOSTICS = config("QUERY_DIAGNOSTICS", default=False, cast=bool)
+SLOW_QUERY_MS = config("SLOW_QUERY_MS", default=250, cast=float)
+# Share of requests whose statements are counted to spot N+1 patterns
+QUERY_SAMPLE_RATE = config("QUERY_SAMPLE_RATE", default=0.1, cast=float)
+# Identical statements in one request before it's reported as a likely N+1
+N_PLUS_ONE_THRESHOLD = config("N_PLUS_ONE_THRESHOLD", default=5, cast=int)
+
+EXPLAINABLE = ("select", "with", "insert", "update", "delete")
+MAX_LOGGED_PARAMETERS = 500
+
+
+# Slow-query log and N+1 detector, switched on and tuned at runtime through /debug/queries.
+# When off, each statement costs one attribute check. When on, every statement is compared
+# with the slow threshold, slow ones are explained, and a sample of requests count their
+# statements so the same SQL repeated many times in one request gets flagged.
+class QueryDiagnostics:
+    def __init__(self, enabled: bool = QUERY_DIAGNOSTICS, slow_ms: float = SLOW_QUERY_MS,
+                 sample_rate: float = QUERY_SAMPLE_RATE, repeat_threshold: int = N_PLUS_ONE_THRESHOLD):
+        self.enabled = enabled
+        self.slow_ms = slow_ms
+        self.sample_rate = sample_rate
+        self.repeat_threshold = repeat_threshold
+        self.slow_queries: deque = deque(maxlen=50)
+        self.repeated_queries: deque = deque(maxlen=50)
+
+    def settings(self) -> dict:
+        return {"enabled": self.enabled, "slowMs": self.slow_ms, "sampleRate": self.sample_rate,
+                "repeatThreshold": self.repeat_threshold}
+
+    # A fresh statement counter when this request is sampled, otherwise None
+    def sample_request(self) -> Counter | None:
+        if self.enabled and random.random() < self.sample_rate:
+            return Counter()
+        return None
+
+    # Called from the cursor events in database.py once a statement has run
+    def check_statement(self, conn, statement: str, parameters, context, executemany: bool, seconds: float):
+        if seconds * 1000 < self.slow_ms:
+            return
+        plan = None
+        if not executemany and not getattr(context, "is_server_side", False):
+            plan = explain(conn, statement, parameters)
+        shown = repr(parameters)[:MAX_LOGGED_PARAMETERS]
+        self.slow_queries.append({"ms": round(seconds * 1000, 1), "statement": statement, "parameters": shown,
+                                  "plan": plan, "at": time.time()})
+        logger.warning("Slow query (%.1f ms): %s\nparameters: %s\nplan:\n%s", seconds * 1000, statement, shown, plan)
+
+    # Logs statements a sampled request ran at least repeat_threshold times
+    def report_repeats(self, method: str, route: str, statements: Counter):
+        for statement, count in statements.items():
+            if count >= self.repeat_threshold:
+                self.repeated_queries.append({"route": f"{method} {route}", "count": count, "statement": statement,
+                                              "at": time.time()})
+                logger.warning("Possible N+1 in %s %s: ran %d times: %s", method, route, count, statement)
+
+
+# Runs EXPLAIN for a statement on the connection that just ran it, through a separate DBAPI
+# cursor so it doesn't fire the cursor events again. Returns the plan as text, or None.
+def explain(conn, statement: str, parameters) -> str | None:
+    if not statement.lstrip().lower().startswith(EXPLAINABLE):
+        return None
+    sqlite = conn.dialect.name == "sqlite"
+    cursor = conn.connection.dbapi_connection.cursor()
+    try:
+        # On Postgres a failed EXPLAIN would abort the request's transaction, so it runs in a savepoint
+        if not sqlite:
+            cursor.execute("SAVEPOINT query_log_explain")
+        try:
+            cursor.execute(("EXPLAIN QUERY PLAN " if sqlite else "EXPLAIN ") + statement, parameters)
+            rows = cursor.fetchall()
+        except Exception as error:
+            if not sqlite:
+                cursor.execute("ROLLBACK TO SAVEPOINT query_log_explain")
+            return f"EXPLAIN failed: {error}"
+        if not sqlite:
+            cursor.execute("RELEASE SAVEPOINT query_log_explain")
+    finally:
+        cursor.close()
+    return "\n".join(str(row[-1]) if len(row) > 1 else str(row[0]) for row in rows)
+
+
+query_diagnostics = QueryDiagnostics()
@@ -0,0 +1,111 @@
+import asyncio
+import logging
+from datetime import date, datetime, time
+
+from decouple import config
+from sqlalchemy import Date, Numeric, case, cast, delete, func, insert, literal, literal_column, not_
+from sqlmodel import select
+from sqlmodel.ext.asyncio.session import AsyncSession
+
+from database import async_engine, try_advisory_lock
+from payroll import job_hours, refresh_weekly_hours
+from scheduling import add_months
+from schema import (Employee, ExpenseSummary, Expense, Invoice, Job, LaborSummary, ReceivablesSummary,
+                    RevenueSummary, utcnow)
+
+
+logger = logging.getLogger(__name__)
+
+REPORTS_WORKER = config("REPORTS_WORKER", default=True, cast=bool)
+REPORT_REFRESH_INTERVAL = config("REPORT_REFRESH_INTERVAL", default=900, cast=float)
+# How many recent months an incremental refresh rebuilds. Edits older than this need a full refresh.
+REPORT_REFRESH_MONTHS = config("REPORT_REFRESH_MONTHS", default=3, cast=int)
+
+
+# First day of the month a date or timestamp falls in. The unit is inlined rather than bound
+# so the expression in GROUP BY is identical to the one selected.
+def month_start(db: AsyncSession, column):
+    if db.bind.dialect.name == "sqlite":
+        return func.date(column, literal_column("'start of month'"))
+    return cast(func.date_trunc(literal_column("'month'"), column), Date)
+
+
+def money_sum(expression):
+    return cast(func.coalesce(func.sum(expression), 0), Numeric(12, 2))
+
+
+# Replaces the summary rows from `since` onwards (all rows when since is None) with a fresh aggregate
+async def rebuild(db: AsyncSession, summary, month_column, query, columns: list[str], since: date | None):
+    clear = delete(summary)
+    if since is not None:
+        clear = clear.where(month_column >= since)
+    await db.exec(clear)
+    await db.exec(insert(summary).from_select(columns, query))
+
+
+# Rebuilds the report summaries with set-based INSERT ... SELECT statements in one transaction.
+# An incremental refresh only aggregates the last REPORT_REFRESH_MONTHS months, which the indexes on
+# invoiceDate, expenseDate and clockIn turn into range scans. Receivables are always rebuilt in full
+# from the unpaid invoices, since any old invoice can be paid off.
+# Every worker runs the refresher, so the transaction takes an advisory lock first and the refresh
+# is skipped, returning None, while another one is running.
+async def refresh_reports(db: AsyncSession, full: bool = False, today: date | None = None) -> dict | None:
+    if not await try_advisory_lock(db, "reports"):
+        await db.rollback()
+        return None
+    today = today or date.today()
+    since = None if full else add_months(today.replace(day=1), 1 - REPORT_REFRESH_MONTHS)
+    now = literal(utcnow(), RevenueSummary.__table__.c.refreshedAt.type)
+
+    month = month_start(db, Invoice.invoiceDate)
+    revenue = (select(month, money_sum(Invoice.totalEstimate),
+                      money_sum(case((Invoice.paid, Invoice.totalEstimate), else_=0)), func.count(), now)
+               .where(Invoice.invoiceDate.is_not(None)))
+    if since is not None:
+        revenue = revenue.where(Invoice.invoiceDate >= since)
+    await rebuild(db, RevenueSummary, RevenueSummary.month, revenue.group_by(month),
+                  ["month", "invoiced", "collected", "invoices", "refreshedAt"], since)
+
+    month = month_start(db, Expense.expenseDate)
+    expenses = (select(month, Expense.purchasedBy, money_sum(Expense.totalAmount), func.count(), now)
+                .where(Expense.purchasedBy.is_not(None), Expense.expenseDate.is_not(None)))
+    if since is not None:
+        expenses = expenses.where(Expense.expenseDate >= since)
+    await rebuild(db, ExpenseSummary, ExpenseSummary.month, expenses.group_by(month, Expense.purchasedBy),
+                  ["month", "employeeId", "amount", "expenses", "refreshedAt"], since)
+
+    month = month_start(db, Job.clockIn)
+    hours = job_hours(db)
+    labor = (select(month, Job.employeeId, func.sum(hours), money_sum(hours * Employee.laborRate), func.count(), now)
+             .join(Employee, Employee.empId == Job.employeeId)
+             .where(Job.clockIn.is_not(None), Job.clockOut.is_not(None)))
+    if since is not None:
+        labor = labor.where(Job.clockIn >= datetime.combine(since, time.min))
+    await rebuild(db, LaborSummary, LaborSummary.month, labor.group_by(month, Job.employeeId),
+                  ["month", "employeeId", "hours", "cost", "jobs", "refreshedAt"], since)
+
+    month = month_start(db, Invoice.dueDate)
+    receivables = (select(month, money_sum(Invoice.totalEstimate), func.count(), now)
+                   .where(not_(Invoice.paid), Invoice.dueDate.is_not(None)).group_by(month))
+    await rebuild(db, ReceivablesSummary, ReceivablesSummary.dueMonth, receivables,
+                  ["dueMonth", "outstanding", "invoices", "refreshedAt"], None)
+
+    # Job writes keep weeklyHours current, this catches the rollover to a new week
+    await refresh_weekly_hours(db, today=today)
+    await db.commit()
+    return {"since": since.isoformat() if since else None}
+
+
+# Refreshes the recent months every REPORT_REFRESH_INTERVAL seconds until `stop` is set
+async def run_report_refresher(stop: asyncio.Event):
+    while not stop.is_set():
+        try:
+            async with AsyncSession(async_engine) as db:
+                if await refresh_reports(db) is None:
+                    logger.debug("Report refresh skipped, another process is refreshing")
+        except Exception:
+            logger.exception("Report refresh failed")
+        try:
+            await asyncio.wait_for(stop.wait(), timeout=REPORT_REFRESH_INTERVAL)
+        except asyncio.TimeoutError:
+            pass
@@ -0,0 +1,125 @@
+import calendar
+import re
+from datetime import date, timedelta
+from typing import NamedTuple
+
+from decouple import config
+from sqlalchemy import func
+from sqlmodel import select
+from sqlmodel.ext.asyncio.session import AsyncSession
+
+from database import try_advisory_lock
+from schema import Customer, Frequency, Job
+
+
+SCHEDULE_HORIZON_DAYS = config("SCHEDULE_HORIZON_DAYS", default=28, cast=int)
+
+UNITS = {"day": "day", "days": "day", "week": "week", "weeks": "week", "month": "month", "months": "month"}
+NUMBERS = {"one": 1, "two": 2, "three": 3, "four": 4, "five": 5, "six": 6, "other": 2}
+NAMED = {
+    "daily": (1, "day"),
+    "weekly": (1, "week"),
+    "biweekly": (2, "week"),
+    "fortnightly": (2, "week"),
+    "semimonthly": (2, "week"),
+    "twice a month": (2, "week"),
+    "monthly": (1, "month"),
+    "bimonthly": (2, "month"),
+    "quarterly": (3, "month"),
+}
+EVERY_PATTERN = re.compile(r"^every\s+(?:(\d+|one|two|three|four|five|six|other)\s+)?(days?|weeks?|months?)$")
+
+
+# A parsed Frequency.serviceFrequency: one visit every `interval` days, weeks or months
+class Recurrence(NamedTuple):
+    interval: int
+    unit: str
+
+
+# Understands the names typed into serviceFrequency ("Weekly", "Bi-weekly", "Monthly", "Quarterly"...)
+# and "every N days/weeks/months". Anything else, including one-off work, returns None.
+def parse_frequency(text: str) -> Recurrence | None:
+    text = " ".join(text.lower().replace("-", "").split())
+    if text in NAMED:
+        return Recurrence(*NAMED[text])
+    match = EVERY_PATTERN.match(text)
+    if match:
+        count, unit = match.groups()
+        interval = NUMBERS.get(count, None) or int(count or 1)
+        if interval > 0:
+            return Recurrence(interval, UNITS[unit])
+    return None
+
+
+def add_months(day: date, months: int) -> date:
+    month = day.month - 1 + months
+    year, month = day.year + month // 12, month % 12 + 1
+    return date(year, month, min(day.day, calendar.monthrange(year, month)[1]))
+
+
+def next_visit(day: date, rule: Recurrence) -> date:
+    if rule.unit == "month":
+        return add_months(day, rule.interval)
+    return day + timedelta(days=rule.interval * (7 if rule.unit == "week" else 1))
+
+
+# Visit dates from `start` through `through` that follow on from the customer's last scheduled visit.
+# With no visit scheduled yet the first one is `start`.
+def upcoming_visits(rule: Recurrence, last: date | None, start: date, through: date) -> list[date]:
+    day = start if last is None else next_visit(last, rule)
+    while day < start:
+        day = next_visit(day, rule)
+    visits = []
+    while day <= through:
+        visits.append(day)
+        day = next_visit(day, rule)
+    return visits
+
+
+# Creates the missing jobs for every customer on a recurring frequency, up to `through`.
+# Each customer carries on from their latest scheduled job, whose arrival window and crew are reused,
+# so running it again only adds what the horizon has moved forward by. All rows go in one insert.
+# Two runs at once would both miss each other's jobs and schedule every visit twice, so the transaction
+# takes an advisory lock first and returns None while another run holds it.
+async def schedule_jobs(db: AsyncSession, start: date, through: date) -> dict | None:
+    if not await try_advisory_lock(db, "schedule"):
+        await db.rollback()
+        return None
+    customers = (await db.exec(
+        select(Customer.customerId, Frequency.serviceFrequency)
+        .join(Frequency, Customer.frequencyId == Frequency.frequencyId)
+    )).all()
+
+    ranked = (
+        select(Job.customerId, Job.serviceDate, Job.arrivalWindow, Job.employeeId,
+               func.row_number().over(partition_by=Job.customerId,
+                                      order_by=(Job.serviceDate.desc(), Job.jobId.desc())).label("recent"))
+        .where(Job.serviceDate.is_not(None))
+        .subquery()
+    )
+    latest = (await db.exec(
+        select(ranked.c.customerId, ranked.c.serviceDate, ranked.c.arrivalWindow, ranked.c.employeeId)
+        .where(ranked.c.recent == 1)
+    )).all()
+    latest = {row.customerId: row for row in latest}
+
+    rules, unrecognized, jobs, scheduled = {}, set(), [], 0
+    for customer_id, frequency in customers:
+        if frequency not in rules:
+            rules[frequency] = parse_frequency(frequency)
+        rule = rules[frequency]
+        if rule is None:
+            unrecognized.add(frequency)
+            continue
+        last = latest.get(customer_id)
+        visits = upcoming_visits(rule, last.serviceDate if last else None, start, through)
+        scheduled += bool(visits)
+        jobs += [{"customerId": customer_id, "serviceDate": day,
+                  "arrivalWindow": last.arrivalWindow if last else "", "employeeId": last.employeeId if last else None,
+                  "payment": False, "isActive": True, "comments": ""} for day in visits]
+
+    if jobs:
+        await db.exec(Job.__table__.insert(), params=jobs)
+        await db.commit()
+    return {"created": len(jobs), "customers": scheduled, "through": through.isoformat(),
+            "unrecognized": sorted(unrecognized)}
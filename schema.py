@@ -1,6 +1,15 @@
+from datetime import date, datetime, timezone
+from decimal import Decimal
+
+from pydantic import NaiveDatetime
+from sqlalchemy import Index, text
 from sqlmodel import Field, Relationship, SQLModel
 
 
+def utcnow() -> datetime:
+    return datetime.now(timezone.utc)
+
+
 class ServiceLink(SQLModel, table=True):
     serviceId: int = Field(foreign_key="services.serviceId", primary_key=True)
     jobId: int = Field(foreign_key="job.jobId", primary_key=True)
@@ -14,60 +23,78 @@ class CustomerServiceAreaLink(SQLModel, table=True):
 class Services(SQLModel, table=True):
     serviceId: int | None = Field(default=None, primary_key=True)
     service: str
+    price: Decimal = Field(default=Decimal("0.00"), max_digits=10, decimal_places=2)
+    version: int = 1
     job: 'Job' = Relationship(back_populates="servicesProvided", link_model=ServiceLink)
 
 
 class Frequency(SQLModel, table=True):
     frequencyId: int | None = Field(default=None, primary_key=True)
     serviceFrequency: str
+    version: int = 1
     customer: list['Customer'] = Relationship(back_populates="frequency")
 
 
 class ServiceArea(SQLModel, table=True):
     serviceAreaId: int | None = Field(default=None, primary_key=True)
     townServiced: str
+    version: int = 1
     customer: list['Customer'] = Relationship(back_populates="city", link_model=CustomerServiceAreaLink)
 
 
 class User(SQLModel, table=True):
     userId: int | None = Field(default=None, primary_key=True)
-    email: str
+    email: str = Field(index=True)
     empId: int | None = Field(default=None, foreign_key="employee.empId")
     customerId: int | None = Field(default=None, foreign_key="customer.customerId")
     password: str
+    version: int = 1
 
 
 class Invoice(SQLModel, table=True):
-    invoiceId: int = Field(default=None, primary_key=True)
+    # Unpaid invoices only, for the receivables report
+    __table_args__ = (
+        Index("ix_invoice_unpaid_dueDate", "dueDate", postgresql_where=text("NOT paid"), sqlite_where=text("NOT paid")),
+    )
+    invoiceId: int | None = Field(default=None, primary_key=True)
     lotSize: str
-    invoiceDate: str
-    dueDate: str
+    # Empty where the old free-text date couldn't be read when the column became a DATE
+    invoiceDate: date | None = Field(default=None, index=True)
+    dueDate: date | None = Field(default=None, index=True)
     emailStatus: bool
     productsUsed: str
     acceptedBy: str
     applyTax: bool
-    taxAmount: float
-    totalEstimate: float
+    taxAmount: Decimal = Field(max_digits=10, decimal_places=2)
+    totalEstimate: Decimal = Field(max_digits=10, decimal_places=2)
     paid: bool
+    # Goes up by one with every write, for PATCH's optimistic concurrency check
+    version: int = 1
     job: 'Job' = Relationship(back_populates="invoice")
     # many to one - many invoices can be associated to one customer
     
 
-class Customer(SQLModel, table=True):
+class CustomerBase(SQLModel):
     customerId: int | None = Field(default=None, primary_key=True)
-    jobs: list['Job'] = Relationship(back_populates="customer")
     fName: str
     lName: str
     phoneNumber: str
     email: str
     billingAddress: str
     physicalAddress: str
+    # Free text the office types in (often blank). Nothing filters or sorts on them, so unlike the
+    # invoice and expense dates they stay strings rather than forcing a format on clients.
     lastPaymentDate: str
     lastServiceDate: str
-    city: list[ServiceArea] = Relationship(back_populates="customer", link_model=CustomerServiceAreaLink)
     isResidential: bool
     comments: str
-    frequencyId: int | None = Field(default=None, foreign_key="frequency.frequencyId")
+    frequencyId: int | None = Field(default=None, foreign_key="frequency.frequencyId", index=True)
+    version: int = 1
+
+
+class Customer(CustomerBase, table=True):
+    jobs: list['Job'] = Relationship(back_populates="customer")
+    city: list[ServiceArea] = Relationship(back_populates="customer", link_model=CustomerServiceAreaLink)
     frequency: Frequency = Relationship(back_populates="customer")
 
 
@@ -75,41 +102,128 @@ class Employee(SQLModel, table=True):
     empId: int | None = Field(default=None, primary_key=True)
     fName: str
     lName: str
+    # Free text like the customer dates above
     birthDate: str
     phoneNumber: str
     email: str
     address: str
     laborRate: float
     weeklyHours: float
+    version: int = 1
     expenses: list['Expense'] = Relationship(back_populates="employee")
 
 
 class Expense(SQLModel, table=True):
     expenseId: int | None = Field(default=None, primary_key=True)
-    expenseDate: str
+    # Empty where the old free-text date couldn't be read, like the invoice dates
+    expenseDate: date | None = Field(default=None, index=True)
     store: str
     itemsPurchased: str
-    totalAmount: str
+    totalAmount: Decimal = Field(max_digits=10, decimal_places=2)
     reason: str
-    purchasedBy: int = Field(default=None, foreign_key="employee.empId")
-    linkedJob: int | None = Field(default=None, foreign_key="job.jobId")
+    purchasedBy: int = Field(default=None, foreign_key="employee.empId", index=True)
+    linkedJob: int | None = Field(default=None, foreign_key="job.jobId", index=True)
+    version: int = 1
     job: 'Job' = Relationship(back_populates='extraExpenses')
     employee: Employee = Relationship(back_populates="expenses")
     # many to one - many expenses can be associated to one employee
 
 
-class Job(SQLModel, table=True):
+class JobBase(SQLModel):
     jobId: int | None = Field(default=None, primary_key=True)
     arrivalWindow: str
-    clockIn: str
-    clockOut: str
-    employeeId: int = Field(default=None, foreign_key="employee.empId")
-    servicesProvided: list[Services] = Relationship(back_populates="job", link_model=ServiceLink)
+    # Day the visit is scheduled for, which /dispatch plans routes from
+    serviceDate: date | None = Field(default=None, index=True)
+    # Local wall clock time, empty until the crew clocks in or out
+    clockIn: NaiveDatetime | None = Field(default=None, index=True)
+    clockOut: NaiveDatetime | None = None
+    # Empty for generated jobs until a crew is assigned
+    employeeId: int | None = Field(default=None, foreign_key="employee.empId", index=True)
     payment: bool
     isActive: bool
-    comments: str
+    comments: str = ""
+    invoiceId: int | None = Field(default=None, foreign_key="invoice.invoiceId", index=True)
+    customerId: int | None = Field(default=None, foreign_key="customer.customerId", index=True)
+    version: int = 1
+
+
+class Job(JobBase, table=True):
+    servicesProvided: list[Services] = Relationship(back_populates="job", link_model=ServiceLink)
     extraExpenses: list[Expense] = Relationship(back_populates="job")
-    invoiceId: int | None = Field(default=None, foreign_key="invoice.invoiceId")
     invoice: Invoice = Relationship(back_populates="job")
-    customerId: int | None = Field(default=None, foreign_key="customer.customerId")
-    customer: Customer = Relationship(back_populates="jobs")
\ No newline at end of file
+    customer: Customer = Relationship(back_populates="jobs")
+
+
+# Read models for ?expand=. Only the relationships that were asked for are filled in.
+class CustomerExpanded(CustomerBase):
+    jobs: list[JobBase] | None = None
+    city: list[ServiceArea] | None = None
+    frequency: Frequency | None = None
+
+
+class JobExpanded(JobBase):
+    servicesProvided: list[Services] | None = None
+    extraExpenses: list[Expense] | None = None
+    invoice: Invoice | None = None
+    customer: CustomerBase | None = None
+
+
+# Emails waiting to be delivered by the outbox worker in outbox.py
+class EmailOutbox(SQLModel, table=True):
+    emailId: int | None = Field(default=None, primary_key=True)
+    toEmail: str
+    subject: str
+    body: str
+    invoiceId: int | None = Field(default=None, foreign_key="invoice.invoiceId")
+    status: str = Field(default="pending", index=True)  # pending, sent or failed
+    attempts: int = 0
+    nextAttemptAt: datetime = Field(default_factory=utcnow)
+    lastError: str | None = None
+    sentAt: datetime | None = None
+
+
+# Coordinates looked up for each address, so every address is geocoded once.
+# Addresses the geocoder couldn't place are stored without coordinates.
+class GeocodeCache(SQLModel, table=True):
+    address: str = Field(primary_key=True)
+    lat: float | None = None
+    lng: float | None = None
+    geocodedAt: datetime = Field(default_factory=utcnow)
+    # Lookups that errored in a row. While retryAt is set the address is waiting to be tried again
+    # and isn't served as a result.
+    attempts: int = 0
+    retryAt: datetime | None = Field(default=None, index=True)
+
+
+# Report summaries rebuilt by reports.py. Each row covers one calendar month, keyed by its first day.
+class RevenueSummary(SQLModel, table=True):
+    month: date = Field(primary_key=True)
+    invoiced: Decimal = Field(max_digits=12, decimal_places=2)
+    collected: Decimal = Field(max_digits=12, decimal_places=2)
+    invoices: int
+    refreshedAt: datetime
+
+
+class ExpenseSummary(SQLModel, table=True):
+    month: date = Field(primary_key=True)
+    employeeId: int = Field(primary_key=True)
+    amount: Decimal = Field(max_digits=12, decimal_places=2)
+    expenses: int
+    refreshedAt: datetime
+
+
+class LaborSummary(SQLModel, table=True):
+    month: date = Field(primary_key=True)
+    employeeId: int = Field(primary_key=True)
+    hours: float
+    cost: Decimal = Field(max_digits=12, decimal_places=2)
+    jobs: int
+    refreshedAt: datetime
+
+
+# Unpaid invoice totals by the month they fall due
+class ReceivablesSummary(SQLModel, table=True):
+    dueMonth: date = Field(primary_key=True)
+    outstanding: Decimal = Field(max_digits=12, decimal_places=2)
+    invoices: int
+    refreshedAt: datetime
@@ -0,0 +1,151 @@
+import asyncio
+import re
+import time
+from collections import defaultdict
+
+from decouple import config
+from sqlalchemy import func, literal, literal_column, or_
+from sqlmodel import select
+from sqlmodel.ext.asyncio.session import AsyncSession
+
+from schema import Customer
+
+
+# How alike a search word and a customer's word must be (0 to 1) to count as a match
+SEARCH_MIN_SIMILARITY = config("SEARCH_MIN_SIMILARITY", default=0.3, cast=float)
+MAX_SEARCH_RESULTS = 100
+# Seconds the SQLite search index is used before it's rebuilt. Customer writes in this process rebuild
+# it straight away, this is how long other workers' writes can take to show up.
+SEARCH_INDEX_TTL = config("SEARCH_INDEX_TTL", default=60, cast=float)
+
+SEARCH_FIELDS = ("fName", "lName", "email", "phoneNumber", "physicalAddress")
+
+
+# The text a customer is searched by, lowercased. The Postgres trigram and tsvector indexes
+# from migration b4e8f1a3c6d2 are built on exactly this expression, so it must stay in step.
+def search_document():
+    space = literal_column("' '")
+    document = getattr(Customer, SEARCH_FIELDS[0])
+    for name in SEARCH_FIELDS[1:]:
+        document = document + space + getattr(Customer, name)
+    return func.lower(document)
+
+
+def words(text: str) -> list[str]:
+    return re.findall(r"\w+", text.lower())
+
+
+# pg_trgm style trigrams: the word padded with two spaces in front and one behind
+def trigrams(word: str) -> set[str]:
+    padded = f"  {word} "
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+# In-process trigram index of customers, for SQLite where there's no pg_trgm.
+# It's built from one query on the first search, and rebuilt after customers change in this process
+# or once it's `ttl` seconds old. Each invalidate() starts a new generation. A build only counts as
+# current if no invalidate() arrived while its query ran.
+class CustomerSearchIndex:
+    def __init__(self, ttl: float = SEARCH_INDEX_TTL):
+        self.ttl = ttl
+        self._generation = 0
+        self._built_generation = None
+        self._built_at = 0.0
+        self._lock = asyncio.Lock()
+        self._grams: dict = defaultdict(set)     # trigram -> words containing it
+        self._customers: dict = defaultdict(set)  # word -> customerIds having it
+        self._sizes: dict = {}                    # word -> number of trigrams
+
+    @property
+    def ready(self) -> bool:
+        return self._built_generation == self._generation and time.monotonic() - self._built_at < self.ttl
+
+    def invalidate(self):
+        self._generation += 1
+
+    async def build(self, db: AsyncSession):
+        async with self._lock:
+            if self.ready:
+                return
+            generation = self._generation
+            grams_index, customers, sizes = defaultdict(set), defaultdict(set), {}
+            columns = [getattr(Customer, name) for name in SEARCH_FIELDS]
+            for customer_id, *values in (await db.exec(select(Customer.customerId, *columns))).all():
+                for word in words(" ".join(value or "" for value in values)):
+                    customers[word].add(customer_id)
+                    if word not in sizes:
+                        grams = trigrams(word)
+                        sizes[word] = len(grams)
+                        for gram in grams:
+                            grams_index[gram].add(word)
+            # Searches waiting on this build use it either way, but after an invalidate() during the
+            # query the generations differ, so the next search builds again
+            self._grams, self._customers, self._sizes = grams_index, customers, sizes
+            self._built_generation, self._built_at = generation, time.monotonic()
+
+    # Best similarity of each customer to one search word, counting shared trigrams
+    # like pg_trgm's similarity(): shared / (search word's + customer word's - shared)
+    def _match(self, word: str, min_similarity: float) -> dict:
+        grams = trigrams(word)
+        shared = defaultdict(int)
+        for gram in grams:
+            for candidate in self._grams.get(gram, ()):
+                shared[candidate] += 1
+        scores = {}
+        for candidate, count in shared.items():
+            similarity = count / (len(grams) + self._sizes[candidate] - count)
+            if similarity < min_similarity:
+                continue
+            for customer_id in self._customers[candidate]:
+                if similarity > scores.get(customer_id, 0):
+                    scores[customer_id] = similarity
+        return scores
+
+    # Customers matching every search word, best average similarity first
+    def search(self, q: str, limit: int, min_similarity: float = SEARCH_MIN_SIMILARITY) -> list[tuple[int, float]]:
+        terms = words(q)
+        if not terms:
+            return []
+        totals = None
+        for term in terms:
+            scores = self._match(term, min_similarity)
+            if totals is None:
+                totals = scores
+            else:
+                totals = {customer_id: total + scores[customer_id]
+                          for customer_id, total in totals.items() if customer_id in scores}
+            if not totals:
+                return []
+        ranked = sorted(totals.items(), key=lambda item: (-item[1], item[0]))[:limit]
+        return [(customer_id, total / len(terms)) for customer_id, total in ranked]
+
+
+customer_index = CustomerSearchIndex()
+
+
+# Ranks customers against a Postgres query: full word matches through the tsvector index, and
+# misspellings and partial words through pg_trgm's word similarity on the trigram index
+async def rank_postgres(db: AsyncSession, q: str, limit: int) -> list[tuple[int, float]]:
+    await db.exec(select(func.set_config("pg_trgm.word_similarity_threshold", str(SEARCH_MIN_SIMILARITY), True)))
+    document = search_document()
+    vector = func.to_tsvector(literal_column("'simple'"), document)
+    query = func.plainto_tsquery(literal_column("'simple'"), q)
+    # Normalization 32 scales ts_rank to rank / (rank + 1), keeping it below 1 like word_similarity
+    score = func.greatest(func.word_similarity(q, document), func.ts_rank(vector, query, 32))
+    rows = (await db.exec(
+        select(Customer.customerId, score)
+        .where(or_(vector.op("@@")(query), literal(q).op("<%")(document)))
+        .order_by(score.desc(), Customer.customerId)
+        .limit(limit)
+    )).all()
+    return [(customer_id, float(rank)) for customer_id, rank in rows]
+
+
+# Top `limit` customers for the search text q across SEARCH_FIELDS, as (customerId, score) pairs.
+# Scores run from 0 to 1.
+async def rank_customers(db: AsyncSession, q: str, limit: int) -> list[tuple[int, float]]:
+    if db.bind.dialect.name == "postgresql":
+        return await rank_postgres(db, q, limit)
+    if not customer_index.ready:
+        await customer_index.build(db)
+    return customer_index.search(q, limit)
@@ -0,0 +1,92 @@
+import asyncio
+
+import httpx
+from decouple import config
+from fastapi import HTTPException
+
+from cache import TTLCache
+from metrics import external_call
+
+
+SQUARE_URL = config("SQUARE_URL", default="https://connect.squareupsandbox.com/v2")
+SQUARE_TOKEN = config("TOKEN", default="")
+SQUARE_TIMEOUT = config("SQUARE_TIMEOUT", default=10, cast=float)
+SQUARE_MAX_CONNECTIONS = config("SQUARE_MAX_CONNECTIONS", default=20, cast=int)
+SQUARE_MAX_CONCURRENCY = config("SQUARE_MAX_CONCURRENCY", default=10, cast=int)
+SQUARE_CACHE_TTL = config("SQUARE_CACHE_TTL", default=30, cast=float)
+
+
+# Shared async client for the Square API. Connections are kept alive and reused
+# between requests, and at most SQUARE_MAX_CONCURRENCY calls are in flight at once.
+class SquareClient:
+    def __init__(self, base_url: str = SQUARE_URL, token: str = SQUARE_TOKEN,
+                 timeout: float = SQUARE_TIMEOUT, transport: httpx.AsyncBaseTransport | None = None):
+        self.base_url = base_url
+        self.token = token
+        self.timeout = timeout
+        self.transport = transport
+        self._http: httpx.AsyncClient | None = None
+        self._slots = asyncio.Semaphore(SQUARE_MAX_CONCURRENCY)
+
+    async def start(self):
+        if self._http is None:
+            self._http = httpx.AsyncClient(
+                base_url=self.base_url,
+                headers={
+                    'Authorization': f'Bearer {self.token}',
+                    'Content-Type': 'application/json',
+                },
+                timeout=httpx.Timeout(self.timeout),
+                limits=httpx.Limits(max_connections=SQUARE_MAX_CONNECTIONS,
+                                    max_keepalive_connections=SQUARE_MAX_CONNECTIONS),
+                transport=self.transport,
+            )
+
+    async def close(self):
+        if self._http is not None:
+            await self._http.aclose()
+            self._http = None
+
+    async def request(self, method: str, path: str, **kwargs) -> httpx.Response:
+        await self.start()
+        async with self._slots:
+            try:
+                # Labelled by the resource (GET payments) rather than the full path with its ids
+                with external_call("square", f"{method} {path.strip('/').split('/')[0]}"):
+                    return await self._http.request(method, path, **kwargs)
+            except httpx.TimeoutException:
+                raise HTTPException(status_code=504, detail="Square API timed out")
+            except httpx.TransportError:
+                raise HTTPException(status_code=502, detail="Square API could not be reached")
+
+    async def get(self, path: str, **kwargs) -> httpx.Response:
+        return await self.request("GET", path, **kwargs)
+
+    async def post(self, path: str, **kwargs) -> httpx.Response:
+        return await self.request("POST", path, **kwargs)
+
+    # Follows Square's cursor through a list endpoint, yielding the `key` items of each page.
+    # Pages are only requested as the caller consumes them. `first_page` is a body already fetched.
+    async def paginate(self, path: str, key: str, params: dict, first_page: dict | None = None):
+        page = first_page
+        while True:
+            if page is None:
+                response = await self.get(path, params=params)
+                response.raise_for_status()
+                page = response.json()
+            yield page.get(key, [])
+            cursor = page.get("cursor")
+            if not cursor:
+                return
+            params = {**params, "cursor": cursor}
+            page = None
+
+
+square = SquareClient()
+
+# Completed payment listings keyed by their query parameters
+payments_cache = TTLCache(ttl=SQUARE_CACHE_TTL)
+
+
+def get_square() -> SquareClient:
+    return square
@@ -0,0 +1,43 @@
+import uuid
+
+from fastapi import FastAPI
+from fastapi.responses import JSONResponse
+
+
+# A local stand-in for the Square payments API, used by the tests.
+# It can also be run on its own with `uvicorn square_stub:app --port 8001`
+# and SQUARE_URL=http://localhost:8001/v2 to develop without the sandbox.
+app = FastAPI()
+
+payments: dict[str, dict] = {}
+PAGE_SIZE = 100
+
+
+# Pages like Square does: the cursor is opaque to callers, here it's just the next offset
+@app.get("/v2/payments")
+async def list_payments(cursor: str | None = None):
+    start = int(cursor or 0)
+    page = list(payments.values())[start:start + PAGE_SIZE]
+    body = {"payments": page} if page else {}
+    if start + PAGE_SIZE < len(payments):
+        body["cursor"] = str(start + PAGE_SIZE)
+    return body
+
+
+@app.get("/v2/payments/{payment_id}")
+async def get_payment(payment_id: str):
+    if payment_id not in payments:
+        return JSONResponse(status_code=404, content={"errors": [{"code": "NOT_FOUND", "detail": "Payment not found"}]})
+    return {"payment": payments[payment_id]}
+
+
+@app.post("/v2/payments")
+async def create_payment(payload: dict):
+    payment = {
+        "id": uuid.uuid4().hex,
+        "source_id": payload["source_id"],
+        "amount_money": payload["amount_money"],
+        "status": "COMPLETED",
+    }
+    payments[payment["id"]] = payment
+    return {"payment": payment}
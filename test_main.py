@@ -1,19 +1,89 @@
+import asyncio
+import importlib.util
+import json
+import os
+import time
+from datetime import date, datetime, timezone
+from decimal import Decimal
+from pathlib import Path
+import smtplib
 from fastapi.testclient import TestClient
 from unittest.mock import patch, MagicMock
 from starlette.testclient import TestClient
 from sqlmodel import create_engine, Session
+from sqlmodel import SQLModel, select, update
+from sqlmodel.ext.asyncio.session import AsyncSession
+from sqlalchemy.ext.asyncio import create_async_engine
+from sqlalchemy import event, text
+from sqlalchemy.pool import StaticPool
+from sqlalchemy.dialects import postgresql
+from contextlib import contextmanager
 import pytest
+import httpx
 
 from main import app, Services, Frequency, ServiceArea, Customer, Employee, User, Invoice, Expense, Job, create_payment
-from database import get_db
+import outbox
+from dispatch import plan_dispatch
+from payroll import refresh_weekly_hours
+from geocode import Geocoder, cached_coordinates, geocode_pending, store_coordinates
+from reports import refresh_reports
+from scheduling import Recurrence, parse_frequency, upcoming_visits
+from search import CustomerSearchIndex, customer_index
+from metrics import MetricsMiddleware, record_query
+from query_log import query_diagnostics
+import database
+from database import ADVISORY_LOCKS, PoolStats, get_async_db, time_queries, try_advisory_lock
+from schema import EmailOutbox, GeocodeCache, RevenueSummary, ServiceLink
+import square_stub as square_stub_module
+from square_api import SquareClient, get_square, payments_cache
+from cache import reference_cache
+from square_stub import app as square_stub_app, payments as square_stub_payments
 
 
 client = TestClient(app)
 
 
+# Reference tables are cached across requests, so every test starts with an empty cache
+@pytest.fixture(autouse=True)
+def clear_reference_cache():
+    reference_cache.local.clear()
+    customer_index.invalidate()
+
+
+# Async session double: awaited calls (exec, get, commit...) resolve to plain MagicMocks
+@contextmanager
+def async_session_mock():
+    session = MagicMock(spec=AsyncSession)
+    session.exec.return_value = MagicMock()
+    session.get.return_value = MagicMock()
+    session.stream_scalars.return_value = MagicMock()
+    session.stream.return_value = MagicMock()
+    yield session
+
+
+# Real in-memory SQLite database behind get_async_db, for routes whose SQL matters
+@pytest.fixture
+def sqlite_db():
+    engine = create_async_engine("sqlite+aiosqlite://", poolclass=StaticPool)
+
+    async def create_tables():
+        async with engine.begin() as conn:
+            await conn.run_sync(SQLModel.metadata.create_all)
+
+    async def override_get_async_db():
+        async with AsyncSession(engine, expire_on_commit=False) as session:
+            yield session
+
+    asyncio.run(create_tables())
+    app.dependency_overrides[get_async_db] = override_get_async_db
+    yield engine
+    app.dependency_overrides.pop(get_async_db)
+    asyncio.run(engine.dispose())
+
+
 @pytest.fixture
 def db_session():
-    session = MagicMock(spec=Session)
+    session = MagicMock(spec=AsyncSession)
     return session
 
 @pytest.fixture
@@ -23,20 +93,20 @@ def override_get_db(db_session):
             yield db_session
         finally:
             pass
-    app.dependency_overrides[get_db] = _override_get_db
+    app.dependency_overrides[get_async_db] = _override_get_db
     yield
-    app.dependency_overrides.pop(get_db)
+    app.dependency_overrides.pop(get_async_db)
 
 
 # *** SERVICES ***
 
 
 def test_get_services():
-    with MagicMock() as mock_db:
+    with async_session_mock() as mock_db:
         mock_db.exec.return_value.all.return_value = [
             Services(serviceId=1, service="Fencing"),
         ]
-        app.dependency_overrides[get_db] = lambda: mock_db
+        app.dependency_overrides[get_async_db] = lambda: mock_db
 
         response = client.get("/services")
 
@@ -46,6 +116,8 @@ def test_get_services():
             {
                 "serviceId": 1,
                 "service": "Fencing",
+                "price": "0.00",
+                "version": 1,
             }
         ]
         assert response.json() == expected_response
@@ -57,8 +129,8 @@ def test_create_service():
         "service": "Mowing",
     }
 
-    with MagicMock() as mock_db:
-        app.dependency_overrides[get_db] = lambda: mock_db
+    with async_session_mock() as mock_db:
+        app.dependency_overrides[get_async_db] = lambda: mock_db
         response = client.post("/services", json=service_data)
 
         assert response.status_code == 201
@@ -69,30 +141,79 @@ def test_create_service():
         assert created_service.service == service_data["service"]
 
 
-def test_delete_service():
-    service_id = 1
+def test_delete_service(sqlite_db):
+    client.post("/services", json={"service": "Mowing"})
+    statements = []
+    event.listen(sqlite_db.sync_engine, "before_cursor_execute", lambda *args: statements.append(args[2]))
 
-    with MagicMock() as mock_db:
-        app.dependency_overrides[get_db] = lambda: mock_db
-        mock_db.get.return_value = Services(serviceId=service_id)
-        response = client.delete(f"/services/{service_id}")
+    response = client.delete("/services/1")
 
-        assert response.status_code == 200
-        assert response.json() == {"detail": "Service Deleted"}
+    assert response.status_code == 200
+    assert response.json() == {"detail": "Service Deleted"}
+    # The job links go first, then the service in one DELETE ... RETURNING
+    assert statements[0].startswith("DELETE FROM servicelink")
+    assert statements[1].startswith("DELETE FROM services") and "RETURNING" in statements[1]
+    assert client.get("/services").json() == []
+    assert client.delete("/services/1").status_code == 404
+
+
+def test_bulk_services_upsert(sqlite_db):
+    response = client.post("/services/bulk", json=[{"service": "Mowing"}, {"service": "Edging"}])
+
+    assert response.status_code == 201
+    assert response.json() == [
+        {"index": 0, "status": "created", "serviceId": 1},
+        {"index": 1, "status": "created", "serviceId": 2},
+    ]
+
+    ndjson = '{"serviceId": 2, "service": "Trimming"}\n{"service": "Aeration"}\n'
+    response = client.post("/services/bulk", content=ndjson, headers={"content-type": "application/x-ndjson"})
+
+    assert response.status_code == 201
+    assert response.json() == [
+        {"index": 0, "status": "upserted", "serviceId": 2},
+        {"index": 1, "status": "created", "serviceId": 3},
+    ]
+    assert [service["service"] for service in client.get("/services").json()] == ["Mowing", "Trimming", "Aeration"]
 
-        deleted_service = mock_db.delete.call_args[0][0]
-        assert deleted_service.serviceId == service_id
+
+def test_bulk_rejects_invalid_rows(sqlite_db):
+    response = client.post("/services/bulk", json=[{"service": "Mowing"}, {"serviceId": "abc"}])
+
+    assert response.status_code == 422
+    assert response.json()["detail"][0]["index"] == 1
+    assert client.get("/services").json() == []
+
+
+def test_get_services_cached_with_etag(sqlite_db):
+    client.post("/services", json={"service": "Mowing"})
+    statements = []
+    event.listen(sqlite_db.sync_engine, "before_cursor_execute", lambda *args: statements.append(args[2]))
+
+    first = client.get("/services")
+    second = client.get("/services", headers={"If-None-Match": first.headers["etag"]})
+
+    assert first.json() == [{"serviceId": 1, "service": "Mowing", "price": "0.00", "version": 1}]
+    assert second.status_code == 304
+    assert len(statements) == 1
+
+    client.post("/services", json={"service": "Trimming"})
+    third = client.get("/services", headers={"If-None-Match": first.headers["etag"]})
+
+    assert third.status_code == 200
+    assert third.headers["etag"] != first.headers["etag"]
+    assert [service["service"] for service in third.json()] == ["Mowing", "Trimming"]
 
 
 # *** FREQUENCY ***
 
 
 def test_get_frequency():
-    with MagicMock() as mock_db:
+    with async_session_mock() as mock_db:
         mock_db.exec.return_value.all.return_value = [
             Frequency(frequencyId=1, serviceFrequency="Monthly"),
         ]
-        app.dependency_overrides[get_db] = lambda: mock_db
+        app.dependency_overrides[get_async_db] = lambda: mock_db
 
         response = client.get("/frequency")
 
@@ -102,6 +223,7 @@ def test_get_frequency():
             {
                 "frequencyId": 1,
                 "serviceFrequency": "Monthly",
+                "version": 1,
             }
         ]
         assert response.json() == expected_response
@@ -113,8 +235,8 @@ def test_create_frequency():
         "serviceFrequency": "Monthly",
     }
 
-    with MagicMock() as mock_db:
-        app.dependency_overrides[get_db] = lambda: mock_db
+    with async_session_mock() as mock_db:
+        app.dependency_overrides[get_async_db] = lambda: mock_db
         response = client.post("/frequency", json=frequency_data)
 
         assert response.status_code == 201
@@ -125,57 +247,58 @@ def test_create_frequency():
         assert created_frequency.serviceFrequency == frequency_data["serviceFrequency"]
 
 
-def test_update_frequency():
+def test_update_frequency(sqlite_db):
     frequency_id = 1
     updated_frequency_data = {
         "frequencyId": frequency_id,
         "serviceFrequency": "Weekly"
     }
+    statements = []
+    event.listen(sqlite_db.sync_engine, "before_cursor_execute", lambda *args: statements.append(args[2]))
 
-    with MagicMock() as mock_db:
-        app.dependency_overrides[get_db] = lambda: mock_db
-        mock_db.get.return_value = Frequency(frequencyId=frequency_id)
-        response = client.put(f"/frequency/{frequency_id}", json=updated_frequency_data)
+    created = client.put(f"/frequency/{frequency_id}", json=updated_frequency_data)
+    updated = client.put(f"/frequency/{frequency_id}", json={**updated_frequency_data, "serviceFrequency": "Biweekly"})
 
-        assert response.status_code == 201
-        assert response.json() == {"detail": "Frequency Updated"}
+    assert created.status_code == 201
+    assert created.json() == {"detail": "Frequency Created"}
+    assert updated.status_code == 201
+    assert updated.json() == {"detail": "Frequency Updated"}
+    # Each PUT is a single INSERT ... ON CONFLICT DO UPDATE
+    assert len(statements) == 2
+    assert all("ON CONFLICT" in statement for statement in statements)
+    assert client.get("/frequency").json() == [{"frequencyId": 1, "serviceFrequency": "Biweekly", "version": 2}]
 
-        updated_frequency = mock_db.add.call_args[0][0]
-        assert updated_frequency.frequencyId == frequency_id
-        assert updated_frequency.serviceFrequency == updated_frequency_data["serviceFrequency"]
 
+def test_delete_frequency(sqlite_db):
+    seed_jobs(sqlite_db, 0)
+    client.put("/frequency/1", json={"serviceFrequency": "Weekly"})
+    client.patch("/customer/1", json={"frequencyId": 1})
 
-def test_delete_frequency():
-    frequency_id = 1
+    response = client.delete("/frequency/1")
 
-    with MagicMock() as mock_db:
-        app.dependency_overrides[get_db] = lambda: mock_db
-        mock_db.get.return_value = Frequency(frequencyId=frequency_id)
-        response = client.delete(f"/frequency/{frequency_id}")
-
-        assert response.status_code == 200
-        assert response.json() == {"detail": "Frequency Deleted"}
-
-        mock_db.delete.assert_called_once()
-        mock_db.commit.assert_called_once()
+    assert response.status_code == 200
+    assert response.json() == {"detail": "Frequency Deleted"}
+    # Customers on the frequency are kept, without one
+    assert client.get("/customer", params={"fields": "frequencyId"}).json() == [{"customerId": 1, "frequencyId": None}]
+    assert client.delete("/frequency/1").json() == {"detail": "Frequency of service not found"}
 
 
 # *** SERVICE AREA ***
 
 def test_get_service_area():
-    with MagicMock() as mock_db:
+    with async_session_mock() as mock_db:
         mock_db.exec.return_value.all.return_value = [
             ServiceArea(serviceAreaId=1, townServiced="Gooding"),
             ServiceArea(serviceAreaId=2, townServiced="Jerome"),
         ]
         
-        app.dependency_overrides[get_db] = lambda: mock_db
+        app.dependency_overrides[get_async_db] = lambda: mock_db
         response = client.get("/servicearea")
         assert response.status_code == 200
 
         expected_response = [
-            {"serviceAreaId": 1, "townServiced": "Gooding"},
-            {"serviceAreaId": 2, "townServiced": "Jerome"},
+            {"serviceAreaId": 1, "townServiced": "Gooding", "version": 1},
+            {"serviceAreaId": 2, "townServiced": "Jerome", "version": 1},
         ]
         assert response.json() == expected_response
 
@@ -184,8 +307,8 @@ def test_create_service_area():
         "townServiced": "Jerome"
     }
 
-    with MagicMock() as mock_db:
-        app.dependency_overrides[get_db] = lambda: mock_db
+    with async_session_mock() as mock_db:
+        app.dependency_overrides[get_async_db] = lambda: mock_db
         response = client.post("/servicearea", json=service_area_data)
 
         assert response.status_code == 201
@@ -195,19 +318,14 @@ def test_create_service_area():
         assert created_service_area.townServiced == service_area_data["townServiced"]
 
 
-def test_delete_service_area():
-    service_area_id = 1
+def test_delete_service_area(sqlite_db):
+    client.post("/servicearea", json={"townServiced": "Jerome"})
 
-    with MagicMock() as mock_db:
-        app.dependency_overrides[get_db] = lambda: mock_db
-        mock_db.get.return_value = ServiceArea(serviceAreaId=service_area_id)
-        response = client.delete(f"/servicearea/{service_area_id}")
+    response = client.delete("/servicearea/1")
 
-        assert response.status_code == 200
-        assert response.json() == {"detail": "Service Area Deleted"}
-
-        deleted_service_area = mock_db.delete.call_args[0][0]
-        assert deleted_service_area.serviceAreaId == service_area_id
+    assert response.status_code == 200
+    assert response.json() == {"detail": "Service Area Deleted"}
+    assert client.get("/servicearea").json() == []
 
 
 # *** CUSTOMER ***
@@ -227,8 +345,8 @@ def test_create_customer():
         "comments": "New customer",
     }
 
-    with MagicMock() as mock_db:
-        app.dependency_overrides[get_db] = lambda: mock_db
+    with async_session_mock() as mock_db:
+        app.dependency_overrides[get_async_db] = lambda: mock_db
         response = client.post("/customer", json=customer_data)
 
         assert response.status_code == 201
@@ -247,6 +365,30 @@ def test_create_customer():
         assert created_customer.comments == customer_data["comments"]
 
 
+def test_get_customers_keyset_page():
+    with async_session_mock() as mock_db:
+        mock_db.exec.return_value.keys.return_value = ["customerId", "fName", "lName"]
+        mock_db.exec.return_value.all.return_value = [(11, "Bob", "Johnson")]
+        app.dependency_overrides[get_async_db] = lambda: mock_db
+        response = client.get("/customer", params={"limit": 1, "after": 10})
+
+        assert response.status_code == 200
+        assert [row["customerId"] for row in response.json()] == [11]
+
+        query = mock_db.exec.call_args[0][0]
+        compiled = query.compile(compile_kwargs={"literal_binds": True})
+        assert 'customer."customerId" > 10' in str(compiled)
+        assert "LIMIT 1" in str(compiled)
+
+
+def test_get_customers_page_size_limit():
+    with async_session_mock() as mock_db:
+        app.dependency_overrides[get_async_db] = lambda: mock_db
+        response = client.get("/customer", params={"limit": 100000})
+
+        assert response.status_code == 422
+
+
 # *** EMPLOYEE ***
 
 
@@ -262,8 +404,8 @@ def test_create_employee():
         "weeklyHours": 40.0
     }
 
-    with MagicMock() as mock_db:
-        app.dependency_overrides[get_db] = lambda: mock_db
+    with async_session_mock() as mock_db:
+        app.dependency_overrides[get_async_db] = lambda: mock_db
         response = client.post("/employee", json=employee_data)
 
         assert response.status_code == 201
@@ -280,7 +422,7 @@ def test_create_employee():
         assert created_employee.weeklyHours == employee_data["weeklyHours"]
 
 
-def test_update_employee():
+def test_update_employee(sqlite_db):
     emp_id = 10
     updated_employee_data = {
         "fName": "Bob",
@@ -293,25 +435,26 @@ def test_update_employee():
         "weeklyHours": 40.0,
     }
 
-    with MagicMock() as mock_db:
-        app.dependency_overrides[get_db] = lambda: mock_db
-        mock_db.get.return_value = Employee(**updated_employee_data)
-        response = client.put(f"/employee/{emp_id}", json=updated_employee_data)
+    created = client.put(f"/employee/{emp_id}", json=updated_employee_data)
+    updated = client.put(f"/employee/{emp_id}", json={**updated_employee_data, "laborRate": 22.0, "version": 7})
 
-        assert response.status_code == 201
-        assert response.json() == {"detail": "Employee Updated"}
+    assert created.status_code == 201
+    assert created.json() == {"detail": "Employee Created"}
+    assert updated.json() == {"detail": "Employee Updated"}
+    # The sent version is ignored, the update bumps it
+    employee = client.get("/employee").json()[0]
+    assert (employee["empId"], employee["laborRate"], employee["version"]) == (emp_id, 22.0, 2)
 
 
-def test_delete_employee():
-    emp_id = 1
+def test_delete_employee(sqlite_db):
+    seed_jobs(sqlite_db, 1)
 
-    with MagicMock() as mock_db:
-        app.dependency_overrides[get_db] = lambda: mock_db
-        mock_db.get.return_value = Employee(empId=emp_id)
-        response = client.delete(f"/employee/{emp_id}")
+    response = client.delete("/employee/1")
 
-        assert response.status_code == 200
-        assert response.json() == {"detail": "Employee Deleted"}
+    assert response.status_code == 200
+    assert response.json() == {"detail": "Employee Deleted"}
+    assert client.get("/employee").json() == []
+    assert client.delete("/employee/1").status_code == 404
 
 
 # *** USER ***
@@ -323,15 +466,17 @@ def test_get_user():
         User(userId=2, email="user2@example.com", empId=None, customerId=2, password="password2"),
     ]
 
-    with MagicMock() as mock_db:
+    with async_session_mock() as mock_db:
         mock_db.exec.return_value.all.return_value = user_data
-        app.dependency_overrides[get_db] = lambda: mock_db
+        app.dependency_overrides[get_async_db] = lambda: mock_db
         response = client.get("/user")
 
         assert response.status_code == 200
         assert response.json() == [
-            {"userId": 1, "email": "user1@example.com", "empId": 1, "customerId": None, "password": "password1"},
-            {"userId": 2, "email": "user2@example.com", "empId": None, "customerId": 2, "password": "password2"},
+            {"userId": 1, "email": "user1@example.com", "empId": 1, "customerId": None, "password": "password1",
+             "version": 1},
+            {"userId": 2, "email": "user2@example.com", "empId": None, "customerId": 2, "password": "password2",
+             "version": 1},
         ]
 
 def test_create_user():
@@ -342,8 +487,8 @@ def test_create_user():
         "password": "password123",
     }
 
-    with MagicMock() as mock_db:
-        app.dependency_overrides[get_db] = lambda: mock_db
+    with async_session_mock() as mock_db:
+        app.dependency_overrides[get_async_db] = lambda: mock_db
         response = client.post("/user", json=user_data)
 
         assert response.status_code == 201
@@ -356,18 +501,25 @@ def test_create_user():
         assert created_user.password == user_data["password"]
 
 
-def test_delete_user():
-    user_id = 1
-    with MagicMock() as mock_db:
-        app.dependency_overrides[get_db] = lambda: mock_db
-        mock_db.get.return_value = User(userId=user_id, email="user@example.com", empId=None, customerId=1, password="password")
-        response = client.delete(f"/user/{user_id}")
+def test_delete_user(sqlite_db):
+    client.put("/user/1", json={"email": "user@example.com", "customerId": 1, "password": "password"})
 
-        assert response.status_code == 200
-        assert response.json() == {"detail": "User Deleted"}
+    response = client.delete("/user/1")
 
-        mock_db.delete.assert_called_once()
-        mock_db.commit.assert_called_once()
+    assert response.status_code == 200
+    assert response.json() == {"detail": "User Deleted"}
+    assert client.delete("/user/1").json() == {"detail": "User not found"}
+
+
+def test_bulk_users_checks_email(sqlite_db):
+    users = [
+        {"email": "good@example.com", "password": "password1"},
+        {"email": "not-an-email", "password": "password2"},
+    ]
+    response = client.post("/user/bulk", json=users)
+
+    assert response.status_code == 422
+    assert response.json()["detail"] == [{"index": 1, "status": "error", "detail": "Invalid email address"}]
 
 
 # *** INVOICE ***
@@ -387,8 +539,8 @@ def test_create_invoice():
         "paid": False,
     }
 
-    with MagicMock() as mock_db:
-        app.dependency_overrides[get_db] = lambda: mock_db
+    with async_session_mock() as mock_db:
+        app.dependency_overrides[get_async_db] = lambda: mock_db
         response = client.post("/invoice", json=invoice_data)
 
         assert response.status_code == 201
@@ -396,8 +548,8 @@ def test_create_invoice():
 
         created_invoice = mock_db.add.call_args[0][0]
         assert created_invoice.lotSize == invoice_data["lotSize"]
-        assert created_invoice.invoiceDate == invoice_data["invoiceDate"]
-        assert created_invoice.dueDate == invoice_data["dueDate"]
+        assert created_invoice.invoiceDate == date.fromisoformat(invoice_data["invoiceDate"])
+        assert created_invoice.dueDate == date.fromisoformat(invoice_data["dueDate"])
         assert created_invoice.emailStatus == invoice_data["emailStatus"]
         assert created_invoice.productsUsed == invoice_data["productsUsed"]
         assert created_invoice.acceptedBy == invoice_data["acceptedBy"]
@@ -407,7 +559,7 @@ def test_create_invoice():
         assert created_invoice.paid == invoice_data["paid"]
 
 
-def test_update_invoice():
+def test_update_invoice(sqlite_db):
     updated_invoice_data = {
         "invoiceId": 1,
         "lotSize": "Large",
@@ -419,27 +571,173 @@ def test_update_invoice():
         "applyTax": True,
         "taxAmount": 15.0,
         "totalEstimate": 200.0,
-        "paid": True
+        "paid": False
     }
 
-    with MagicMock() as mock_db:
-        app.dependency_overrides[get_db] = lambda: mock_db
-        mock_db.get.return_value = Invoice(**updated_invoice_data)
-        response = client.put(f"/invoice/{updated_invoice_data['invoiceId']}", json=updated_invoice_data)
+    created = client.put(f"/invoice/{updated_invoice_data['invoiceId']}", json=updated_invoice_data)
+    updated = client.put(f"/invoice/{updated_invoice_data['invoiceId']}", json={**updated_invoice_data, "paid": True})
 
-        assert response.status_code == 201
-        assert response.json() == {"detail": "Invoice Updated"}
+    assert created.status_code == 201
+    assert created.json() == {"detail": "Invoice Created"}
+    assert updated.status_code == 201
+    assert updated.json() == {"detail": "Invoice Updated"}
+    assert client.get("/invoice", params={"fields": ["paid", "version"]}).json() == [
+        {"invoiceId": 1, "paid": True, "version": 2}]
 
 
-def test_delete_invoice():
-    invoice_id = 1
-    with MagicMock() as mock_db:
-        app.dependency_overrides[get_db] = lambda: mock_db
-        mock_db.get.return_value = Invoice(invoiceId=invoice_id)
-        response = client.delete(f"/invoice/{invoice_id}")
-        
-        assert response.status_code == 200
-        assert response.json() == {"detail": "Invoice Deleted"}
+def test_delete_invoice(sqlite_db):
+    seed_jobs(sqlite_db, 1)
+
+    response = client.delete("/invoice/1")
+
+    assert response.status_code == 200
+    assert response.json() == {"detail": "Invoice Deleted"}
+    assert client.get("/job", params={"fields": "invoiceId"}).json() == [{"jobId": 1, "invoiceId": None}]
+
+
+def seed_billing_data(engine):
+    async def seed():
+        async with AsyncSession(engine) as db:
+            db.add(Employee(empId=1, fName="Bob", lName="Johnson", birthDate="2000-01-01", phoneNumber="",
+                            email="", address="", laborRate=20.0, weeklyHours=0))
+            db.add(Services(serviceId=1, service="Mowing", price=Decimal("40.00")))
+            db.add(Services(serviceId=2, service="Edging", price=Decimal("10.00")))
+            for customer_id in (1, 2):
+                db.add(Customer(customerId=customer_id, fName="Ann", lName="Lee", phoneNumber="", email="",
+                                billingAddress="", physicalAddress="", lastPaymentDate="", lastServiceDate="",
+                                isResidential=True, comments=""))
+            for job_id, customer_id, day, active in ((1, 1, 5, False), (2, 1, 12, False), (3, 2, 6, False),
+                                                     (4, 2, 7, True), (5, 2, 30, False)):
+                db.add(Job(jobId=job_id, customerId=customer_id, serviceDate=date(2025, 5, day), arrivalWindow="",
+                           employeeId=1, payment=False, isActive=active, comments=""))
+                db.add(ServiceLink(serviceId=1, jobId=job_id))
+            db.add(ServiceLink(serviceId=2, jobId=1))
+            db.add(Expense(expenseId=1, expenseDate=date(2025, 5, 5), store="Co-op", itemsPurchased="Seed",
+                           totalAmount=Decimal("25.50"), reason="", purchasedBy=1, linkedJob=2))
+            await db.commit()
+
+    asyncio.run(seed())
+
+
+def test_generate_invoices_bills_finished_jobs_per_customer(sqlite_db):
+    seed_billing_data(sqlite_db)
+
+    response = client.post("/invoice/generate",
+                           params={"start": "2025-05-01", "end": "2025-05-15", "invoiceDate": "2025-05-31"})
+
+    assert response.status_code == 201
+    assert response.json() == {
+        "invoices": [
+            {"invoiceId": 1, "customerId": 1, "jobs": 2, "taxAmount": "6.93", "totalEstimate": "122.43"},
+            {"invoiceId": 2, "customerId": 2, "jobs": 1, "taxAmount": "2.40", "totalEstimate": "42.40"},
+        ],
+        "jobs": 3,
+    }
+    jobs = client.get("/job", params={"fields": "invoiceId"}).json()
+    assert [job["invoiceId"] for job in jobs] == [1, 1, 2, None, None]
+    assert client.get("/invoice").json()[0]["dueDate"] == "2025-06-14"
+
+    again = client.post("/invoice/generate", params={"start": "2025-05-01", "end": "2025-05-15"})
+    assert again.json() == {"invoices": [], "jobs": 0}
+
+
+def test_generate_invoices_leaves_jobs_finished_mid_run(sqlite_db):
+    seed_billing_data(sqlite_db)
+
+    # Job 4 is finished by someone else after the jobs were read, just before the invoices are written
+    def finish_job(conn, cursor, statement, *args):
+        if statement.startswith("INSERT INTO invoice"):
+            cursor.execute('UPDATE job SET "isActive" = 0 WHERE "jobId" = 4')
+    event.listen(sqlite_db.sync_engine, "before_cursor_execute", finish_job)
+
+    response = client.post("/invoice/generate",
+                           params={"start": "2025-05-01", "end": "2025-05-15", "invoiceDate": "2025-05-31"})
+    event.remove(sqlite_db.sync_engine, "before_cursor_execute", finish_job)
+
+    # Customer 2's invoice covers only job 3, and job 4 waits for the next run
+    assert response.json()["invoices"][1] == {"invoiceId": 2, "customerId": 2, "jobs": 1, "taxAmount": "2.40",
+                                              "totalEstimate": "42.40"}
+    jobs = client.get("/job", params={"fields": "invoiceId"}).json()
+    assert [job["invoiceId"] for job in jobs] == [1, 1, 2, None, None]
+
+    again = client.post("/invoice/generate", params={"start": "2025-05-01", "end": "2025-05-15"})
+    assert [invoice["jobs"] for invoice in again.json()["invoices"]] == [1]
+
+
+def test_email_invoice_queues_message():
+    with async_session_mock() as mock_db:
+        app.dependency_overrides[get_async_db] = lambda: mock_db
+        mock_db.get.return_value = Invoice(invoiceId=7, invoiceDate="2025-05-10", dueDate="2025-05-17",
+                                           taxAmount=10.0, totalEstimate=100.0)
+        response = client.post("/invoice/7/email", params={"to_email": "bob@email.com"})
+
+        assert response.status_code == 202
+        assert response.json() == {"detail": "Invoice Email Queued"}
+
+        queued = mock_db.add.call_args[0][0]
+        assert isinstance(queued, EmailOutbox)
+        assert queued.toEmail == "bob@email.com"
+        assert queued.invoiceId == 7
+        assert queued.status == "pending"
+        mock_db.commit.assert_called_once()
+
+
+# Local stand-in for an SMTP server that records what it's asked to do
+class FakeSMTP:
+    instances = []
+
+    def __init__(self, host, port):
+        self.logins = 0
+        self.sent = []
+        FakeSMTP.instances.append(self)
+
+    def starttls(self):
+        pass
+
+    def login(self, user, password):
+        self.logins += 1
+
+    def send_message(self, msg):
+        if msg["To"] == "bounce@email.com":
+            raise smtplib.SMTPRecipientsRefused({msg["To"]: (550, b"No such user")})
+        self.sent.append(msg["To"])
+
+    def quit(self):
+        pass
+
+
+def test_outbox_delivers_batch_over_one_connection(monkeypatch):
+    monkeypatch.setattr(outbox, "SMTP_USER", "office@queenoftheyard.com")
+    FakeSMTP.instances.clear()
+
+    async def run():
+        engine = create_async_engine("sqlite+aiosqlite://", poolclass=StaticPool)
+        async with engine.begin() as conn:
+            await conn.run_sync(SQLModel.metadata.create_all)
+        async with AsyncSession(engine, expire_on_commit=False) as db:
+            db.add(Invoice(invoiceId=1, lotSize="", invoiceDate=date(2025, 5, 10), dueDate=date(2025, 5, 17), emailStatus=False,
+                           productsUsed="", acceptedBy="", applyTax=False, taxAmount=0, totalEstimate=0, paid=False))
+            outbox.queue_email(db, "a@email.com", "Invoice", "body", invoice_id=1)
+            outbox.queue_email(db, "b@email.com", "Invoice", "body")
+            outbox.queue_email(db, "bounce@email.com", "Invoice", "body")
+            await db.commit()
+
+            sent = await outbox.deliver_batch(db, outbox.SmtpSender(smtp_factory=FakeSMTP))
+            emails = (await db.exec(select(EmailOutbox).order_by(EmailOutbox.emailId))).all()
+            invoice = await db.get(Invoice, 1)
+        await engine.dispose()
+        return sent, emails, invoice
+
+    sent, emails, invoice = asyncio.run(run())
+
+    assert sent == 3
+    assert len(FakeSMTP.instances) == 1
+    assert FakeSMTP.instances[0].logins == 1
+    assert FakeSMTP.instances[0].sent == ["a@email.com", "b@email.com"]
+    assert [email.status for email in emails] == ["sent", "sent", "pending"]
+    assert emails[2].attempts == 1
+    assert emails[2].nextAttemptAt > emails[0].sentAt
+    assert invoice.emailStatus is True
 
 
 # *** EXPENSE ***
@@ -454,22 +752,22 @@ def test_create_expense():
         "reason": "ran out of fuel",
     }
 
-    with MagicMock() as mock_db:
-        app.dependency_overrides[get_db] = lambda: mock_db
+    with async_session_mock() as mock_db:
+        app.dependency_overrides[get_async_db] = lambda: mock_db
         response = client.post("/expense", json=expense_data)
 
         assert response.status_code == 201
         assert response.json() == {"detail": "Expense Created"}
 
         created_expense = mock_db.add.call_args[0][0]
-        assert created_expense.expenseDate == expense_data["expenseDate"]
+        assert created_expense.expenseDate == date.fromisoformat(expense_data["expenseDate"])
         assert created_expense.store == expense_data["store"]
         assert created_expense.itemsPurchased == expense_data["itemsPurchased"]
-        assert created_expense.totalAmount == expense_data["totalAmount"]
+        assert created_expense.totalAmount == Decimal(expense_data["totalAmount"])
         assert created_expense.reason == expense_data["reason"]
 
 
-def test_update_expense():
+def test_update_expense(sqlite_db):
     expense_id = 1
     updated_expense_data = {
         "expenseDate": "2024-05-03",
@@ -477,30 +775,28 @@ def test_update_expense():
         "itemsPurchased": "Chainsaw fuel",
         "totalAmount": "200.00",
         "reason": "ran out of fuel",
+        "purchasedBy": 1,
     }
 
-    with MagicMock() as mock_db:
-        app.dependency_overrides[get_db] = lambda: mock_db
-        response = client.put(f"/expense/{expense_id}", json=updated_expense_data)
+    created = client.put(f"/expense/{expense_id}", json=updated_expense_data)
+    updated = client.put(f"/expense/{expense_id}", json={**updated_expense_data, "store": "Lowe's"})
 
-        assert response.status_code == 201
-        assert response.json() == {"detail": "Expense Updated"}
+    assert created.json() == {"detail": "Expense Created"}
+    assert updated.status_code == 201
+    assert updated.json() == {"detail": "Expense Updated"}
+    expense = client.get("/expense").json()[0]
+    assert (expense["expenseId"], expense["store"], expense["totalAmount"]) == (expense_id, "Lowe's", "200.00")
 
-        existing_expense = mock_db.get.return_value
-        for key, value in updated_expense_data.items():
-            assert getattr(existing_expense, key) == value
 
+def test_delete_expense(sqlite_db):
+    client.put("/expense/1", json={"expenseDate": "2024-05-03", "store": "Home Depot", "itemsPurchased": "Fuel",
+                                   "totalAmount": "20.00", "reason": "ran out of fuel", "purchasedBy": 1})
 
-def test_delete_expense():
-    expense_id = 1
+    response = client.delete("/expense/1")
 
-    with MagicMock() as mock_db:
-        app.dependency_overrides[get_db] = lambda: mock_db
-        mock_db.get.return_value = Expense(invoiceId=expense_id)
-        response = client.delete(f"/expense/{expense_id}")
-
-        assert response.status_code == 200
-        assert response.json() == {"detail": "Expense Deleted"}
+    assert response.status_code == 200
+    assert response.json() == {"detail": "Expense Deleted"}
+    assert client.get("/expense").json() == []
 
 
 # *** JOB ***
@@ -509,15 +805,15 @@ def test_delete_expense():
 def test_create_job():
     job_data = {
         "arrivalWindow": "08:00-10:00",
-        "clockIn": "08:15",
-        "clockOut": "10:00",
+        "clockIn": "2025-05-05T08:15:00",
+        "clockOut": "2025-05-05T10:00:00",
         "employeeId": 1,
         "payment": True,
         "isActive": True,
     }
 
-    with MagicMock() as mock_db:
-        app.dependency_overrides[get_db] = lambda: mock_db
+    with async_session_mock() as mock_db:
+        app.dependency_overrides[get_async_db] = lambda: mock_db
         response = client.post("/job", json=job_data)
 
         assert response.status_code == 201
@@ -525,43 +821,953 @@ def test_create_job():
 
         created_job = mock_db.add.call_args[0][0]
         assert created_job.arrivalWindow == job_data["arrivalWindow"]
-        assert created_job.clockIn == job_data["clockIn"]
-        assert created_job.clockOut == job_data["clockOut"]
+        assert created_job.clockIn == datetime.fromisoformat(job_data["clockIn"])
+        assert created_job.clockOut == datetime.fromisoformat(job_data["clockOut"])
         assert created_job.employeeId == job_data["employeeId"]
         assert created_job.payment == job_data["payment"]
         assert created_job.isActive == job_data["isActive"]
 
 
+def test_get_jobs_stream():
+    with async_session_mock() as mock_db:
+        mock_db.stream.return_value.keys.return_value = ["jobId", "arrivalWindow", "clockIn"]
+        mock_db.stream.return_value.partitions.return_value.__aiter__.return_value = [
+            [(1, "08:00-10:00", datetime(2025, 5, 5, 8, 15))],
+            [(2, "10:00-12:00", datetime(2025, 5, 5, 10, 15))],
+        ]
+        app.dependency_overrides[get_async_db] = lambda: mock_db
+        response = client.get("/job", params={"stream": True})
+
+        assert response.status_code == 200
+        assert response.headers["content-type"] == "application/x-ndjson"
+        lines = response.text.splitlines()
+        assert [json.loads(line)["jobId"] for line in lines] == [1, 2]
+
+
+def test_parse_frequency():
+    assert parse_frequency("Weekly") == Recurrence(1, "week")
+    assert parse_frequency("Bi-Weekly") == Recurrence(2, "week")
+    assert parse_frequency("every 10 days") == Recurrence(10, "day")
+    assert parse_frequency("Every other month") == Recurrence(2, "month")
+    assert parse_frequency("One time") is None
+    assert upcoming_visits(Recurrence(1, "month"), date(2025, 1, 31), date(2025, 2, 1), date(2025, 4, 30)) == [
+        date(2025, 2, 28), date(2025, 3, 28), date(2025, 4, 28)]
+
+
+def test_schedule_recurring_jobs_is_incremental(sqlite_db):
+    async def seed():
+        async with AsyncSession(sqlite_db) as db:
+            db.add(Frequency(frequencyId=1, serviceFrequency="Weekly"))
+            db.add(Frequency(frequencyId=2, serviceFrequency="Whenever it rains"))
+            for customer_id, frequency_id in ((1, 1), (2, 1), (3, 2)):
+                db.add(Customer(customerId=customer_id, fName="Ann", lName="Lee", phoneNumber="", email="",
+                                billingAddress="", physicalAddress="", lastPaymentDate="", lastServiceDate="",
+                                isResidential=True, comments="", frequencyId=frequency_id))
+            db.add(Job(jobId=1, customerId=2, serviceDate=date(2025, 5, 6), arrivalWindow="10:00-12:00",
+                       payment=False, isActive=True, comments=""))
+            await db.commit()
+
+    asyncio.run(seed())
+
+    first = client.post("/job/schedule", params={"start": "2025-05-05", "through": "2025-05-18"})
+    assert first.status_code == 201
+    assert first.json() == {"created": 3, "customers": 2, "through": "2025-05-18", "unrecognized": ["Whenever it rains"]}
+
+    jobs = client.get("/job", params={"customerId": 2}).json()
+    assert [(job["serviceDate"], job["arrivalWindow"]) for job in jobs] == [
+        ("2025-05-06", "10:00-12:00"), ("2025-05-13", "10:00-12:00")]
+    assert [job["serviceDate"] for job in client.get("/job", params={"customerId": 1}).json()] == [
+        "2025-05-05", "2025-05-12"]
+
+    again = client.post("/job/schedule", params={"start": "2025-05-05", "through": "2025-05-25"})
+    assert again.json()["created"] == 2
+
+
+def test_schedule_recurring_jobs_skipped_while_another_runs(sqlite_db, monkeypatch):
+    locks = []
+
+    async def lock_held_elsewhere(db, name):
+        locks.append(name)
+        return False
+
+    monkeypatch.setattr("scheduling.try_advisory_lock", lock_held_elsewhere)
+    response = client.post("/job/schedule", params={"start": "2025-05-05"})
+
+    assert response.status_code == 409
+    assert locks == ["schedule"]
+
+
+# *** DISPATCH ***
+
+
+def test_plan_dispatch_respects_windows_and_uncrosses():
+    coordinates = {f"{n} Main St": (42.70, -114.50 + n * 0.01) for n in range(5)}
+    jobs = [{"jobId": n, "employeeId": 1, "customerId": n, "address": f"{n} Main St", "arrivalWindow": "08:00-17:00"}
+            for n in (3, 0, 4, 1, 2)]
+    jobs.append({"jobId": 9, "employeeId": 2, "customerId": 9, "address": "Nowhere", "arrivalWindow": "08:00-17:00"})
+
+    plan = plan_dispatch(jobs, coordinates, depot=(42.70, -114.51))
+
+    assert [stop["jobId"] for stop in plan["routes"][0]["stops"]] == [0, 1, 2, 3, 4]
+    assert plan["unlocated"] == [9]
+
+    jobs[4]["arrivalWindow"] = "08:00-08:30"
+    plan = plan_dispatch(jobs[:5], coordinates, depot=(42.70, -114.51))
+    first = plan["routes"][0]["stops"][0]
+    assert (first["jobId"], first["late"]) == (2, False)
+
+
+def test_dispatch_reads_addresses_geocoded_in_background(sqlite_db):
+    lookups = []
+
+    def nominatim(request):
+        lookups.append(request.url.params["q"])
+        return httpx.Response(200, json=[{"lat": "42.72", "lon": "-114.51"}])
+
+    async def schedule():
+        async with AsyncSession(sqlite_db) as db:
+            for n in (2, 3):
+                job = await db.get(Job, n)
+                job.serviceDate = date(2025, 5, 10)
+                db.add(job)
+            await db.commit()
+
+    async def geocode_pending_addresses():
+        geocoder = Geocoder(url="http://geocoder.test/search", delay=0, transport=httpx.MockTransport(nominatim))
+        async with AsyncSession(sqlite_db) as db:
+            return await geocode_pending(db, geocoder)
+
+    seed_jobs(sqlite_db, 3)
+    asyncio.run(schedule())
+
+    # Until the worker has geocoded the address, the jobs can't be placed
+    assert client.get("/dispatch/2025-05-10").json()["unlocated"] == [2, 3]
+    assert lookups == []
+
+    assert asyncio.run(geocode_pending_addresses()) == 1
+    assert asyncio.run(geocode_pending_addresses()) == 0
+    assert lookups == ["1 Elm St"]
+
+    first = client.get("/dispatch/2025-05-10").json()
+    assert first["routes"][0]["employeeId"] == 1
+    assert [stop["jobId"] for stop in first["routes"][0]["stops"]] == [2, 3]
+    assert first["routes"][0]["stops"][0]["eta"] == "08:00"
+    assert first["unlocated"] == []
+
+
+def test_store_coordinates_ignores_addresses_already_cached(sqlite_db):
+    async def store_twice():
+        # Two processes geocoding the same new address both store it
+        for point in ((42.72, -114.51), (1.0, 1.0)):
+            async with AsyncSession(sqlite_db) as db:
+                await store_coordinates(db, {"1 Elm St": point})
+                await db.commit()
+        async with AsyncSession(sqlite_db) as db:
+            return await cached_coordinates(db, {"1 Elm St", "2 Oak St"})
+
+    assert asyncio.run(store_twice()) == {"1 Elm St": (42.72, -114.51)}
+
+
+def test_geocode_pending_sets_failed_addresses_aside(sqlite_db):
+    statuses = {"1 Elm St": 503, "2 Oak St": 200, "3 Ash St": 200}
+    lookups = []
+
+    def nominatim(request):
+        address = request.url.params["q"]
+        lookups.append(address)
+        if statuses[address] != 200:
+            return httpx.Response(statuses[address], headers={"Retry-After": "120"})
+        return httpx.Response(200, json=[{"lat": "42.72", "lon": "-114.51"}])
+
+    geocoder = Geocoder(url="http://geocoder.test/search", delay=0, transport=httpx.MockTransport(nominatim))
+
+    async def seed():
+        async with AsyncSession(sqlite_db) as db:
+            for n, address in enumerate(statuses, start=1):
+                db.add(Customer(customerId=n, fName="Ann", lName="Lee", phoneNumber="", email="", billingAddress="",
+                                physicalAddress=address, lastPaymentDate="", lastServiceDate="", isResidential=True,
+                                comments=""))
+            await db.commit()
+
+    async def geocode(limit):
+        async with AsyncSession(sqlite_db) as db:
+            return await geocode_pending(db, geocoder, limit=limit)
+
+    async def failed_row():
+        async with AsyncSession(sqlite_db) as db:
+            row = await db.get(GeocodeCache, "1 Elm St")
+            placed = await cached_coordinates(db, set(statuses))
+            return row.attempts, row.retryAt is not None, placed
+
+    async def retry_is_due():
+        async with AsyncSession(sqlite_db) as db:
+            await db.exec(update(GeocodeCache).where(GeocodeCache.address == "1 Elm St")
+                          .values(retryAt=datetime(2000, 1, 1, tzinfo=timezone.utc)))
+            await db.commit()
+
+    asyncio.run(seed())
+
+    # The failed address is recorded and the next batch moves on past it
+    assert asyncio.run(geocode(1)) == 0
+    assert asyncio.run(geocode(1)) == 1
+    assert asyncio.run(failed_row()) == (1, True, {"2 Oak St": (42.72, -114.51)})
+
+    # New addresses go first, then failed ones whose retry is due
+    statuses["1 Elm St"] = 200
+    asyncio.run(retry_is_due())
+    assert asyncio.run(geocode(5)) == 2
+    assert lookups == ["1 Elm St", "2 Oak St", "3 Ash St", "1 Elm St"]
+    assert asyncio.run(failed_row())[:2] == (0, False)
+
+    # A 429 pauses every lookup for Retry-After seconds without counting against the address
+    async def add_customer():
+        async with AsyncSession(sqlite_db) as db:
+            db.add(Customer(customerId=4, fName="Ann", lName="Lee", phoneNumber="", email="", billingAddress="",
+                            physicalAddress="4 Fir St", lastPaymentDate="", lastServiceDate="", isResidential=True,
+                            comments=""))
+            await db.commit()
+
+    statuses["4 Fir St"] = 429
+    asyncio.run(add_customer())
+    assert asyncio.run(geocode(5)) == 0
+    assert asyncio.run(geocode(5)) == 0
+    assert lookups[4:] == ["4 Fir St"]
+    assert 100 < geocoder.resume_at - time.monotonic() <= 120
+
+
+# *** REPORTS ***
+
+
+def seed_report_data(engine):
+    async def seed():
+        async with AsyncSession(engine) as db:
+            db.add(Employee(empId=1, fName="Bob", lName="Johnson", birthDate="2000-01-01", phoneNumber="",
+                            email="", address="", laborRate=20.0, weeklyHours=0))
+            for invoice_id, month, total, paid in ((1, 4, 100.0, True), (2, 5, 50.0, True), (3, 5, 25.5, False)):
+                db.add(Invoice(invoiceId=invoice_id, lotSize="", invoiceDate=date(2025, month, 10),
+                               dueDate=date(2025, month, 24), emailStatus=False, productsUsed="", acceptedBy="",
+                               applyTax=False, taxAmount=0, totalEstimate=total, paid=paid))
+            # Dates the migration couldn't read are left out of the monthly summaries
+            db.add(Invoice(invoiceId=4, lotSize="", invoiceDate=None, dueDate=None, emailStatus=False, productsUsed="",
+                           acceptedBy="", applyTax=False, taxAmount=0, totalEstimate=999, paid=False))
+            db.add(Expense(expenseId=2, expenseDate=None, store="Co-op", itemsPurchased="Gas",
+                           totalAmount=Decimal("5.00"), reason="", purchasedBy=1))
+            db.add(Expense(expenseId=1, expenseDate=date(2025, 5, 2), store="Co-op", itemsPurchased="Seed",
+                           totalAmount=Decimal("12.25"), reason="", purchasedBy=1))
+            db.add(Job(jobId=1, arrivalWindow="", clockIn=datetime(2025, 5, 3, 8), clockOut=datetime(2025, 5, 3, 9, 30),
+                       employeeId=1, payment=False, isActive=False, comments=""))
+            await db.commit()
+
+    asyncio.run(seed())
+
+
+def test_reports_read_refreshed_summaries(sqlite_db):
+    seed_report_data(sqlite_db)
+
+    assert client.get("/reports/revenue").json() == []
+    assert client.post("/reports/refresh", params={"full": True}).json() == {"since": None}
+
+    revenue = client.get("/reports/revenue", params={"start": "2025-05-15"}).json()
+    assert [(row["month"], row["invoiced"], row["collected"], row["invoices"]) for row in revenue] == [
+        ("2025-05-01", "75.50", "50.00", 2)]
+    expenses = client.get("/reports/expenses", params={"employeeId": 1}).json()
+    assert [(row["month"], row["amount"]) for row in expenses] == [("2025-05-01", "12.25")]
+    labor = client.get("/reports/labor").json()
+    assert [(row["month"], row["hours"], row["cost"], row["jobs"]) for row in labor] == [("2025-05-01", 1.5, "30.00", 1)]
+    receivables = client.get("/reports/receivables").json()
+    assert [(row["dueMonth"], row["outstanding"]) for row in receivables] == [("2025-05-01", "25.50")]
+
+
+def test_refresh_reports_incremental_keeps_older_months(sqlite_db, monkeypatch):
+    seed_report_data(sqlite_db)
+    monkeypatch.setattr("reports.REPORT_REFRESH_MONTHS", 1)
+
+    async def refresh_after_backdated_edit():
+        async with AsyncSession(sqlite_db, expire_on_commit=False) as db:
+            await refresh_reports(db, full=True)
+            for invoice_id in (1, 2):
+                invoice = await db.get(Invoice, invoice_id)
+                invoice.totalEstimate += 1000
+                db.add(invoice)
+            await db.commit()
+            assert await refresh_reports(db, today=date(2025, 5, 20)) == {"since": "2025-05-01"}
+            return (await db.exec(select(RevenueSummary.month, RevenueSummary.invoiced)
+                                  .order_by(RevenueSummary.month))).all()
+
+    rows = asyncio.run(refresh_after_backdated_edit())
+
+    assert rows == [(date(2025, 4, 1), Decimal("100.00")), (date(2025, 5, 1), Decimal("1075.50"))]
+
+
+def test_refresh_reports_skipped_while_another_runs(sqlite_db, monkeypatch):
+    seed_report_data(sqlite_db)
+    locks = []
+
+    async def lock_held_elsewhere(db, name):
+        locks.append(name)
+        return False
+
+    monkeypatch.setattr("reports.try_advisory_lock", lock_held_elsewhere)
+    response = client.post("/reports/refresh")
+
+    assert response.status_code == 409
+    assert locks == ["reports"]
+    assert client.get("/reports/revenue").json() == []
+
+
+def test_try_advisory_lock_on_postgres():
+    with async_session_mock() as mock_db:
+        mock_db.bind.dialect.name = "postgresql"
+        mock_db.exec.return_value.first.return_value = True
+
+        assert asyncio.run(try_advisory_lock(mock_db, "reports")) is True
+        statement = mock_db.exec.call_args[0][0].compile(dialect=postgresql.dialect())
+        assert str(statement).startswith("SELECT pg_try_advisory_xact_lock(")
+        assert list(statement.params.values()) == [ADVISORY_LOCKS["reports"]]
+
+
+
+# *** PAYROLL ***
+
+
+def test_get_payroll_splits_overtime(sqlite_db):
+    seed_report_data(sqlite_db)
+
+    async def seed():
+        async with AsyncSession(sqlite_db) as db:
+            db.add(Employee(empId=2, fName="Sam", lName="Lee", birthDate="2000-01-01", phoneNumber="",
+                            email="", address="", laborRate=15.0, weeklyHours=0))
+            # Six 7 hour days Monday to Saturday, plus a job still on the clock and one the week after
+            for day in range(6):
+                db.add(Job(arrivalWindow="", clockIn=datetime(2025, 5, 5 + day, 8), clockOut=datetime(2025, 5, 5 + day, 15),
+                           employeeId=1, payment=False, isActive=False))
+            db.add(Job(arrivalWindow="", clockIn=datetime(2025, 5, 11, 8), employeeId=1, payment=False, isActive=True))
+            db.add(Job(arrivalWindow="", clockIn=datetime(2025, 5, 12, 8), clockOut=datetime(2025, 5, 12, 9),
+                       employeeId=1, payment=False, isActive=False))
+            await db.commit()
+
+    asyncio.run(seed())
+
+    response = client.get("/payroll/2025-05-08")
+
+    assert response.status_code == 200
+    payroll = response.json()
+    assert (payroll["weekStart"], payroll["weekEnd"]) == ("2025-05-05", "2025-05-11")
+    assert [(row["empId"], row["jobs"], row["hours"], row["regularHours"], row["overtimeHours"], row["laborCost"])
+            for row in payroll["employees"]] == [(1, 6, 42.0, 40.0, 2.0, "860.00"), (2, 0, 0.0, 0.0, 0.0, "0.00")]
+    assert (payroll["totalHours"], payroll["totalCost"]) == (42.0, "860.00")
+
+
+def test_job_writes_update_weekly_hours(sqlite_db):
+    seed_report_data(sqlite_db)
+    today = date.today().isoformat()
+
+    async def weekly_hours():
+        async with AsyncSession(sqlite_db) as db:
+            return (await db.get(Employee, 1)).weeklyHours
+
+    response = client.post("/job", json={"jobId": 10, "arrivalWindow": "", "clockIn": f"{today}T08:00:00",
+                                         "clockOut": f"{today}T10:30:00", "employeeId": 1, "payment": False,
+                                         "isActive": False})
+    assert response.status_code == 201
+    assert asyncio.run(weekly_hours()) == 2.5
+
+    client.delete("/job/10", params={"jobId": 10})
+    assert asyncio.run(weekly_hours()) == 0
+
+
+def test_moving_a_job_recounts_only_both_employees(sqlite_db):
+    seed_report_data(sqlite_db)
+    client.put("/employee/2", json={"fName": "Sue", "lName": "Ng", "birthDate": "", "phoneNumber": "", "email": "",
+                                    "address": "", "laborRate": 20.0, "weeklyHours": 0})
+    client.put("/employee/3", json={"fName": "Al", "lName": "Ito", "birthDate": "", "phoneNumber": "", "email": "",
+                                    "address": "", "laborRate": 20.0, "weeklyHours": 7})
+    today = date.today().isoformat()
+    job = {"arrivalWindow": "", "clockIn": f"{today}T08:00:00", "clockOut": f"{today}T10:30:00", "employeeId": 1,
+           "payment": False, "isActive": False}
+    client.put("/job/10", params={"jobId": 10}, json=job)
+    before = {employee["empId"]: employee["version"] for employee in client.get("/employee").json()}
+    statements = []
+    event.listen(sqlite_db.sync_engine, "before_cursor_execute",
+                 lambda conn, cursor, statement, parameters, *args: statements.append((statement, parameters)))
+
+    def weekly_hours():
+        return {employee["empId"]: employee["weeklyHours"] for employee in client.get("/employee").json()}
+
+    def versions():
+        return {employee["empId"]: employee["version"] for employee in client.get("/employee").json()}
+
+    assert client.put("/job/10", params={"jobId": 10}, json={**job, "employeeId": 2}).json() == {"detail": "Job Updated"}
+    assert weekly_hours() == {1: 0, 2: 2.5, 3: 7}
+    # The upsert reads the previous employee itself, then only employees 1 and 2 are recounted
+    assert statements[0][0].startswith("WITH previous AS MATERIALIZED") and "ON CONFLICT" in statements[0][0]
+    assert statements[1][0].startswith('UPDATE employee SET "weeklyHours"')
+    assert sorted(statements[1][1][-2:]) == [1, 2]
+    # Recounted hours are a write like any other, so both versions move on
+    assert versions() == {1: before[1] + 1, 2: before[2] + 1, 3: before[3]}
+    stale = client.patch("/employee/2", json={"weeklyHours": 0, "version": before[2]})
+    assert stale.status_code == 409
+
+    client.patch("/job/10", json={"employeeId": 3})
+    assert weekly_hours() == {1: 0, 2: 0, 3: 2.5}
+
+    # A full recount with nothing changed leaves every row, and its version, alone
+    current = versions()
+
+    async def refresh_everyone():
+        async with AsyncSession(sqlite_db) as db:
+            await refresh_weekly_hours(db)
+            await db.commit()
+
+    asyncio.run(refresh_everyone())
+    assert versions() == current
+
+
+# *** DIAGNOSTICS ***
+
+
+def test_get_pool_status():
+    response = client.get("/debug/pool")
+
+    assert response.status_code == 200
+    stats = response.json()
+    for key in ("pool", "connects", "checkouts", "waitCount", "waitAvgMs", "waitMaxMs"):
+        assert key in stats
+
+
+def test_cached_requests_skip_pool_checkout(sqlite_db, monkeypatch):
+    # Served through the real get_async_db, on the test database's engine
+    monkeypatch.setattr(database, "async_engine", sqlite_db)
+    monkeypatch.delitem(app.dependency_overrides, get_async_db)
+    stats = PoolStats(sqlite_db.sync_engine.pool)
+
+    for _ in range(5):
+        assert client.get("/services").status_code == 200
+
+    # Only the first request misses the cache and needs a connection
+    assert (stats.checkouts, stats.wait_count) == (1, 1)
+
+
+def test_metrics_record_route_latency_and_sql(sqlite_db):
+    seed_jobs(sqlite_db, 3)
+    time_queries(sqlite_db)
+
+    assert client.get("/job", params={"limit": 2}).status_code == 200
+    client.delete("/job/999", params={"jobId": 999})
+    response = client.get("/metrics")
+
+    assert response.status_code == 200
+    assert response.headers["content-type"].startswith("text/plain; version=0.0.4")
+    metrics = response.text
+    assert 'http_request_duration_seconds_count{method="GET",route="/job",status="200"}' in metrics
+    assert 'http_request_duration_seconds_count{method="DELETE",route="/job/{JobId}",status="404"}' in metrics
+    queries = next(line for line in metrics.splitlines()
+                   if line.startswith('http_request_db_queries_sum{method="GET",route="/job"}'))
+    assert float(queries.split()[-1]) >= 1
+    assert "/metrics" not in metrics
+
+
+def test_square_calls_are_timed():
+    square = SquareClient(base_url="https://square.test", transport=httpx.MockTransport(
+        lambda request: httpx.Response(200, json={})))
+    asyncio.run(square.get("/payments/abc"))
+
+    assert 'external_call_duration_seconds_count{service="square",operation="GET payments",outcome="ok"}' in \
+        client.get("/metrics").text
+
+
+def test_slow_query_log_explains_statements(sqlite_db, monkeypatch):
+    for name in ("enabled", "slow_ms", "sample_rate", "repeat_threshold"):
+        monkeypatch.setattr(query_diagnostics, name, getattr(query_diagnostics, name))
+    seed_jobs(sqlite_db, 2)
+    time_queries(sqlite_db)
+
+    settings = client.put("/debug/queries", params={"enabled": True, "slowMs": 0}).json()
+    assert settings["enabled"] is True and settings["slowMs"] == 0
+    client.get("/job", params={"limit": 1, "employeeId": 1})
+
+    slow = client.get("/debug/queries").json()["slowQueries"]
+    job_query = next(query for query in slow if "FROM job" in query["statement"])
+    assert "ix_job_employeeId" in job_query["plan"]
+    assert client.put("/debug/queries", params={"sampleRate": 2}).status_code == 422
+
+
+def test_repeated_statements_in_a_request_are_flagged(monkeypatch):
+    monkeypatch.setattr(query_diagnostics, "enabled", True)
+    monkeypatch.setattr(query_diagnostics, "sample_rate", 1.0)
+    monkeypatch.setattr(query_diagnostics, "repeat_threshold", 3)
+
+    async def lazy_loading_route(scope, receive, send):
+        for _ in range(3):
+            record_query(0.001, "SELECT * FROM employee WHERE employee.\"empId\" = ?")
+        record_query(0.001, "SELECT * FROM job")
+        await send({"type": "http.response.start", "status": 200, "headers": []})
+        await send({"type": "http.response.body", "body": b""})
+
+    async def send(message):
+        pass
+
+    asyncio.run(MetricsMiddleware(lazy_loading_route)({"type": "http", "path": "/jobs", "method": "GET"}, None, send))
+
+    flagged = query_diagnostics.repeated_queries[-1]
+    assert (flagged["count"], flagged["statement"]) == (3, 'SELECT * FROM employee WHERE employee."empId" = ?')
+
+
+def test_profile_disabled_by_default():
+    assert client.get("/debug/profile", params={"seconds": 0.01}).status_code == 404
+
+
+def test_profile_samples_event_loop(monkeypatch):
+    monkeypatch.setattr("main.PROFILER_ENABLED", True)
+
+    response = client.get("/debug/profile", params={"seconds": 0.2, "interval": 0.001})
+
+    assert response.status_code == 200
+    stack, count = response.text.splitlines()[0].rsplit(" ", 1)
+    assert int(count) > 0 and ";" in stack
+    assert client.get("/debug/profile", params={"seconds": 3600}).status_code == 400
+
+
+def seed_jobs(engine, count):
+    async def seed():
+        async with AsyncSession(engine) as db:
+            db.add(Employee(empId=1, fName="Bob", lName="Johnson", birthDate="2000-01-01", phoneNumber="123-456-7890",
+                            email="bob@example.com", address="123 Apple St", laborRate=20.0, weeklyHours=0))
+            db.add(Customer(customerId=1, fName="Ann", lName="Lee", phoneNumber="555-0100", email="ann@example.com",
+                            billingAddress="1 Elm St", physicalAddress="1 Elm St", lastPaymentDate="",
+                            lastServiceDate="", isResidential=True, comments=""))
+            db.add(Services(serviceId=1, service="Mowing"))
+            for n in range(1, count + 1):
+                db.add(Invoice(invoiceId=n, lotSize="", invoiceDate=date(2025, 5, 10), dueDate=date(2025, 5, 17),
+                               emailStatus=False, productsUsed="", acceptedBy="", applyTax=False, taxAmount=0,
+                               totalEstimate=50.0, paid=False))
+                db.add(Job(jobId=n, arrivalWindow="08:00-10:00", clockIn=datetime(2025, 5, 10, 8, 15),
+                           clockOut=datetime(2025, 5, 10, 10, 0), employeeId=1,
+                           payment=False, isActive=True, comments="", invoiceId=n, customerId=1))
+                db.add(ServiceLink(serviceId=1, jobId=n))
+            await db.commit()
+
+    asyncio.run(seed())
+
+
+def test_get_jobs_expand_uses_fixed_query_count(sqlite_db):
+    seed_jobs(sqlite_db, 20)
+    statements = []
+    event.listen(sqlite_db.sync_engine, "before_cursor_execute", lambda *args: statements.append(args[2]))
+
+    response = client.get("/job", params={"expand": "servicesProvided,invoice", "limit": 20})
+
+    assert response.status_code == 200
+    jobs = response.json()
+    assert len(jobs) == 20
+    assert jobs[0]["servicesProvided"] == [{"serviceId": 1, "service": "Mowing", "price": "0.00", "version": 1}]
+    assert jobs[0]["invoice"]["invoiceId"] == 1
+    assert "customer" not in jobs[0]
+    assert len(statements) == 2
+
+
+def test_get_customers_expand_unknown(sqlite_db):
+    response = client.get("/customer", params={"expand": "password"})
+
+    assert response.status_code == 400
+
+
+def test_get_jobs_filter_and_sort_pages_by_cursor(sqlite_db):
+    seed_jobs(sqlite_db, 6)
+
+    async def vary_jobs():
+        async with AsyncSession(sqlite_db) as db:
+            for job_id, clock_in in [(1, datetime(2025, 5, 12, 9)), (2, None), (3, datetime(2025, 5, 11, 9)),
+                                     (4, datetime(2025, 5, 12, 9)), (5, datetime(2025, 5, 11, 7))]:
+                job = await db.get(Job, job_id)
+                job.clockIn = clock_in
+                db.add(job)
+            job = await db.get(Job, 6)
+            job.isActive = False
+            db.add(job)
+            await db.commit()
+
+    asyncio.run(vary_jobs())
+
+    seen, after = [], None
+    while True:
+        params = {"isActive": True, "employeeId": 1, "sort": "-clockIn", "limit": 2}
+        if after is not None:
+            params["after"] = after
+        page = client.get("/job", params=params).json()
+        if not page:
+            break
+        seen += [job["jobId"] for job in page]
+        after = page[-1]["jobId"]
+
+    assert seen == [4, 1, 3, 5, 2]
+
+    response = client.get("/job", params={"clockInFrom": "2025-05-11", "clockInTo": "2025-05-11"})
+    assert [job["jobId"] for job in response.json()] == [3, 5]
+
+
+def test_get_invoice_filters_paid_and_date_range(sqlite_db):
+    seed_jobs(sqlite_db, 3)
+
+    async def pay_first():
+        async with AsyncSession(sqlite_db) as db:
+            invoice = await db.get(Invoice, 1)
+            invoice.paid = True
+            invoice.dueDate = date(2025, 6, 1)
+            db.add(invoice)
+            await db.commit()
+
+    asyncio.run(pay_first())
+
+    unpaid = client.get("/invoice", params={"paid": False, "sort": "-invoiceId"}).json()
+    assert [invoice["invoiceId"] for invoice in unpaid] == [3, 2]
+
+    due = client.get("/invoice", params={"dueDateFrom": "2025-05-20", "dueDateTo": "2025-06-30"}).json()
+    assert [invoice["invoiceId"] for invoice in due] == [1]
+
+
+def test_get_invoice_sort_unknown(sqlite_db):
+    response = client.get("/invoice", params={"sort": "password"})
+
+    assert response.status_code == 400
+
+
+def test_get_jobs_etag_and_gzip(sqlite_db):
+    seed_jobs(sqlite_db, 20)
+
+    first = client.get("/job", headers={"Accept-Encoding": "gzip"})
+
+    assert first.status_code == 200
+    assert first.headers["content-encoding"] == "gzip"
+    assert first.headers["etag"].startswith('W/"')
+    assert len(first.json()) == 20
+
+    second = client.get("/job", headers={"If-None-Match": first.headers["etag"]})
+    assert second.status_code == 304
+    assert second.content == b""
+
+    changed = client.get("/job", params={"limit": 5}, headers={"If-None-Match": first.headers["etag"]})
+    assert changed.status_code == 200
+
+
+def test_get_jobs_column_rows_match_models(sqlite_db):
+    seed_jobs(sqlite_db, 2)
+
+    listed = client.get("/job").json()
+    streamed = [json.loads(line) for line in client.get("/job", params={"stream": True}).text.splitlines()]
+
+    assert listed == streamed
+    assert listed[0]["clockIn"] == "2025-05-10T08:15:00"
+
+
+def test_patch_job_writes_only_sent_fields(sqlite_db):
+    seed_jobs(sqlite_db, 1)
+    statements = []
+    event.listen(sqlite_db.sync_engine, "before_cursor_execute", lambda *args: statements.append(args[2]))
+
+    response = client.patch("/job/1", json={"clockOut": "2025-05-10T11:00:00", "version": 1})
+
+    assert response.status_code == 200
+    job = response.json()
+    assert (job["clockIn"], job["clockOut"], job["version"]) == ("2025-05-10T08:15:00", "2025-05-10T11:00:00", 2)
+    # The job is written in one statement, then the employee's weeklyHours is recounted
+    assert len(statements) == 2
+    assert 'UPDATE job SET "clockOut"=?, version=' in statements[0] and "RETURNING" in statements[0]
+    assert statements[1].startswith('UPDATE employee SET "weeklyHours"')
+
+    stale = client.patch("/job/1", json={"clockOut": "2025-05-10T12:00:00", "version": 1})
+    assert stale.status_code == 409 and "version 2" in stale.json()["detail"]
+    assert client.patch("/job/99", json={"comments": "Gate code 1234"}).status_code == 404
+    assert client.patch("/job/1", json={"jobId": 5}).status_code == 422
+    assert client.patch("/job/1", json={"clockOut": "after lunch"}).status_code == 422
+    assert client.patch("/job/1", json={"version": 2}).status_code == 400
+
+
+def test_writes_bump_version(sqlite_db):
+    seed_jobs(sqlite_db, 1)
+
+    patched = client.patch("/customer/1", json={"comments": "Dog in yard"}).json()
+    assert (patched["comments"], patched["fName"], patched["version"]) == ("Dog in yard", "Ann", 2)
+    client.post("/customer/bulk", json=[{**patched, "comments": "", "version": 1}])
+
+    assert client.get("/customer", params={"fields": "version"}).json() == [{"customerId": 1, "version": 3}]
+
+
+def test_delete_jobs_by_filter(sqlite_db):
+    seed_jobs(sqlite_db, 4)
+    # Job 2 is completed and invoiced, job 3 was cancelled before anyone clocked in,
+    # job 4 is completed but not billed yet
+    client.patch("/job/2", json={"isActive": False})
+    client.patch("/job/3", json={"isActive": False, "clockIn": None, "clockOut": None, "invoiceId": None})
+    client.patch("/job/4", json={"isActive": False, "invoiceId": None})
+    statements = []
+    event.listen(sqlite_db.sync_engine, "before_cursor_execute", lambda *args: statements.append(args[2]))
+
+    response = client.delete("/job", params={"isActive": False, "started": False})
+
+    assert response.status_code == 200
+    assert response.json() == {"deleted": 1, "jobIds": [3]}
+    # Link rows and expenses' linkedJob are cleared, then the jobs go in one DELETE ... RETURNING
+    assert [statement.split()[0:3] for statement in statements[:3]] == [
+        ["DELETE", "FROM", "servicelink"], ["UPDATE", "expense", "SET"], ["DELETE", "FROM", "job"]]
+    assert statements[3].startswith('UPDATE employee SET "weeklyHours"')
+    # Invoiced jobs are kept even when a broader filter matches them
+    assert client.delete("/job", params={"isActive": False}).json() == {"deleted": 1, "jobIds": [4]}
+    assert [job["jobId"] for job in client.get("/job").json()] == [1, 2]
+    assert client.delete("/job").status_code == 400
+
+
+def test_get_customers_fields(sqlite_db):
+    seed_jobs(sqlite_db, 1)
+    statements = []
+    event.listen(sqlite_db.sync_engine, "before_cursor_execute", lambda *args: statements.append(args[2]))
+
+    response = client.get("/customer", params={"fields": "fName,lName"})
+
+    assert response.json() == [{"customerId": 1, "fName": "Ann", "lName": "Lee"}]
+    assert "comments" not in statements[0]
+
+    streamed = client.get("/customer", params={"fields": ["fName"], "stream": True})
+    assert [json.loads(line) for line in streamed.text.splitlines()] == [{"customerId": 1, "fName": "Ann"}]
+
+    assert client.get("/customer", params={"custId": 1, "fields": "lName"}).json() == [{"customerId": 1, "lName": "Lee"}]
+    assert client.get("/job", params={"jobId": 1, "fields": "customerId"}).json() == [{"jobId": 1, "customerId": 1}]
+
+
+def test_search_customers_tolerates_typos(sqlite_db):
+    seed_jobs(sqlite_db, 1)
+    customers = [
+        {"customerId": 2, "fName": "Johnathan", "lName": "Smith", "phoneNumber": "208-555-0199",
+         "email": "jsmith@example.com", "physicalAddress": "42 Maple Ave"},
+        {"customerId": 3, "fName": "Jon", "lName": "Smythe", "phoneNumber": "208-555-0142",
+         "email": "jon@example.com", "physicalAddress": "9 Oak St"},
+    ]
+    for customer in customers:
+        client.post("/customer", json={**customer, "billingAddress": "", "lastPaymentDate": "", "lastServiceDate": "",
+                                       "isResidential": True, "comments": ""})
+
+    response = client.get("/customer/search", params={"q": "johnathon smith", "fields": "fName,lName"})
+
+    assert response.status_code == 200
+    results = response.json()
+    assert [(row["customerId"], row["fName"]) for row in results] == [(2, "Johnathan")]
+    assert 0 < results[0]["score"] <= 1
+    assert [row["customerId"] for row in client.get("/customer/search", params={"q": "maple"}).json()] == [2]
+    assert [row["customerId"] for row in client.get("/customer/search", params={"q": "elm"}).json()] == [1]
+    assert client.get("/customer/search", params={"q": "zzzz"}).json() == []
+
+    client.delete("/customer/2", params={"custId": 2})
+    assert client.get("/customer/search", params={"q": "maple"}).json() == []
+
+
+def test_customer_index_rebuilds_after_invalidate_during_build(sqlite_db):
+    seed_jobs(sqlite_db, 1)
+    index = CustomerSearchIndex()
+
+    # A customer written while the index's query runs
+    def customer_written(*args):
+        index.invalidate()
+
+    async def build_twice():
+        async with AsyncSession(sqlite_db) as db:
+            event.listen(sqlite_db.sync_engine, "before_cursor_execute", customer_written)
+            await index.build(db)
+            event.remove(sqlite_db.sync_engine, "before_cursor_execute", customer_written)
+            during = index.ready
+            await index.build(db)
+            return during, index.ready
+
+    assert asyncio.run(build_twice()) == (False, True)
+    assert [customer_id for customer_id, _ in index.search("ann", 5)] == [1]
+
+    # Writes in other workers never reach invalidate(), the ttl bounds how long they go unseen
+    expired = CustomerSearchIndex(ttl=0)
+
+    async def build():
+        async with AsyncSession(sqlite_db) as db:
+            await expired.build(db)
+
+    asyncio.run(build())
+    assert expired.ready is False
+
+
+def test_search_customers_postgres_query():
+    with async_session_mock() as mock_db:
+        mock_db.bind.dialect.name = "postgresql"
+        mock_db.exec.return_value.keys.return_value = ["customerId"]
+        mock_db.exec.return_value.all.return_value = [(7, 0.5)]
+        app.dependency_overrides[get_async_db] = lambda: mock_db
+        response = client.get("/customer/search", params={"q": "smith"})
+
+        assert response.json() == [{"customerId": 7, "score": 0.5}]
+        ranking = str(mock_db.exec.call_args_list[1][0][0].compile(dialect=postgresql.dialect()))
+        assert "word_similarity" in ranking and "<%" in ranking and "@@ plainto_tsquery('simple'" in ranking
+
+
+def test_get_jobs_fields_unknown_or_with_expand(sqlite_db):
+    assert client.get("/job", params={"fields": "password"}).status_code == 400
+    assert client.get("/job", params={"fields": "jobId", "expand": "invoice"}).status_code == 400
+
+
+def test_get_jobs_stream_gzip(sqlite_db):
+    seed_jobs(sqlite_db, 20)
+
+    response = client.get("/job", params={"stream": True}, headers={"Accept-Encoding": "gzip"})
+
+    assert response.headers["content-encoding"] == "gzip"
+    assert len(response.text.splitlines()) == 20
+
+
+# *** MIGRATIONS ***
+
+
+# Conversion SQL only runs on Postgres, set TEST_POSTGRES_URL to a scratch database to check it
+TEST_POSTGRES_URL = os.getenv("TEST_POSTGRES_URL")
+
+
+def load_migration(name):
+    path = next(Path(__file__).with_name("alembic").joinpath("versions").glob(f"{name}_*.py"))
+    spec = importlib.util.spec_from_file_location(path.stem, path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+@pytest.mark.skipif(not TEST_POSTGRES_URL, reason="needs TEST_POSTGRES_URL")
+def test_type_migration_nulls_impossible_dates_and_times():
+    migration = load_migration("3c9e51d7a2f4")
+    engine = create_engine(TEST_POSTGRES_URL)
+    values = ["2025-05-10", "5/10/2025", "13/45/2025", "2/30/2025", "2025-02-30", "2025-01-01garbage", "", "soon"]
+    with engine.connect() as connection:
+        connection.execute(text(migration.SAFE_DATE))
+        connection.execute(text(migration.SAFE_TIMESTAMP))
+        dates = [connection.execute(text(f"SELECT {migration.as_date('value')} FROM (SELECT :value AS value) AS row"),
+                                    {"value": value}).scalar() for value in values]
+        times = [connection.execute(text(f"SELECT {migration.as_timestamp('value')} FROM (SELECT :value AS value) AS row"),
+                                    {"value": value}).scalar()
+                 for value in ("2025-05-10 08:15", "2025-02-30 08:15", "2025-05-10 25:00", "08:15")]
+        connection.rollback()
+    engine.dispose()
+
+    assert dates == [date(2025, 5, 10), date(2025, 5, 10), None, None, None, None, None, None]
+    assert times == [datetime(2025, 5, 10, 8, 15), None, None, None]
+
+
 ############################
 # *** SQUARE PAYMENTS ***
 ############################
 
 
+@pytest.fixture
+def square_stub():
+    stub_client = SquareClient(base_url="http://square.test/v2", transport=httpx.ASGITransport(app=square_stub_app))
+    app.dependency_overrides[get_square] = lambda: stub_client
+    square_stub_payments.clear()
+    payments_cache.clear()
+    yield square_stub_payments
+    app.dependency_overrides.pop(get_square)
+
+
 # *** list_payments ***
 
-@patch('main.requests.get')
-def test_list_payments(mock_get):
-    mock_response = {
-        'payments': [
-            {'id': "N660Kal63Svrcev0BFhBDclL9lNZY", 'amount': 100},
-            {'id': "TTNksUg2Y2xZiTI0UYJqBIrPFWNZY", 'amount': 200}
-        ]
-    }
-    mock_get.return_value.status_code = 200
-    mock_get.return_value.json.return_value = mock_response
+def test_list_payments(square_stub):
+    square_stub.update({
+        "N660Kal63Svrcev0BFhBDclL9lNZY": {'id': "N660Kal63Svrcev0BFhBDclL9lNZY", 'amount': 100},
+        "TTNksUg2Y2xZiTI0UYJqBIrPFWNZY": {'id': "TTNksUg2Y2xZiTI0UYJqBIrPFWNZY", 'amount': 200},
+    })
 
     response = client.get("/payments")
 
     assert response.status_code == 200
-    assert response.json() == mock_response['payments']
+    assert response.json() == list(square_stub.values())
+    assert "etag" not in response.headers
 
-@patch('main.requests.get')
-def test_list_payments_error(mock_get):
 
-    mock_get.return_value.status_code = 404
-    mock_get.return_value.text = "Payment not found"
+def test_list_payments_error():
+    payments_cache.clear()
+    failing_transport = httpx.MockTransport(lambda request: httpx.Response(404, text="Payment not found"))
+    app.dependency_overrides[get_square] = lambda: SquareClient(base_url="http://square.test/v2", transport=failing_transport)
 
     response = client.get("/payments")
 
     assert response.status_code == 404
     assert response.json() == {"detail": "Payment not found"}
+    app.dependency_overrides.pop(get_square)
+
+
+def test_list_payments_timeout():
+    payments_cache.clear()
+
+    def timeout(request):
+        raise httpx.ReadTimeout("timed out", request=request)
+
+    app.dependency_overrides[get_square] = lambda: SquareClient(base_url="http://square.test/v2", transport=httpx.MockTransport(timeout))
+
+    response = client.get("/payments")
+
+    assert response.status_code == 504
+    app.dependency_overrides.pop(get_square)
+
+
+def test_list_payments_later_page_failure_ends_array(square_stub):
+    def second_page_fails(request):
+        if "cursor" in request.url.params:
+            return httpx.Response(500, text="Internal error")
+        return httpx.Response(200, json={"payments": [{"id": "payment-0"}, {"id": "payment-1"}], "cursor": "2"})
+
+    app.dependency_overrides[get_square] = lambda: SquareClient(base_url="http://square.test/v2",
+                                                                transport=httpx.MockTransport(second_page_fails))
+    response = client.get("/payments")
+
+    assert response.status_code == 200
+    payments = response.json()
+    assert [payment.get("id") for payment in payments[:2]] == ["payment-0", "payment-1"]
+    assert "error" in payments[2]
+    assert payments_cache.get(()) is None
+
+
+def test_list_payments_connection_error():
+    payments_cache.clear()
+
+    def refused(request):
+        raise httpx.ConnectError("connection refused", request=request)
+
+    app.dependency_overrides[get_square] = lambda: SquareClient(base_url="http://square.test/v2", transport=httpx.MockTransport(refused))
+
+    response = client.get("/payments")
+
+    assert response.status_code == 502
+    assert response.json() == {"detail": "Square API could not be reached"}
+    app.dependency_overrides.pop(get_square)
+
+
+def test_list_payments_follows_cursor_and_caches(square_stub, monkeypatch):
+    monkeypatch.setattr(square_stub_module, "PAGE_SIZE", 2)
+    for n in range(5):
+        square_stub[f"payment-{n}"] = {"id": f"payment-{n}", "amount": n}
+
+    response = client.get("/payments", params={"location_id": "L1"})
+
+    assert response.status_code == 200
+    assert [payment["id"] for payment in response.json()] == [f"payment-{n}" for n in range(5)]
+
+    square_stub.clear()
+    response = client.get("/payments", params={"location_id": "L1"})
+
+    assert len(response.json()) == 5
+    assert client.get("/debug/cache").json()["payments"]["hits"] >= 1
+
+
+# *** create_payment ***
+
+def test_create_and_get_payment(square_stub):
+    response = client.post("/payments", params={"amount": 100, "source_id": "cnon:card-nonce-ok", "idempotency_key": "abc"})
+
+    assert response.status_code == 200
+    payment = response.json()["payment"]
+    assert payment["amount_money"] == {"amount": 100, "currency": "USD"}
+
+    response = client.get(f"/payments/{payment['id']}")
+
+    assert response.status_code == 200
+    assert response.json()["payment"]["id"] == payment["id"]